@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""Микробенчмарк JSON кодеков на апдейтах вебхука и логирования тела запроса.
+
+    python bench_codec.py [итераций]
+"""
+import sys
+import json
+import timeit
+import codec
+from sample_updates import text_update, photo_update, long_text_update
+
+
+def backends():
+    found = {"json": (json.loads, lambda obj: json.dumps(obj, ensure_ascii=False).encode())}
+    try:
+        import orjson
+        found["orjson"] = (orjson.loads, orjson.dumps)
+    except ImportError:
+        pass
+    try:
+        import msgspec
+        found["msgspec"] = (msgspec.json.decode, msgspec.json.encode)
+    except ImportError:
+        pass
+    return found
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    payloads = {
+        "text": text_update(1),
+        "photo": photo_update(2),
+        "long_text": long_text_update(3),
+    }
+    print(f"codec.BACKEND = {codec.BACKEND}\n")
+    print(f"{'апдейт':<11}{'размер':>8}  {'кодек':<9}{'decode мкс':>12}{'encode мкс':>12}")
+    for name, payload in payloads.items():
+        raw = json.dumps(payload, ensure_ascii=False).encode()
+        for backend, (loads, dumps) in backends().items():
+            decode = timeit.timeit(lambda: loads(raw), number=iterations) / iterations * 1e6
+            encode = timeit.timeit(lambda: dumps(payload), number=iterations) / iterations * 1e6
+            print(f"{name:<11}{len(raw):>8}  {backend:<9}{decode:>12.2f}{encode:>12.2f}")
+
+    print(f"\n{'лог тела':<11}{'способ':<26}{'мкс':>8}")
+    for name, payload in payloads.items():
+        raw = json.dumps(payload, ensure_ascii=False).encode()
+        old = timeit.timeit(lambda: json.dumps(payload, ensure_ascii=False)[:200], number=iterations)
+        lazy = timeit.timeit(lambda: codec.Preview(raw), number=iterations)
+        emitted = timeit.timeit(lambda: str(codec.Preview(raw)), number=iterations)
+        print(f"{name:<11}{'json.dumps(...)[:200]':<26}{old / iterations * 1e6:>8.2f}")
+        print(f"{'':<11}{'Preview (не записан)':<26}{lazy / iterations * 1e6:>8.2f}")
+        print(f"{'':<11}{'Preview (записан)':<26}{emitted / iterations * 1e6:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Сравнение быстрого пути FastRouter с Update.de_json: CPU и аллокации на апдейт.
+
+    python bench_fast_router.py [итераций]
+"""
+import sys
+import time
+import tracemalloc
+from telegram import Bot, Update
+from fast_router import FastRouter
+from sample_updates import text_update, command_update, photo_update
+
+bot = Bot("123456:BENCHMARK")
+
+
+def de_json_path(data):
+    update = Update.de_json(data, bot)
+    message = update.message
+    if message.text == "/start":
+        return message.chat.id
+    if message.text:
+        return message.chat.id, message.text
+    if message.photo:
+        return message.chat.id
+
+
+router = FastRouter()
+router.command("start")(lambda raw: raw.chat_id)
+router.text(lambda raw: (raw.chat_id, raw.text))
+router.photo(lambda raw: raw.chat_id)
+
+
+def fast_path(data):
+    return router.route(data, bot)
+
+
+def measure(func, payloads, iterations):
+    start = time.process_time()
+    for i in range(iterations):
+        func(payloads[i % len(payloads)])
+    cpu_us = (time.process_time() - start) / iterations * 1e6
+
+    # Пик памяти, выделенной за обработку одного апдейта
+    tracemalloc.start()
+    peak = 0
+    for payload in payloads:
+        tracemalloc.reset_peak()
+        func(payload)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+    tracemalloc.stop()
+    return cpu_us, peak
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    cases = {
+        "text": [text_update(i, 1000 + i % 10) for i in range(100)],
+        "command": [command_update(i, 1000 + i % 10) for i in range(100)],
+        "photo": [photo_update(i, 1000 + i % 10) for i in range(100)],
+    }
+    print(f"{'апдейт':<10}{'путь':<12}{'CPU мкс/апдейт':>16}{'пик памяти, Б':>16}")
+    for name, payloads in cases.items():
+        for label, func in (("de_json", de_json_path), ("fast", fast_path)):
+            cpu_us, peak = measure(func, payloads, iterations)
+            print(f"{name:<10}{label:<12}{cpu_us:>16.2f}{peak:>16}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Время холодного старта вариантов сервера против локального fake_bot_api.py.
+
+    python bench_startup.py [вариант ...] [--repeat 3] [--latency 0.02] [--handshake 0.1]
+
+Для каждого варианта меряется:
+  * импорт модуля в чистом интерпретаторе (медиана из --repeat запусков);
+  * запуск под gunicorn: время до первого ответа /health, до готовности
+    (/ready, конец прогрева из warmup.py) и до первого ответа бота
+    (sendMessage в заглушке) на команду /start;
+  * задержка ответа на первую и на вторую команду /start после /ready:
+    если прогрев работает, первая не медленнее второй. Заглушка берёт
+    --handshake секунд за каждое новое соединение, как TCP+TLS до
+    api.telegram.org.
+"""
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+import subprocess
+import aiohttp
+import codec
+from sample_updates import command_update
+from loadtest import (ENTRY_POINTS, HERE, free_port, start_fake_api, server_env, server_command,
+                      wait_http, fake_api)
+
+IMPORT_SNIPPET = "import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+
+
+def import_time(module, env):
+    output = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET.format(module=module)],
+                            cwd=HERE, env=env, capture_output=True, text=True, timeout=60)
+    if output.returncode != 0:
+        raise RuntimeError(output.stderr.strip().splitlines()[-1])
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+async def reply_latency(session, url, api_base, update_id, deadline):
+    """Секунды от отправки /start до вызова sendMessage в заглушке."""
+    before = (await fake_api(session, api_base, "/fake/stats"))["calls"].get("sendMessage", 0)
+    body = codec.dumps(command_update(update_id, chat_id=1000 + update_id))
+    started = time.perf_counter()
+    while time.monotonic() < deadline:
+        async with session.post(url, data=body, headers={"Content-Type": "application/json"}) as response:
+            await response.read()
+        if response.status == 200:
+            break
+        await asyncio.sleep(0.05)
+    while time.monotonic() < deadline:
+        calls = (await fake_api(session, api_base, "/fake/stats"))["calls"]
+        if calls.get("sendMessage", 0) > before:
+            return time.perf_counter() - started
+        await asyncio.sleep(0.005)
+    return None
+
+
+async def cold_start(name, api_base, timeout):
+    """Секунды до /health, до /ready и до первого ответа бота; задержки первого и второго ответа."""
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    path = ENTRY_POINTS[name][2]
+    async with aiohttp.ClientSession() as session:
+        await fake_api(session, api_base, "/fake/reset", "POST")
+        started = time.perf_counter()
+        server = subprocess.Popen(server_command(name, port), cwd=HERE, env=server_env(port, api_base),
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            if not await wait_http(f"{base}/health", timeout):
+                return None, None, None, None, None
+            health = time.perf_counter() - started
+            # Платформа начинает слать трафик после /ready
+            ready = time.perf_counter() - started if await wait_http(f"{base}/ready", timeout) else None
+            deadline = time.monotonic() + timeout
+            first = await reply_latency(session, base + path, api_base, 1, deadline)
+            reply = time.perf_counter() - started if first is not None else None
+            second = await reply_latency(session, base + path, api_base, 2, deadline)
+            return health, ready, reply, first, second
+        finally:
+            server.terminate()
+            try:
+                server.wait(10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+
+
+def seconds(value):
+    return f"{value:>10.3f}" if value is not None else f"{'-':>10}"
+
+
+def millis(value):
+    return f"{value * 1000:>10.1f}" if value is not None else f"{'-':>10}"
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Время холодного старта вариантов сервера")
+    parser.add_argument("entries", nargs="*", metavar="вариант",
+                        help=f"варианты сервера: {', '.join(ENTRY_POINTS)} (по умолчанию все)")
+    parser.add_argument("--repeat", type=int, default=3, help="повторов замера импорта")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка Bot API, с")
+    parser.add_argument("--handshake", type=float, default=0.1, help="цена нового соединения к Bot API, с")
+    args = parser.parse_args()
+    unknown = set(args.entries) - set(ENTRY_POINTS)
+    if unknown:
+        parser.error(f"неизвестные варианты: {', '.join(sorted(unknown))}")
+
+    api_port = free_port()
+    api_base = f"http://127.0.0.1:{api_port}"
+    fake = start_fake_api(api_port, args.latency, handshake=args.handshake)
+    try:
+        if not await wait_http(f"{api_base}/fake/stats", 10):
+            sys.exit("fake_bot_api.py не запустился")
+        print(f"{'вариант':<20}{'импорт с':>10}{'/health с':>10}{'/ready с':>10}{'ответ с':>10}"
+              f"{'1-й мс':>10}{'2-й мс':>10}")
+        for name in args.entries or ENTRY_POINTS:
+            module = ENTRY_POINTS[name][0].split(":")[0]
+            env = server_env(free_port(), api_base)
+            try:
+                imported = statistics.median(import_time(module, env) for _ in range(args.repeat))
+            except RuntimeError as e:
+                print(f"{name:<20}  ошибка импорта: {e}")
+                continue
+            health, ready, reply, first, second = await cold_start(name, api_base, args.timeout)
+            print(f"{name:<20}{imported:>10.3f}{seconds(health)}{seconds(ready)}{seconds(reply)}"
+                  f"{millis(first)}{millis(second)}", flush=True)
+    finally:
+        fake.terminate()
+        fake.wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
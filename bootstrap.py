@@ -0,0 +1,83 @@
+import os
+import time
+import logging
+import functools
+import threading
+
+# Seconds before a failed setup runs again; doubles with every failure in a row
+BOOTSTRAP_RETRY_DELAY = float(os.getenv("BOOTSTRAP_RETRY_DELAY", "30"))
+BOOTSTRAP_RETRY_MAX_DELAY = float(os.getenv("BOOTSTRAP_RETRY_MAX_DELAY", "600"))
+
+logger = logging.getLogger(__name__)
+
+
+class Bootstrap:
+    """Runs an expensive setup function once per process, on first call.
+
+    Server modules import without side effects and wrap their setup (building
+    the Application, starting the bot loop, registering the webhook) in
+    :func:`run_once`. The setup then runs from gunicorn's ``post_worker_init``
+    hook (see gunicorn.conf.py) or lazily on the first request that needs it.
+    The result is remembered per process id, so a setup that ran before a
+    fork (``preload_app``) runs again in each worker, where its threads and
+    connections actually live.
+
+    A setup that raises is not re-run by every request: the exception is
+    kept for the process and re-raised until a retry delay has passed
+    (:data:`BOOTSTRAP_RETRY_DELAY`, doubling up to
+    :data:`BOOTSTRAP_RETRY_MAX_DELAY`). Whatever the failed attempt had
+    already started - a bot loop, monitor or poller threads - is thus
+    started again at most once per delay, not once per request.
+    """
+
+    def __init__(self, setup):
+        self.setup = setup
+        self.result = None
+        self.duration = None
+        self.error = None
+        self.failures = 0
+        self._pid = None
+        self._failed_pid = None
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+        functools.update_wrapper(self, setup)
+
+    @property
+    def done(self):
+        return self._pid == os.getpid()
+
+    def __call__(self):
+        if self._pid == os.getpid():
+            return self.result
+        with self._lock:
+            if self._pid != os.getpid():
+                self._run()
+        return self.result
+
+    def _run(self):
+        pid = os.getpid()
+        if self._failed_pid != pid:
+            # A failure before fork says nothing about this worker
+            self._failed_pid, self.error, self.failures = pid, None, 0
+        if self.error is not None and time.monotonic() < self._retry_at:
+            raise self.error
+        start = time.perf_counter()
+        try:
+            self.result = self.setup()
+        except Exception as e:
+            self.error = e
+            self.failures += 1
+            delay = min(BOOTSTRAP_RETRY_MAX_DELAY, BOOTSTRAP_RETRY_DELAY * 2 ** (self.failures - 1))
+            self._retry_at = time.monotonic() + delay
+            logger.error("Инициализация %s не удалась (%s), следующая попытка через %.0f с",
+                         self.setup.__module__, e, delay)
+            raise
+        self.duration = time.perf_counter() - start
+        self.error = None
+        self._pid = pid
+        logger.info("Инициализация %s заняла %.3f с", self.setup.__module__, self.duration)
+
+
+def run_once(setup):
+    """Decorator turning ``setup`` into a :class:`Bootstrap`."""
+    return Bootstrap(setup)
@@ -7,228 +7,233 @@ from telegram import Update, WebAppInfo, InlineKeyboardButton, InlineKeyboardMar
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, filters
 from telegram.error import TelegramError
 from dotenv import load_dotenv
-import threading
+import codec
+import metrics
+import inline_reply
+from bot_api import PTBRequest, PTB_BASE_URL, PTB_BASE_FILE_URL
+from rate_limit import PTBRateLimiter
+from bot_loop import BotLoop
+from ingest import RETRY_AFTER
+from dedup import recent_updates
+import ops_routes
+from bootstrap import run_once
+from leader import leader_lock
+from webhook_registration import allowed_updates_for
+from polling import UpdatePoller
+import warmup
+from readiness import monitor
+import profiling
+from webhook_auth import WEBHOOK_SECRET, webhook_path, reject as reject_webhook
+from webapp import load_webapp
+from log_setup import setup_logging, SAMPLE_WEBHOOK, SAMPLE_HEALTH, SAMPLE_WEBAPP
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Set up logging for better visibility
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Set up logging for better visibility (written off-thread, see log_setup.py)
+setup_logging('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
 # Load environment variables
 TOKEN = os.getenv("BOT_TOKEN")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 PORT = int(os.getenv("PORT", "8000"))
-WEBHOOK_PATH = f'/{TOKEN}'
-
-# Web App HTML content
-WEB_APP_HTML = """
-<!DOCTYPE html>
-<html>
-<head>
-    <title>Моё первое Web App</title>
-    <style>
-        body {
-            font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, Helvetica, Arial, sans-serif;
-            text-align: center;
-            background-color: #f0f2f5;
-            padding: 20px;
-        }
-        .container {
-            background-color: white;
-            border-radius: 12px;
-            box-shadow: 0 4px 12px rgba(0, 0, 0, 0.1);
-            padding: 30px;
-            max-width: 400px;
-            margin: 0 auto;
-        }
-        h1 {
-            color: #333;
-            margin-bottom: 20px;
-        }
-        p {
-            color: #666;
-            line-height: 1.6;
-        }
-        button {
-            background-color: #007bff;
-            color: white;
-            border: none;
-            padding: 12px 24px;
-            border-radius: 8px;
-            font-size: 16px;
-            cursor: pointer;
-            transition: background-color 0.3s;
-            margin-top: 20px;
-        }
-        button:hover {
-            background-color: #0056b3;
-        }
-    </style>
-    <script src="https://telegram.org/js/telegram-web-app.js"></script>
-    <script>
-        function sendMessage() {
-            // Отправляем данные боту
-            Telegram.WebApp.sendData("Привет, бот! Я из Web App!");
-        }
-    </script>
-</head>
-<body>
-    <div class="container">
-        <h1>Добро пожаловать в Web App!</h1>
-        <p>Это простое веб-приложение, запущенное прямо в Telegram.</p>
-        <button onclick="sendMessage()">Отправить сообщение боту</button>
-    </div>
-</body>
-</html>
-"""
+WEBHOOK_PATH = webhook_path(TOKEN)
 
 # Create Flask app
 app = Flask(__name__)
 
-# Global variable to store the bot application
+# Global variables to store the bot application and its event loop
 bot_application = None
-
-def init_bot():
-    """Initialize bot application."""
-    global bot_application
+bot_loop = None
+# The leader's UpdatePoller (None in the other workers)
+poller = None
+
+@run_once
+def bootstrap():
+    """Build the bot application, start its loop and register the webhook.
+
+    Runs once per worker process: from gunicorn's post_worker_init hook or on
+    the first webhook, never at import.
+    """
+    global bot_application, bot_loop, poller
     
     if not all([TOKEN, WEBHOOK_URL]):
         logging.error("Не установлены обязательные переменные окружения")
         return None
     
     # Build the Application
-    bot_application = ApplicationBuilder().token(TOKEN).build()
+    bot_application = ApplicationBuilder().token(TOKEN).base_url(PTB_BASE_URL).base_file_url(PTB_BASE_FILE_URL).request(PTBRequest()).rate_limiter(PTBRateLimiter()).build()
     
     # Add command handlers
     bot_application.add_handler(CommandHandler("start", start_command))
     bot_application.add_handler(CommandHandler("openweb", start_webapp_command))
     bot_application.add_handler(MessageHandler(filters.StatusUpdate.WEB_APP_DATA, web_app_data_handler))
     
-    # Set webhook in background (non-blocking)
-    def setup_webhook_background():
-        async def setup_webhook():
-            webhook_full_url = WEBHOOK_URL + WEBHOOK_PATH
-            await bot_application.bot.set_webhook(url=webhook_full_url)
-            logging.info(f"Вебхук успешно установлен на URL: {webhook_full_url}")
-        
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(setup_webhook())
-        loop.close()
+    # Run the Application on one shared background event loop
+    bot_loop = BotLoop(bot_application).start()
+    monitor.start(ingest=bot_loop.ingest, loop=bot_loop.loop, warm=warmup.is_ready)
     
-    # Start webhook setup in background thread (don't wait for it)
-    setup_thread = threading.Thread(target=setup_webhook_background)
-    setup_thread.daemon = True  # Daemon thread won't block app shutdown
-    setup_thread.start()
+    # With several workers only the elected leader registers the webhook; it
+    # also falls back to getUpdates while the webhook lags (see polling.py).
+    # Runs in a background thread (non-blocking).
+    if leader_lock.acquire():
+        poller = UpdatePoller(TOKEN, deliver_polled_update, WEBHOOK_URL + WEBHOOK_PATH,
+                              allowed_updates_for(bot_application), secret_token=WEBHOOK_SECRET).start()
     
     logging.info("Bot application инициализирован")
     return bot_application
 
+def deliver_polled_update(data):
+    """Sends an update fetched with getUpdates down the webhook's path; False if full."""
+    update_id = data.get('update_id')
+    if update_id is not None and recent_updates.seen(update_id):
+        return True
+    with metrics.STAGE_DE_JSON.time():
+        update = Update.de_json(data, bot_application.bot)
+    if not bot_loop.submit(update):
+        recent_updates.forget(update_id)
+        return False
+    return True
+
 @app.route('/health')
 def health_check():
-    """Health check endpoint."""
-    logging.info("Получен запрос на /health")
+    """Liveness probe: constant time and no logging (readiness is /ready)."""
     return 'OK', 200
 
+def ops_components():
+    """Parts of this server shown by /diagnostics (see ops_routes.py)."""
+    return {"dispatcher": bot_loop and bot_loop.dispatcher, "ingest": bot_loop and bot_loop.ingest, "poller": poller}
+
+# /ready, /metrics, /diagnostics and /debug/*
+app.register_blueprint(ops_routes.blueprint(ops_components))
+
 @app.route('/ping')
 def ping():
     """Simple ping endpoint."""
-    logging.info("Получен запрос на /ping")
+    logging.info("Получен запрос на /ping", extra=SAMPLE_HEALTH)
     return 'pong', 200
 
 # Removed @app.before_first_request as it's deprecated in newer Flask versions
 
+# Web App files, compressed and hashed once at startup
+webapp_assets = load_webapp()
+
 @app.route('/')
-def web_app_handler():
-    """Handles requests for the Web App and returns the HTML page."""
-    logging.info("Получен GET-запрос на главную страницу Web App")
-    return WEB_APP_HTML
+@app.route('/<path:filename>')
+def web_app_handler(filename=None):
+    """Handles requests for the Web App and returns the HTML page or bundle file."""
+    logging.info("Получен GET-запрос на главную страницу Web App", extra=SAMPLE_WEBAPP)
+    asset = webapp_assets.get(filename)
+    if asset is None:
+        return 'Not found', 404
+    status, headers, body = asset.respond(request.headers)
+    return body, status, headers
 
 @app.route(WEBHOOK_PATH, methods=['POST'])
+@metrics.track_request
+@profiling.trace_webhook
 def telegram_webhook_handler():
     """Handles incoming webhooks from Telegram."""
+    # Junk traffic is turned away on its headers, before the body is read
+    rejected = reject_webhook(request.headers)
+    if rejected:
+        return rejected
+    update_id = None
     try:
-        data = request.get_json()
-        logging.info(f"Получен вебхук от Telegram: {data.get('update_id', 'unknown')}")
+        body = request.get_data()
+        with metrics.STAGE_DECODE.time():
+            data = codec.loads(body)
+        logging.info("Получен вебхук от Telegram: %s", data.get('update_id', 'unknown'), extra=SAMPLE_WEBHOOK)
         
+        bootstrap()
         if not bot_application:
             logging.error("Bot application не инициализирован")
             return 'Bot not initialized', 500
         
-        update = Update.de_json(data, bot_application.bot)
+        # Telegram redelivers updates it considers undelivered; process each one once
+        update_id = data.get('update_id')
+        if update_id is not None and recent_updates.seen(update_id):
+            logging.info("Повторная доставка апдейта %s, пропускаем", update_id)
+            return 'OK'
+        
+        with metrics.STAGE_DE_JSON.time():
+            update = Update.de_json(data, bot_application.bot)
         
         if not update:
             logging.warning("Не удалось создать объект Update из данных вебхука")
             return 'Invalid update data', 400
         
-        # Process the update with the bot application in a separate thread
-        def process_update():
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            loop.run_until_complete(bot_application.process_update(update))
-            loop.close()
-        
-        thread = threading.Thread(target=process_update)
-        thread.start()
+        # Hand the update over to the shared bot event loop
+        slot = inline_reply.new_slot()
+        if not bot_loop.submit(update, slot):
+            logging.warning("Очередь апдейтов переполнена, просим Telegram повторить позже")
+            recent_updates.forget(update_id)
+            return 'Overloaded', 503, {'Retry-After': str(RETRY_AFTER)}
         
-        logging.info("Вебхук обработан успешно")
+        logging.info("Вебхук обработан успешно", extra=SAMPLE_WEBHOOK)
+        # With INLINE_REPLIES=1 the handler's first reply is the response body
+        if slot is not None and slot.wait():
+            return slot.body, 200, inline_reply.JSON_HEADERS
         return 'OK'
         
     except Exception as e:
         logging.error("Ошибка при обработке вебхука: %s", e, exc_info=True)
+        if update_id is not None:
+            recent_updates.forget(update_id)
         return f'Error: {e}', 500
 
 # Command handlers
+@metrics.track_handler
+@profiling.trace_handler
 async def start_webapp_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Sends a button to open the Web App."""
     try:
-        logging.info(f"Получена команда /openweb от пользователя {update.effective_user.id}")
+        logging.info("Получена команда /openweb от пользователя %s", update.effective_user.id, extra=SAMPLE_WEBHOOK)
         
         webapp_url = WEBHOOK_URL.rstrip('/')
-        logging.info(f"Используется URL для Web App: {webapp_url}")
+        logging.debug("Используется URL для Web App: %s", webapp_url)
         
         keyboard = [
             [InlineKeyboardButton("Открыть Web App", web_app=WebAppInfo(url=webapp_url))]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text("Нажмите кнопку, чтобы открыть Web App:", reply_markup=reply_markup)
-        logging.info("Кнопка Web App отправлена успешно")
+        logging.info("Кнопка Web App отправлена успешно", extra=SAMPLE_WEBHOOK)
         
     except Exception as e:
-        logging.error(f"Ошибка при обработке команды /openweb: {e}")
+        logging.error("Ошибка при обработке команды /openweb: %s", e)
         await update.message.reply_text("Произошла ошибка при создании Web App.")
 
+@metrics.track_handler
+@profiling.trace_handler
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles the /start command."""
     try:
-        logging.info(f"Получена команда /start от пользователя {update.effective_user.id}")
+        logging.info("Получена команда /start от пользователя %s", update.effective_user.id, extra=SAMPLE_WEBHOOK)
         await update.message.reply_text("Привет! Я готов к работе. Используйте /openweb, чтобы открыть Web App.")
-        logging.info("Ответ на команду /start отправлен успешно")
+        logging.info("Ответ на команду /start отправлен успешно", extra=SAMPLE_WEBHOOK)
     except Exception as e:
-        logging.error(f"Ошибка при обработке команды /start: {e}")
+        logging.error("Ошибка при обработке команды /start: %s", e)
         await update.message.reply_text("Произошла ошибка при обработке команды.")
 
+@metrics.track_handler
+@profiling.trace_handler
 async def web_app_data_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles data sent from the Web App."""
     try:
         if update.message.web_app_data:
             data = update.message.web_app_data.data
-            logging.info(f"Получены данные от Web App: {data}")
+            logging.info("Получены данные от Web App: %s", data, extra=SAMPLE_WEBHOOK)
             await update.message.reply_text(f"Получено сообщение от Web App: {data}")
         else:
             logging.warning("Получено сообщение без данных Web App")
     except Exception as e:
-        logging.error(f"Ошибка при обработке данных Web App: {e}")
+        logging.error("Ошибка при обработке данных Web App: %s", e)
         await update.message.reply_text("Ошибка при обработке данных от Web App.")
 
-# Initialize bot when module is imported
-init_bot()
 logging.info("Flask приложение готово к работе!")
 
 if __name__ == '__main__':
     logging.info("Запуск Flask веб-сервера...")
+    bootstrap()
     app.run(host='0.0.0.0', port=PORT, debug=False)
\ No newline at end of file
@@ -1,36 +1,60 @@
 #!/usr/bin/env python3
 import os
 import sys
-import logging
 import asyncio
-from flask import Flask, request
+import logging
+from aiohttp import web
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
+from rate_limit import PTBRateLimiter
+import codec
+import metrics
+import inline_reply
+from bot_api import PTBRequest, PTB_BASE_URL, PTB_BASE_FILE_URL
+from webapp import load_webapp
+from ingest import RETRY_AFTER
+from dispatcher import ChatDispatcher, Overloaded
+from bot_loop import INIT_RETRY_DELAY
+from dedup import recent_updates
+from log_setup import setup_logging
+from leader import leader_lock
+from webhook_registration import allowed_updates_for
+from polling import UpdatePoller
+from resilience import diagnostics
+import warmup
+from readiness import monitor
+import profiling
+from webhook_auth import WEBHOOK_SECRET, webhook_path, reject as reject_webhook
 
-# --- Логирование ---
-logging.basicConfig(
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-
-# --- Flask ---
-app = Flask(__name__)
+# --- Логирование (запись в отдельном потоке, см. log_setup.py) ---
+setup_logging('%(asctime)s - %(levelname)s - %(message)s')
 
 # --- Переменные окружения ---
 PORT = int(os.environ.get("PORT", 8080))
-TOKEN = os.environ.get("BOT_TOKEN")  # Railway Variables
-WEBHOOK_URL = f"https://{os.environ.get('RAILWAY_STATIC_URL', 'xxxkg-production.up.railway.app')}/{TOKEN}"
+TOKEN = os.environ.get("BOT_TOKEN")
+if not TOKEN:
+    logging.error("❌ BOT_TOKEN не найден в переменных окружения!")
+    sys.exit(1)
+
+WEBHOOK_URL = f"https://{os.environ.get('RAILWAY_STATIC_URL', 'xxxkg-production.up.railway.app')}{webhook_path(TOKEN)}"
 
 # --- Telegram bot ---
-application = Application.builder().token(TOKEN).build()
+# Updater не нужен: апдейты приходят через aiohttp и обрабатываются на том же event loop
+application = Application.builder().token(TOKEN).base_url(PTB_BASE_URL).base_file_url(PTB_BASE_FILE_URL).updater(None).request(PTBRequest()).rate_limiter(PTBRateLimiter()).build()
 
 # --- Хэндлеры ---
+@metrics.track_handler
+@profiling.trace_handler
 async def start(update: Update, context):
     await update.message.reply_text("Привет! Бот работает на Railway 🚀")
 
+@metrics.track_handler
+@profiling.trace_handler
 async def echo_text(update: Update, context):
     await update.message.reply_text(f"Ты написал: {update.message.text}")
 
+@metrics.track_handler
+@profiling.trace_handler
 async def handle_photo(update: Update, context):
     await update.message.reply_text("Фото получил! 📸")
 
@@ -38,35 +62,192 @@ application.add_handler(CommandHandler("start", start))
 application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, echo_text))
 application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
 
-# --- Flask маршруты ---
-@app.route("/")
-def home():
-    logging.info("=== ПОЛУЧЕН ЗАПРОС НА ГЛАВНУЮ СТРАНИЦУ ===")
-    return f"""
-    <h1>🎉 FLASK СЕРВЕР РАБОТАЕТ!</h1>
-    <p>Port: {PORT}</p>
-    <p>Python: {sys.version}</p>
-    """
-
-@app.route("/health")
-def health():
-    return "OK", 200
-
-@app.route(f"/{TOKEN}", methods=["POST"])
-def webhook():
+# Application инициализируется в фоне (см. on_startup); апдейты ждут конца инициализации
+initialized = asyncio.Event()
+initialize_task = None
+
+async def process_update(update):
+    await initialized.wait()
+    await application.process_update(update)
+
+# Апдейты одного чата обрабатываются по порядку, разные чаты - параллельно
+dispatcher = ChatDispatcher(process_update)
+
+# getUpdates/вебхук у процесса-лидера (создаётся в on_startup)
+poller = None
+
+# Файлы Web App: сжатие и ETag считаются один раз при запуске
+webapp_assets = load_webapp()
+
+# --- aiohttp маршруты ---
+routes = web.RouteTableDef()
+
+@routes.get("/")
+async def home(request):
+    """Отдаёт страницу Web App"""
+    return webapp_response(request, None)
+
+@routes.get("/health")
+async def health(request):
+    return web.Response(text="OK")
+
+@routes.get("/ready")
+async def ready(request):
+    """Готовность: 503 во время прогрева и при перегрузке (см. readiness.py)"""
+    reason = monitor.not_ready()
+    if reason:
+        return web.Response(text=reason, status=503)
+    return web.Response(text="OK")
+
+@routes.get("/metrics")
+async def metrics_endpoint(request):
+    """Метрики в формате Prometheus"""
+    return web.Response(text=metrics.render(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+@routes.get("/diagnostics")
+async def diagnostics_endpoint(request):
+    """Состояние исходящих вызовов Bot API и очередей апдейтов (JSON)"""
+    report = diagnostics(dispatcher=dispatcher, ingest=dispatcher.ingest, dedup=recent_updates, poller=poller,
+                         warmup=warmup.state, load=monitor)
+    return web.Response(body=codec.dumps(report), content_type="application/json")
+
+@routes.get("/debug/profile")
+async def debug_profile(request):
+    """Профиль процесса за ?seconds=N, нужен заголовок X-Profile-Token (см. profiling.py)"""
+    # Сэмплирование блокирует поток, поэтому не на event loop
+    body, status, content_type = await asyncio.get_running_loop().run_in_executor(
+        None, profiling.profile_response, request.headers, request.query)
+    return web.Response(body=body, status=status, headers={"Content-Type": content_type})
+
+@routes.get("/debug/traces")
+async def debug_traces(request):
+    """Время стадий последних апдейтов (TRACE_UPDATES=1), нужен X-Profile-Token"""
+    body, status, content_type = profiling.traces_response(request.headers, request.query)
+    return web.Response(body=body, status=status, headers={"Content-Type": content_type})
+
+@routes.route("*", "/debug/log_level")
+async def debug_log_level(request):
+    """Уровень логов процесса; POST ?level=DEBUG меняет его, нужен X-Profile-Token"""
+    body, status, content_type = profiling.log_level_response(request.headers, request.query, request.method)
+    return web.Response(body=body, status=status, headers={"Content-Type": content_type})
+
+@routes.post(webhook_path(TOKEN))
+@metrics.track_request
+@profiling.trace_webhook
+async def webhook(request):
     """Получение апдейтов от Telegram"""
-    update = Update.de_json(request.get_json(force=True), application.bot)
-    application.update_queue.put_nowait(update)
-    return "OK", 200
-
-# --- Установка вебхука при запуске ---
-try:
-    logging.info("=== УСТАНАВЛИВАЕМ ВЕБХУК ===")
-    asyncio.get_event_loop().run_until_complete(
-        application.bot.set_webhook(url=WEBHOOK_URL)
-    )
-except Exception as e:
-    logging.error(f"Ошибка при установке вебхука: {e}")
-
-# Gunicorn будет использовать app
-logging.info("=== Flask приложение загружено и готово к работе ===")
+    # Посторонние запросы отклоняются по заголовкам, до чтения тела
+    rejected = reject_webhook(request.headers)
+    if rejected:
+        return web.Response(text=rejected[0], status=rejected[1])
+    # Пока Application инициализируется, апдейты не копятся в очередях:
+    # 503 (как и /ready), Telegram повторит доставку позже
+    if not initialized.is_set():
+        return web.Response(text="Starting", status=503, headers={"Retry-After": str(RETRY_AFTER)})
+    body = await request.read()
+    try:
+        with metrics.STAGE_DECODE.time():
+            data = codec.loads(body)
+    except codec.DecodeError:
+        logging.error("❌ Некорректный JSON в webhook")
+        return web.Response(text="ERROR", status=400)
+
+    # Повторная доставка уже принятого апдейта - подтверждаем без обработки
+    update_id = data.get("update_id")
+    if update_id is not None and recent_updates.seen(update_id):
+        return web.Response(text="OK")
+
+    with metrics.STAGE_DE_JSON.time():
+        update = Update.de_json(data, application.bot)
+    if not update:
+        logging.error("❌ Не удалось создать Update объект")
+        return web.Response(text="ERROR", status=400)
+
+    # Обработчики выполняются на том же event loop, что и HTTP сервер
+    slot = inline_reply.new_slot()
+    try:
+        await dispatcher.dispatch(update, slot)
+    except Overloaded:
+        # При перегрузке отвечаем 503, Telegram повторит доставку позже
+        recent_updates.forget(update_id)
+        return web.Response(text="Overloaded", status=503, headers={"Retry-After": str(RETRY_AFTER)})
+    # INLINE_REPLIES=1: первый ответ обработчика уходит в теле ответа на вебхук
+    if slot is not None and slot.body:
+        return web.Response(body=slot.body, content_type="application/json")
+    return web.Response(text="OK")
+
+@routes.get("/{filename:.+}")
+async def webapp_file(request):
+    """Отдаёт файлы бандла Web App (WEBAPP_DIR)"""
+    return webapp_response(request, request.match_info["filename"])
+
+def webapp_response(request, filename):
+    asset = webapp_assets.get(filename)
+    if asset is None:
+        raise web.HTTPNotFound()
+    status, headers, body = asset.respond(request.headers)
+    return web.Response(body=body, status=status, headers=headers)
+
+# --- Жизненный цикл ---
+async def on_startup(app):
+    # Прогрев идёт в фоне: /health отвечает сразу, /ready - 503 до конца прогрева,
+    # а недоступный при старте Bot API не роняет процесс
+    metrics.watch_loop(asyncio.get_running_loop())
+    monitor.start(ingest=dispatcher.ingest, loop=asyncio.get_running_loop(), warm=warmup.is_ready)
+    dispatcher.start()
+    global initialize_task
+    initialize_task = asyncio.create_task(initialize_application())
+
+async def initialize_application():
+    """DNS, initialize() и соединения пула (warmup.py) с повторами, как в BotLoop"""
+    while True:
+        try:
+            await warmup.warm_up_application(application)
+            break
+        except Exception as e:
+            logging.error("❌ Не удалось инициализировать Application: %s", e)
+            await asyncio.sleep(INIT_RETRY_DELAY)
+    await application.start()
+    initialized.set()
+    logging.info("✅ Application инициализировано")
+    # При нескольких воркерах вебхук регистрирует только лидер; он же
+    # переходит на getUpdates, пока вебхук отстаёт (см. polling.py)
+    global poller
+    if leader_lock.acquire():
+        poller = UpdatePoller(TOKEN, deliver_polled_update, WEBHOOK_URL,
+                              allowed_updates_for(application), secret_token=WEBHOOK_SECRET).start()
+
+def deliver_polled_update(data):
+    """Апдейт из getUpdates - тот же путь, что и у вебхука (вызывается из потока поллера)"""
+    update_id = data.get("update_id")
+    if update_id is not None and recent_updates.seen(update_id):
+        return True
+    with metrics.STAGE_DE_JSON.time():
+        update = Update.de_json(data, application.bot)
+    if not dispatcher.submit(update):
+        recent_updates.forget(update_id)
+        return False
+    return True
+
+async def on_cleanup(app):
+    if initialize_task is not None:
+        initialize_task.cancel()
+    if poller is not None:
+        poller.stop()
+    await dispatcher.stop()
+    if application.running:
+        await application.stop()
+    await application.shutdown()
+
+def create_app():
+    app = web.Application()
+    app.add_routes(routes)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+# gunicorn bot_aiohttp:app --worker-class aiohttp.GunicornWebWorker
+app = create_app()
+
+if __name__ == "__main__":
+    web.run_app(app, host="0.0.0.0", port=PORT)
@@ -0,0 +1,204 @@
+import os
+import time
+import logging
+from http.client import responses
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from telegram.error import TelegramError
+from telegram.request import HTTPXRequest
+import codec
+import metrics
+import inline_reply
+from rate_limit import outbound_limiter, MAX_RETRIES
+from resilience import bot_api_breaker, timeout_for, retry_delay, CircuitOpenError, DEFAULT_TIMEOUT
+
+# Base URL of the Bot API server (point it at fake_bot_api.py for load tests)
+API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+# The same server for python-telegram-bot's ApplicationBuilder.base_url/base_file_url
+PTB_BASE_URL = f"{API_URL}/bot"
+PTB_BASE_FILE_URL = f"{API_URL}/file/bot"
+# Timeouts for direct Bot API calls (seconds); most methods have their own
+# read timeout, see resilience.METHOD_TIMEOUTS
+CONNECT_TIMEOUT = float(os.getenv("BOT_API_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = DEFAULT_TIMEOUT
+# Pool timeout of python-telegram-bot's HTTP client: how long a request waits for a free connection
+PTB_POOL_TIMEOUT = float(os.getenv("PTB_POOL_TIMEOUT", "5"))
+# How long python-telegram-bot keeps an idle connection (seconds); httpx closes them after 5
+PTB_KEEPALIVE_EXPIRY = float(os.getenv("PTB_KEEPALIVE_EXPIRY", "60"))
+# Number of keep-alive connections kept open to the Bot API
+POOL_SIZE = int(os.getenv("BOT_API_POOL_SIZE", "10"))
+# Connection pool size of python-telegram-bot's HTTP client
+PTB_POOL_SIZE = int(os.getenv("PTB_POOL_SIZE", "256"))
+
+logger = logging.getLogger(__name__)
+
+
+class BotApiError(Exception):
+    """The Bot API answered with ``ok: false`` or a non-JSON error page."""
+
+    def __init__(self, description, error_code=None, parameters=None):
+        super().__init__(description)
+        self.description = description
+        self.error_code = error_code
+        self.parameters = parameters or {}
+
+    @property
+    def retry_after(self):
+        return self.parameters.get("retry_after")
+
+
+class BotApiClient:
+    """Thread-safe client for direct Bot API calls.
+
+    One ``requests.Session`` is shared by all threads: its urllib3 pool keeps
+    up to ``pool_size`` keep-alive connections to the Bot API, so replies do not
+    pay for a new TCP/TLS handshake. Request bodies are serialized to JSON once
+    here, and every call has a connect timeout and its method's read timeout.
+    Calls addressed to a chat wait for the shared
+    :class:`rate_limit.OutboundLimiter` (or raise
+    :class:`rate_limit.RateLimited` when the slot is too far off), and 429
+    answers are retried after ``retry_after``. Idempotent methods are also retried after timeouts,
+    network errors and 5xx answers, and while the shared
+    :class:`resilience.CircuitBreaker` is open calls fail at once.
+    """
+
+    def __init__(self, token, base_url=API_URL, pool_size=POOL_SIZE,
+                 timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), limiter=outbound_limiter,
+                 max_retries=MAX_RETRIES, breaker=bot_api_breaker):
+        self.timeout = timeout
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.breaker = breaker
+        self._url = f"{base_url}/bot{token}/"
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._session.headers["Content-Type"] = "application/json"
+
+    def call(self, method, params=None, timeout=None):
+        """Call a Bot API method and return its ``result``; raises BotApiError."""
+        params = params or {}
+        chat_id = params.get("chat_id")
+        body = codec.dumps(params)
+        timeout = timeout or (self.timeout[0], timeout_for(method, self.timeout[1]))
+        for attempt in range(self.max_retries + 1):
+            if chat_id is not None and self.limiter is not None:
+                self.limiter.acquire(chat_id)
+            if attempt == 0:
+                # Goes out in the webhook response instead (INLINE_REPLIES=1)
+                inlined = inline_reply.capture(method, params)
+                if inlined is not None:
+                    return inlined
+            try:
+                return self._post(method, body, timeout)
+            except BotApiError as e:
+                if e.retry_after is None or attempt >= self.max_retries:
+                    raise
+                if self.limiter is not None:
+                    self.limiter.pause(e.retry_after, chat_id)
+                if chat_id is None or self.limiter is None:
+                    time.sleep(e.retry_after)
+
+    def _post(self, method, body, timeout):
+        attempt = 0
+        while True:
+            if self.breaker is not None and not self.breaker.allow():
+                metrics.observe_outbound(method, "circuit_open", 0)
+                raise BotApiError(str(CircuitOpenError(self.breaker)))
+            try:
+                result = self._post_once(method, body, timeout)
+            except requests.RequestException as e:
+                error = e
+            except BotApiError as e:
+                if not isinstance(e.error_code, int) or e.error_code < 500:
+                    self._record(True)
+                    raise
+                error = e
+            else:
+                self._record(True)
+                return result
+            self._record(False)
+            delay = retry_delay(method, attempt)
+            if delay is None:
+                raise error
+            logger.warning("%s не удался (%s), повтор через %.2f с", method, error, delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def _record(self, ok):
+        if self.breaker is not None:
+            if ok:
+                self.breaker.success()
+            else:
+                self.breaker.failure()
+
+    def _post_once(self, method, body, timeout):
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = self._session.post(self._url + method, data=body, timeout=timeout)
+            status = response.status_code
+        finally:
+            metrics.observe_outbound(method, status, time.perf_counter() - start)
+        try:
+            payload = codec.loads(response.content)
+        except codec.DecodeError:
+            raise BotApiError(response.text, response.status_code) from None
+        if not payload.get("ok"):
+            raise BotApiError(payload.get("description", response.text),
+                              payload.get("error_code", response.status_code),
+                              payload.get("parameters"))
+        return payload["result"]
+
+    def send_message(self, chat_id, text, **params):
+        return self.call("sendMessage", {"chat_id": chat_id, "text": text, **params})
+
+    def set_webhook(self, url, **params):
+        return self.call("setWebhook", {"url": url, **params})
+
+    def get_webhook_info(self):
+        return self.call("getWebhookInfo")
+
+    def delete_webhook(self, **params):
+        return self.call("deleteWebhook", params)
+
+    def close(self):
+        self._session.close()
+
+
+class PTBRequest(HTTPXRequest):
+    """python-telegram-bot HTTP client that decodes responses with :mod:`codec`.
+
+    Its timeouts are the direct client's instead of the library defaults; the
+    per-method read timeouts are filled in by :class:`rate_limit.PTBRateLimiter`.
+    Idle connections are kept for :data:`PTB_KEEPALIVE_EXPIRY` seconds, so the
+    ones opened at warm-up (see warmup.py) are still there for the first updates.
+    """
+
+    def __init__(self, connection_pool_size=PTB_POOL_SIZE, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, pool_timeout=PTB_POOL_TIMEOUT,
+                 keepalive_expiry=PTB_KEEPALIVE_EXPIRY, **kwargs):
+        limits = httpx.Limits(max_connections=connection_pool_size,
+                              max_keepalive_connections=connection_pool_size,
+                              keepalive_expiry=keepalive_expiry)
+        kwargs["httpx_kwargs"] = {"limits": limits, **(kwargs.get("httpx_kwargs") or {})}
+        super().__init__(connection_pool_size=connection_pool_size, connect_timeout=connect_timeout,
+                         read_timeout=read_timeout, pool_timeout=pool_timeout, **kwargs)
+
+    async def do_request(self, *args, **kwargs):
+        code, payload = await super().do_request(*args, **kwargs)
+        if code >= 500 and not payload.lstrip().startswith(b"{"):
+            # A proxy's error page: answer as the Bot API would, so it becomes a
+            # NetworkError (a failure for the circuit breaker) instead of a parse error
+            payload = codec.dumps({"ok": False, "error_code": code,
+                                   "description": responses.get(code, "Server Error")})
+        return code, payload
+
+    @staticmethod
+    def parse_json_payload(payload):
+        try:
+            return codec.loads(payload)
+        except codec.DecodeError as exc:
+            raise TelegramError("Invalid server response") from exc
@@ -0,0 +1,100 @@
+import os
+import logging
+import asyncio
+import threading
+from dispatcher import ChatDispatcher
+from warmup import warm_up_application
+import metrics
+
+# Delay between attempts to initialize the Application (seconds)
+INIT_RETRY_DELAY = float(os.getenv("BOT_INIT_RETRY_DELAY", "5"))
+
+logger = logging.getLogger(__name__)
+
+
+class BotLoop:
+    """Runs a python-telegram-bot Application on one long-lived event loop.
+
+    The loop lives in a daemon thread owned by the process. The Application is
+    initialized and warmed up on it exactly once (see warmup.py), so its HTTP
+    connection pool is reused by all updates. Web server threads hand updates
+    over with :meth:`submit`, which only pushes onto a :class:`ChatDispatcher`
+    lane; updates of one chat are processed in order, different chats in
+    parallel, and admission is bounded by the dispatcher's
+    :class:`IngestStage`.
+    """
+
+    def __init__(self, application, dispatcher=None):
+        self.application = application
+        self.dispatcher = dispatcher or ChatDispatcher(self._process)
+        self.ingest = self.dispatcher.ingest
+        self.loop = None
+        self._thread = None
+        self._initialized = None
+        self._started = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def start(self, timeout=10):
+        """Start the background loop (idempotent) and wait until it accepts updates."""
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="bot-loop", daemon=True)
+                self._thread.start()
+        self._started.wait(timeout)
+        return self
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._bootstrap())
+        self.loop.run_forever()
+
+    async def _bootstrap(self):
+        self._initialized = asyncio.Event()
+        metrics.watch_loop(self.loop)
+        self.dispatcher.start()
+        asyncio.create_task(self._initialize_application())
+        self._started.set()
+
+    async def _initialize_application(self):
+        """Initialize and warm up the Application, retrying until the Bot API is reachable."""
+        while True:
+            try:
+                await warm_up_application(self.application)
+                break
+            except Exception as e:
+                logger.error("Не удалось инициализировать Application: %s", e)
+                await asyncio.sleep(INIT_RETRY_DELAY)
+        self._initialized.set()
+        logger.info("Application инициализирован на общем event loop")
+
+    async def _process(self, update):
+        await self._initialized.wait()
+        await self.application.process_update(update)
+
+    def submit(self, update, slot=None):
+        """Queue an update for processing. Thread-safe and non-blocking.
+
+        Returns False without queueing when the dispatcher is full. ``slot``
+        is an optional :class:`inline_reply.InlineSlot` for the reply.
+        """
+        return self.dispatcher.submit(update, slot)
+
+    def run_coroutine(self, coro):
+        """Schedule a coroutine on the bot loop; returns a concurrent future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self, timeout=10):
+        """Shut down the Application and stop the loop."""
+        if self._thread is None or self.loop is None:
+            return
+
+        async def shutdown():
+            await self.dispatcher.stop()
+            await self.application.shutdown()
+
+        try:
+            self.run_coroutine(shutdown()).result(timeout)
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join(timeout)
@@ -0,0 +1,79 @@
+import os
+import json
+import time
+
+# Force a JSON backend: "orjson", "msgspec" or "json"; by default the fastest installed one
+JSON_CODEC = os.getenv("JSON_CODEC", "")
+# How many bytes of a payload end up in log lines
+LOG_PREVIEW_BYTES = int(os.getenv("LOG_PREVIEW_BYTES", "200"))
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def _select_backend(name):
+    if name in ("", "orjson"):
+        try:
+            import orjson
+            return "orjson", orjson.loads, orjson.dumps, ValueError
+        except ImportError:
+            if name:
+                raise
+    if name in ("", "msgspec"):
+        try:
+            import msgspec
+            return "msgspec", msgspec.json.decode, msgspec.json.encode, (ValueError, msgspec.DecodeError)
+        except ImportError:
+            if name:
+                raise
+    return "json", json.loads, _stdlib_dumps, ValueError
+
+
+# loads(bytes | str) -> object, dumps(object) -> UTF-8 bytes; loads raises DecodeError
+BACKEND, _loads, dumps, DecodeError = _select_backend(JSON_CODEC)
+
+# Called as observer(result, seconds) after each loads(), see add_decode_observer()
+_decode_observers = []
+
+
+def loads(data):
+    """Decode JSON from bytes or str; raises :data:`DecodeError`."""
+    if not _decode_observers:
+        return _loads(data)
+    start = time.perf_counter()
+    result = _loads(data)
+    seconds = time.perf_counter() - start
+    for observer in _decode_observers:
+        observer(result, seconds)
+    return result
+
+
+def add_decode_observer(observer):
+    """Call ``observer(result, seconds)`` after every successful :func:`loads`.
+
+    This is how update tracing (profiling.py) sees decoded webhook bodies;
+    with no observer registered :func:`loads` only calls the backend.
+    """
+    _decode_observers.append(observer)
+
+
+class Preview:
+    """Lazy, truncated view of a raw payload for log messages.
+
+    Pass it as a ``%s`` argument: nothing is decoded unless the record is
+    actually emitted, and never more than ``limit`` bytes.
+    """
+
+    __slots__ = ("raw", "limit")
+
+    def __init__(self, raw, limit=LOG_PREVIEW_BYTES):
+        self.raw = raw
+        self.limit = limit
+
+    def __str__(self):
+        raw = self.raw
+        if isinstance(raw, str):
+            raw = raw.encode()
+        text = raw[:self.limit].decode("utf-8", "replace")
+        return text + "..." if len(raw) > self.limit else text
@@ -1,12 +1,10 @@
 import os
 import logging
 from flask import Flask, request
+from log_setup import setup_logging, SAMPLE_HEALTH
 
-# Set up logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Set up logging (written off-thread, see log_setup.py)
+setup_logging('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
 app = Flask(__name__)
 
@@ -17,7 +15,7 @@ logging.info(f"=== PORT из окружения: {os.environ.get('PORT', 'НЕ 
 # Добавляем простой health check
 @app.before_request
 def log_request():
-    logging.info(f"=== ПОЛУЧЕН ЗАПРОС: {request.method} {request.path} ===")
+    logging.info("=== ПОЛУЧЕН ЗАПРОС: %s %s ===", request.method, request.path)
 
 @app.route('/')
 def debug_info():
@@ -42,7 +40,7 @@ def debug_info():
 
 @app.route('/health')
 def health():
-    logging.info("=== ПОЛУЧЕН ЗАПРОС НА /health ===")
+    logging.info("=== ПОЛУЧЕН ЗАПРОС НА /health ===", extra=SAMPLE_HEALTH)
     return 'OK'
 
 if __name__ == '__main__':
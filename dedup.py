@@ -0,0 +1,70 @@
+import os
+import threading
+from array import array
+
+# How many recent update_ids are remembered
+DEDUP_CAPACITY = int(os.getenv("DEDUP_CAPACITY", "4096"))
+
+
+class UpdateDeduplicator:
+    """Remembers recently seen ``update_id`` values to drop redeliveries.
+
+    Ids live in a fixed-size ring buffer (a compact ``array`` of 64-bit ints)
+    mirrored by a dict of id -> slot for O(1) lookups; once the ring is full
+    the oldest id is evicted. An id re-added after :meth:`forget` owns only
+    its new slot, so overwriting the stale one does not evict it early.
+    Thread-safe.
+    """
+
+    def __init__(self, capacity=DEDUP_CAPACITY):
+        self.capacity = max(1, capacity)
+        self.hits = 0
+        self.misses = 0
+        self._ring = array("q", [0] * self.capacity)
+        self._seen = {}
+        self._next = 0
+        self._filled = False
+        self._lock = threading.Lock()
+
+    def seen(self, update_id):
+        """Return True if the id was seen before, otherwise remember it."""
+        # Checked up front: array("q") would raise only after the dict changed
+        if not isinstance(update_id, int):
+            raise TypeError(
+                f"update_id must be int, not {type(update_id).__name__}")
+        with self._lock:
+            if update_id in self._seen:
+                self.hits += 1
+                return True
+            self.misses += 1
+            if self._filled:
+                evicted = self._ring[self._next]
+                if self._seen.get(evicted) == self._next:
+                    del self._seen[evicted]
+            self._ring[self._next] = update_id
+            self._seen[update_id] = self._next
+            self._next += 1
+            if self._next == self.capacity:
+                self._next = 0
+                self._filled = True
+            return False
+
+    def forget(self, update_id):
+        """Drop an id again, e.g. when its update was rejected.
+
+        Telegram redelivers such an update, and it must not count as a repeat.
+        """
+        with self._lock:
+            self._seen.pop(update_id, None)
+
+    def stats(self):
+        return {
+            "capacity": self.capacity,
+            "size": len(self._seen),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+# One per process: the webhook and getUpdates paths drop each other's repeats
+recent_updates = UpdateDeduplicator()
@@ -0,0 +1,140 @@
+import os
+import time
+import logging
+import asyncio
+import threading
+from ingest import IngestStage
+import metrics
+import inline_reply
+
+# Number of worker lanes; updates of one chat always land on the same lane
+DISPATCH_SHARDS = int(os.getenv("DISPATCH_SHARDS", "16"))
+# Maximum number of queued updates per lane
+DISPATCH_LANE_DEPTH = int(os.getenv("DISPATCH_LANE_DEPTH", "100"))
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """Raised when an update cannot be queued because the dispatcher is full."""
+
+
+class ChatDispatcher:
+    """Shards updates by chat onto a fixed number of async worker lanes.
+
+    Each lane is served by a single worker task, so updates from one chat are
+    processed strictly in the order they arrived, while different chats run
+    in parallel on different lanes. Admission is bounded twice: by the shared
+    :class:`IngestStage` and by the per-lane queue depth.
+    """
+
+    def __init__(self, process, shards=DISPATCH_SHARDS, lane_depth=DISPATCH_LANE_DEPTH, ingest=None):
+        self.process = process
+        self.shards = max(1, shards)
+        self.lane_depth = max(1, lane_depth)
+        self.ingest = ingest or IngestStage()
+        self.loop = None
+        self.rejected = 0
+        self._lanes = []
+        self._workers = []
+        self._pending = [0] * self.shards
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the lane workers; must be called from the event loop."""
+        self.loop = asyncio.get_running_loop()
+        self._lanes = [asyncio.Queue() for _ in range(self.shards)]
+        self._workers = [
+            asyncio.create_task(self._run_lane(i), name=f"dispatch-lane-{i}")
+            for i in range(self.shards)
+        ]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    @staticmethod
+    def shard_key(update):
+        chat = update.effective_chat
+        if chat is not None:
+            return chat.id
+        user = update.effective_user
+        if user is not None:
+            return user.id
+        return update.update_id
+
+    def lane_of(self, update):
+        return hash(self.shard_key(update)) % self.shards
+
+    def _reserve(self, lane):
+        if not self.ingest.try_acquire():
+            return False
+        with self._lock:
+            if self._pending[lane] >= self.lane_depth:
+                self.rejected += 1
+                full = True
+            else:
+                self._pending[lane] += 1
+                full = False
+        if full:
+            self.ingest.release()
+            return False
+        return True
+
+    def _release(self, lane):
+        with self._lock:
+            self._pending[lane] -= 1
+        self.ingest.release()
+
+    def submit(self, update, slot=None):
+        """Queue an update without waiting for it. Thread-safe; False if full.
+
+        ``slot`` is an :class:`inline_reply.InlineSlot` the handler's first
+        call may be answered through.
+        """
+        lane = self.lane_of(update)
+        if not self._reserve(lane):
+            return False
+        self.loop.call_soon_threadsafe(self._lanes[lane].put_nowait,
+                                       (update, None, time.perf_counter(), slot))
+        return True
+
+    async def dispatch(self, update, slot=None):
+        """Queue an update from the loop and wait until it has been processed."""
+        lane = self.lane_of(update)
+        if not self._reserve(lane):
+            raise Overloaded(f"lane {lane} is full")
+        future = self.loop.create_future()
+        self._lanes[lane].put_nowait((update, future, time.perf_counter(), slot))
+        return await future
+
+    async def _run_lane(self, index):
+        lane = self._lanes[index]
+        while True:
+            update, future, enqueued, slot = await lane.get()
+            started = time.perf_counter()
+            metrics.STAGE_QUEUE_WAIT.observe(started - enqueued)
+            try:
+                with inline_reply.active(slot):
+                    result = await self.process(update)
+            except Exception as e:
+                logger.error("Ошибка при обработке апдейта: %s", e, exc_info=True)
+                if future is not None and not future.done():
+                    future.set_exception(e)
+            else:
+                if future is not None and not future.done():
+                    future.set_result(result)
+            finally:
+                metrics.STAGE_HANDLER.observe(time.perf_counter() - started)
+                self._release(index)
+
+    def stats(self):
+        return {
+            "shards": self.shards,
+            "lane_depth": self.lane_depth,
+            "pending": sum(self._pending),
+            "busiest_lane": max(self._pending),
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""Локальная замена Telegram Bot API для нагрузочных тестов.
+
+    python fake_bot_api.py [--port 8081] [--latency 0.05] [--jitter 0.02] [--rate-429 0.01] [--rate-5xx 0.01]
+                           [--handshake 0.1]
+
+Сервер отвечает на /bot<token>/<method> как api.telegram.org: sendMessage,
+setWebhook, getWebhookInfo, deleteWebhook, getUpdates и getMe. Задержка
+ответа, доли ответов 429 и 502 и цена нового соединения (--handshake -
+задержка первого запроса в соединении, как TCP+TLS до api.telegram.org)
+настраиваются. Запустите бота с
+TELEGRAM_API_URL=http://127.0.0.1:<port>, и он будет ходить сюда.
+
+Служебные маршруты:
+    GET  /fake/stats    - счётчики вызовов и текущие настройки вебхука
+    POST /fake/updates  - положить апдейты (JSON список) в очередь getUpdates
+    POST /fake/reset    - сбросить счётчики, вебхук и очередь апдейтов
+    POST /fake/outage?seconds=N - N секунд отвечать 502 на все методы
+    POST /fake/webhook_error?message=... - ошибка доставки в getWebhookInfo
+"""
+import time
+import random
+import asyncio
+import argparse
+import itertools
+from collections import Counter
+from aiohttp import web
+import codec
+
+BOT_USER = {
+    "id": 123456, "is_bot": True, "first_name": "Fake", "username": "fake_bot",
+    "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False,
+}
+
+
+def _ok(result):
+    return web.Response(body=codec.dumps({"ok": True, "result": result}), content_type="application/json")
+
+
+def _error(code, description, **parameters):
+    payload = {"ok": False, "error_code": code, "description": description}
+    if parameters:
+        payload["parameters"] = parameters
+    return web.Response(body=codec.dumps(payload), status=code, content_type="application/json")
+
+
+class FakeBotApi:
+    """Bot API stand-in with configurable latency and 429/502 injection."""
+
+    def __init__(self, latency=0.0, jitter=0.0, rate_429=0.0, retry_after=1, seed=None, rate_5xx=0.0,
+                 handshake=0.0):
+        self.latency = latency
+        self.handshake = handshake
+        self.connections = set()
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.injected_429 = 0
+        self.injected_5xx = 0
+        self.outage_until = 0.0
+        self.webhook_error = None
+        self.connections.clear()
+        self.webhook = {}
+        self.updates = []
+        self._new_updates = asyncio.Event()
+        self._message_ids = itertools.count(1)
+        self.methods = {
+            "getMe": self.get_me,
+            "sendMessage": self.send_message,
+            "setWebhook": self.set_webhook,
+            "deleteWebhook": self.delete_webhook,
+            "getWebhookInfo": self.get_webhook_info,
+            "getUpdates": self.get_updates,
+        }
+
+    def make_app(self):
+        app = web.Application(client_max_size=50 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        app.router.add_get("/fake/stats", self.stats)
+        app.router.add_post("/fake/updates", self.push_updates)
+        app.router.add_post("/fake/reset", self.reset)
+        app.router.add_post("/fake/outage", self.outage)
+        app.router.add_post("/fake/webhook_error", self.report_webhook_error)
+        return app
+
+    @staticmethod
+    async def _params(request):
+        params = dict(request.query)
+        if request.can_read_body:
+            if request.content_type == "application/json":
+                body = await request.read()
+                if body:
+                    params.update(codec.loads(body))
+            else:
+                params.update(await request.post())
+        # PTB шлёт составные поля (allowed_updates, reply_markup) JSON-строками
+        for key, value in params.items():
+            if isinstance(value, str) and value[:1] in "[{":
+                try:
+                    params[key] = codec.loads(value)
+                except codec.DecodeError:
+                    pass
+        return params
+
+    async def handle(self, request):
+        if self.handshake:
+            # Запрос "доходит" только после установки соединения
+            peer = request.transport.get_extra_info("peername")
+            if peer not in self.connections:
+                self.connections.add(peer)
+                await asyncio.sleep(self.handshake)
+        method = request.match_info["method"]
+        handler = self.methods.get(method)
+        self.calls[method] += 1
+        if handler is None:
+            return _error(404, "Not Found: method not found")
+        params = await self._params(request)
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+        if time.monotonic() < self.outage_until or (self.rate_5xx and self.random.random() < self.rate_5xx):
+            self.injected_5xx += 1
+            return web.Response(text="Bad Gateway", status=502)
+        if self.rate_429 and method != "getUpdates" and self.random.random() < self.rate_429:
+            self.injected_429 += 1
+            return _error(429, f"Too Many Requests: retry after {self.retry_after}",
+                          retry_after=self.retry_after)
+        return await handler(params)
+
+    async def get_me(self, params):
+        return _ok(BOT_USER)
+
+    async def send_message(self, params):
+        if "chat_id" not in params or "text" not in params:
+            return _error(400, "Bad Request: message text is empty")
+        chat_id = params["chat_id"]
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+        return _ok({
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if isinstance(chat_id, int) and chat_id > 0 else "group"},
+            "from": BOT_USER,
+            "text": params["text"],
+        })
+
+    async def set_webhook(self, params):
+        # Как и настоящий Bot API: без allowed_updates остаётся прежний список
+        allowed_updates = params.get("allowed_updates", self.webhook.get("allowed_updates"))
+        self.webhook = {
+            "url": params.get("url", ""),
+            "allowed_updates": allowed_updates,
+            "max_connections": params.get("max_connections"),
+            "has_secret_token": bool(params.get("secret_token")),
+            "drop_pending_updates": params.get("drop_pending_updates"),
+        }
+        return _ok(True)
+
+    async def delete_webhook(self, params):
+        self.webhook = {}
+        if params.get("drop_pending_updates") in (True, "true", "True"):
+            self.updates.clear()
+        return _ok(True)
+
+    async def get_webhook_info(self, params):
+        info = {
+            "url": self.webhook.get("url", ""),
+            "has_custom_certificate": False,
+            "pending_update_count": len(self.updates),
+        }
+        if self.webhook.get("max_connections") is not None:
+            info["max_connections"] = int(self.webhook["max_connections"])
+        if self.webhook.get("allowed_updates") is not None:
+            info["allowed_updates"] = self.webhook["allowed_updates"]
+        if self.webhook_error is not None:
+            info["last_error_date"], info["last_error_message"] = self.webhook_error
+        return _ok(info)
+
+    async def get_updates(self, params):
+        if self.webhook.get("url"):
+            return _error(409, "Conflict: can't use getUpdates method while webhook is active; "
+                               "use deleteWebhook to delete the webhook first")
+        offset = int(params.get("offset") or 0)
+        limit = min(int(params.get("limit") or 100), 100)
+        timeout = float(params.get("timeout") or 0)
+        # offset подтверждает всё, что было до него
+        if offset:
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return _ok(self.updates[:limit])
+
+    async def push_updates(self, request):
+        updates = codec.loads(await request.read())
+        self.updates.extend(updates if isinstance(updates, list) else [updates])
+        self._new_updates.set()
+        return _ok(len(self.updates))
+
+    async def stats(self, request):
+        return _ok({
+            "calls": dict(self.calls),
+            "injected_429": self.injected_429,
+            "injected_5xx": self.injected_5xx,
+            "connections": len(self.connections),
+            "webhook": self.webhook,
+            "pending_updates": len(self.updates),
+        })
+
+    async def reset(self, request):
+        self.calls.clear()
+        self.injected_429 = 0
+        self.injected_5xx = 0
+        self.outage_until = 0.0
+        self.webhook_error = None
+        self.webhook = {}
+        self.updates.clear()
+        return _ok(True)
+
+    async def outage(self, request):
+        self.outage_until = time.monotonic() + float(request.query.get("seconds", "10"))
+        return _ok(True)
+
+    def set_webhook_error(self, message):
+        """Как будто Telegram только что не смог доставить апдейт на вебхук"""
+        self.webhook_error = (int(time.time()) + 1, message)
+
+    async def report_webhook_error(self, request):
+        self.set_webhook_error(request.query.get("message", "Connection refused"))
+        return _ok(True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная замена Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, с")
+    parser.add_argument("--jitter", type=float, default=0.0, help="разброс задержки, ± с")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="доля ответов 429 (0..1)")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429, с")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="доля ответов 502 (0..1)")
+    parser.add_argument("--handshake", type=float, default=0.0, help="задержка первого запроса соединения, с")
+    args = parser.parse_args()
+    fake = FakeBotApi(args.latency, args.jitter, args.rate_429, args.retry_after, rate_5xx=args.rate_5xx,
+                      handshake=args.handshake)
+    web.run_app(fake.make_app(), host=args.host, port=args.port, access_log=None, print=None)
+
+
+if __name__ == "__main__":
+    main()
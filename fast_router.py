@@ -0,0 +1,94 @@
+from telegram import Update
+
+
+class RawUpdate:
+    """Thin view over a decoded update dict.
+
+    Only the fields the fast path needs are read straight from the dict; the
+    full :class:`telegram.Update` object graph is built on first access to
+    :attr:`update`, i.e. only by handlers that actually ask for it.
+    """
+
+    __slots__ = ("data", "message", "_bot", "_update")
+
+    def __init__(self, data, bot=None):
+        self.data = data
+        self.message = data.get("message")
+        self._bot = bot
+        self._update = None
+
+    @property
+    def update_id(self):
+        return self.data.get("update_id")
+
+    @property
+    def chat_id(self):
+        return self.message["chat"]["id"]
+
+    @property
+    def text(self):
+        return self.message.get("text")
+
+    @property
+    def update(self):
+        if self._update is None:
+            self._update = Update.de_json(self.data, self._bot)
+        return self._update
+
+
+class FastRouter:
+    """Routes plain messages on the raw update dict without ``Update.de_json``.
+
+    Registered commands are matched first, then any other text, then photos.
+    :meth:`route` returns False when nothing matched, so the caller can fall
+    back to the regular python-telegram-bot path.
+    """
+
+    def __init__(self):
+        self._commands = {}
+        self._text = None
+        self._photo = None
+
+    def command(self, name):
+        def register(handler):
+            self._commands[name] = handler
+            return handler
+        return register
+
+    def text(self, handler):
+        self._text = handler
+        return handler
+
+    def photo(self, handler):
+        self._photo = handler
+        return handler
+
+    @staticmethod
+    def command_of(message):
+        """Return the bot command a message starts with (without '/' and @botname)."""
+        entities = message.get("entities")
+        if not entities:
+            return None
+        first = entities[0]
+        if first.get("type") != "bot_command" or first.get("offset") != 0:
+            return None
+        return message["text"][1:first["length"]].split("@", 1)[0]
+
+    def route(self, data, bot=None):
+        message = data.get("message")
+        if not message:
+            return False
+        if "text" in message:
+            handler = None
+            command = self.command_of(message)
+            if command is not None:
+                handler = self._commands.get(command)
+            handler = handler or self._text
+        elif "photo" in message:
+            handler = self._photo
+        else:
+            return False
+        if handler is None:
+            return False
+        handler(RawUpdate(data, bot))
+        return True
@@ -1,16 +1,35 @@
 #!/usr/bin/env python3
 import os
 import sys
+import math
+import time
 import logging
 import json
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
+from rate_limit import PTBRateLimiter, RateLimited
+import codec
+import metrics
+import inline_reply
+from bot_api import BotApiClient, BotApiError, PTBRequest, PTB_BASE_URL, PTB_BASE_FILE_URL
+from ingest import IngestStage, RETRY_AFTER
+from dedup import recent_updates
+import ops_routes
+from fast_router import FastRouter
+from bootstrap import run_once
+from leader import leader_lock
+from polling import UpdatePoller
+import warmup
+from readiness import monitor
+import profiling
+from webhook_auth import WEBHOOK_SECRET, webhook_path, reject as reject_webhook
+from webhook_registration import ensure_webhook, allowed_updates_for
+from log_setup import setup_logging, SAMPLE_WEBHOOK
 
-logging.basicConfig(
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Логи пишутся в отдельном потоке (см. log_setup.py)
+setup_logging('%(asctime)s - %(levelname)s - %(message)s')
 
 app = Flask(__name__)
 
@@ -20,25 +39,82 @@ if not TOKEN:
     logging.error("❌ BOT_TOKEN не найден в переменных окружения!")
     sys.exit(1)
 
-WEBHOOK_URL = f"https://{os.environ.get('RAILWAY_STATIC_URL', 'xxxkg-production.up.railway.app')}/{TOKEN}"
+WEBHOOK_URL = f"https://{os.environ.get('RAILWAY_STATIC_URL', 'xxxkg-production.up.railway.app')}{webhook_path(TOKEN)}"
+# Быстрый путь: простые апдейты разбираются прямо из dict, без Update.de_json
+FAST_PATH = os.environ.get("FAST_PATH", "0") == "1"
+# Потоков для обработки апдейтов из getUpdates (см. polling.py)
+POLL_THREADS = int(os.environ.get("POLL_THREADS", "8"))
 
-# Создаем Application БЕЗ инициализации
-application = Application.builder().token(TOKEN).build()
+# Application создаётся в bootstrap(), а не при импорте
+application = None
+# UpdatePoller лидера (в остальных воркерах None)
+poller = None
+
+# Общий клиент для прямых вызовов Bot API (keep-alive пул соединений)
+api = BotApiClient(TOKEN)
+
+# Обработчики быстрого пути (FAST_PATH=1)
+fast_router = FastRouter()
+
+@fast_router.command("start")
+@metrics.track_handler
+def fast_start(raw):
+    api.send_message(raw.chat_id, "Привет! Бот работает 🚀")
+    logging.info("✅ Отправлен ответ на /start", extra=SAMPLE_WEBHOOK)
+
+@fast_router.text
+@metrics.track_handler
+def fast_echo(raw):
+    api.send_message(raw.chat_id, f"Ты написал: {raw.text}")
+    logging.info("✅ Отправлен эхо ответ", extra=SAMPLE_WEBHOOK)
+
+@fast_router.photo
+@metrics.track_handler
+def fast_photo(raw):
+    api.send_message(raw.chat_id, "Фото получил! 📸")
+    logging.info("✅ Отправлен ответ на фото", extra=SAMPLE_WEBHOOK)
 
 # Обработчики бота
+@metrics.track_handler
+@profiling.trace_handler
 async def start(update: Update, context):
     await update.message.reply_text("Привет! Бот работает 🚀")
 
+@metrics.track_handler
+@profiling.trace_handler
 async def echo_text(update: Update, context):
     await update.message.reply_text(f"Ты написал: {update.message.text}")
 
+@metrics.track_handler
+@profiling.trace_handler
 async def handle_photo(update: Update, context):
     await update.message.reply_text("Фото получил! 📸")
 
-# Добавляем обработчики
-application.add_handler(CommandHandler("start", start))
-application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, echo_text))
-application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+@run_once
+def bootstrap():
+    """Создаёт Application (без инициализации) - один раз на процесс.
+
+    Вызывается хуком post_worker_init из gunicorn.conf.py или первым вебхуком.
+    """
+    global application, poller
+    application = Application.builder().token(TOKEN).base_url(PTB_BASE_URL).base_file_url(PTB_BASE_FILE_URL).request(PTBRequest()).rate_limiter(PTBRateLimiter()).build()
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, echo_text))
+    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    # DNS и соединения пула api открываются до первого апдейта; /ready ждёт конца прогрева
+    warmup.start_client_warmup(api)
+    monitor.start(ingest=ingest, warm=warmup.is_ready)
+    # Вебхук регистрирует только лидер; он же переходит на getUpdates, пока вебхук отстаёт
+    if leader_lock.acquire():
+        poller = UpdatePoller(TOKEN, deliver_polled_update, WEBHOOK_URL, allowed_updates_for(application),
+                              secret_token=WEBHOOK_SECRET).start()
+    return application
+
+# Ограничение числа одновременно обрабатываемых апдейтов
+ingest = IngestStage()
+
+# Апдейты из getUpdates обрабатываются параллельно, как вебхуки в потоках gunicorn
+poll_executor = ThreadPoolExecutor(max_workers=POLL_THREADS, thread_name_prefix="poll")
 
 @app.route("/")
 def home():
@@ -56,106 +132,161 @@ def home():
 
 @app.route("/health")
 def health():
-    logging.info("=== HEALTH CHECK ===")
+    """Проверка жизни: без логов и за постоянное время (готовность - /ready)"""
     return "OK", 200
 
-@app.route(f"/{TOKEN}", methods=["POST"])
+def ops_components():
+    """Части сервера для /diagnostics (см. ops_routes.py)"""
+    return {"ingest": ingest, "poller": poller}
+
+# /ready, /metrics, /diagnostics и /debug/*
+app.register_blueprint(ops_routes.blueprint(ops_components))
+
+@app.route(webhook_path(TOKEN), methods=["POST"])
+@metrics.track_request
+@profiling.trace_webhook
 def webhook():
     """Получение апдейтов от Telegram"""
+    # Посторонние запросы отклоняются по заголовкам, до чтения тела
+    rejected = reject_webhook(request.headers)
+    if rejected:
+        return rejected
+    # При перегрузке отвечаем 503, Telegram повторит доставку позже
+    if not ingest.try_acquire():
+        logging.warning("⚠️ Слишком много апдейтов в обработке, отвечаем 503")
+        return "Overloaded", 503, {"Retry-After": str(RETRY_AFTER)}
+    update_id = None
     try:
+        bootstrap()
         # Получаем JSON данные
-        json_data = request.get_json(force=True)
+        body = request.get_data()
+        with metrics.STAGE_DECODE.time():
+            json_data = codec.loads(body)
         if not json_data:
             logging.error("❌ Пустые данные в webhook")
             return "ERROR", 400
         
-        logging.info(f"📨 Получен webhook от Telegram")
+        logging.info("📨 Получен webhook от Telegram: %s", json_data.get("update_id"), extra=SAMPLE_WEBHOOK)
         
-        # Создаем Update объект
-        update = Update.de_json(json_data, application.bot)
-        if not update:
-            logging.error("❌ Не удалось создать Update объект")
-            return "ERROR", 400
+        # Повторная доставка уже обработанного апдейта - подтверждаем без обработки
+        update_id = json_data.get("update_id")
+        if update_id is not None and recent_updates.seen(update_id):
+            logging.info("🔁 Повторный апдейт %s, пропускаем", update_id)
+            return "OK", 200
         
-        # Простая обработка без async
-        if update.message:
-            if update.message.text == "/start":
-                # Отправляем ответ напрямую через bot API
-                import requests
-                url = f"https://api.telegram.org/bot{TOKEN}/sendMessage"
-                data = {
-                    "chat_id": update.message.chat.id,
-                    "text": "Привет! Бот работает 🚀"
-                }
-                requests.post(url, data=data)
-                logging.info("✅ Отправлен ответ на /start")
-            elif update.message.text:
-                # Эхо сообщение
-                import requests
-                url = f"https://api.telegram.org/bot{TOKEN}/sendMessage"
-                data = {
-                    "chat_id": update.message.chat.id,
-                    "text": f"Ты написал: {update.message.text}"
-                }
-                requests.post(url, data=data)
-                logging.info("✅ Отправлен эхо ответ")
-            elif update.message.photo:
-                # Ответ на фото
-                import requests
-                url = f"https://api.telegram.org/bot{TOKEN}/sendMessage"
-                data = {
-                    "chat_id": update.message.chat.id,
-                    "text": "Фото получил! 📸"
-                }
-                requests.post(url, data=data)
-                logging.info("✅ Отправлен ответ на фото")
+        # INLINE_REPLIES=1: первый ответ обработчика уходит в теле ответа на вебхук
+        with inline_reply.active(inline_reply.new_slot()) as slot:
+            if not handle_update(json_data):
+                return "ERROR", 400
         
-        logging.info("✅ Webhook обработан успешно")
+        logging.info("✅ Webhook обработан успешно", extra=SAMPLE_WEBHOOK)
+        if slot is not None and slot.body:
+            return slot.body, 200, inline_reply.JSON_HEADERS
         return "OK", 200
         
+    except RateLimited as e:
+        # Чат (или бот) упёрся в лимит Telegram: не держим поток gunicorn, Telegram повторит позже
+        logging.warning("⚠️ Лимит отправки, следующий слот через %.1f с, отвечаем 503", e.retry_after)
+        recent_updates.forget(update_id)
+        return "Rate limited", 503, {"Retry-After": str(max(RETRY_AFTER, math.ceil(e.retry_after)))}
     except Exception as e:
-        logging.error(f"❌ Ошибка обработки webhook: {e}")
-        import traceback
-        logging.error(f"❌ Traceback: {traceback.format_exc()}")
+        logging.error("❌ Ошибка обработки webhook: %s", e, exc_info=True)
+        if update_id is not None:
+            recent_updates.forget(update_id)
         return "ERROR", 500
+    finally:
+        ingest.release()
+
+def handle_update(json_data):
+    """Обработка апдейта (из вебхука или getUpdates); False, если апдейт некорректен"""
+    if FAST_PATH:
+        with metrics.STAGE_HANDLER.time():
+            routed = fast_router.route(json_data, application.bot)
+        if routed:
+            return True
+        # Быстрый путь не узнал апдейт - обычный путь через Update.de_json
+        metrics.FAST_PATH_FALLBACKS.inc()
+        logging.debug("Быстрый путь не разобрал апдейт %s, обрабатываем через de_json", json_data.get("update_id"))
+    
+    # Создаем Update объект
+    with metrics.STAGE_DE_JSON.time():
+        update = Update.de_json(json_data, application.bot)
+    if not update:
+        logging.error("❌ Не удалось создать Update объект")
+        return False
+    
+    # Простая обработка без async
+    started = time.perf_counter()
+    if update.message:
+        if update.message.text == "/start":
+            # Отправляем ответ напрямую через bot API
+            api.send_message(update.message.chat.id, "Привет! Бот работает 🚀")
+            logging.info("✅ Отправлен ответ на /start", extra=SAMPLE_WEBHOOK)
+        elif update.message.text:
+            # Эхо сообщение
+            api.send_message(update.message.chat.id, f"Ты написал: {update.message.text}")
+            logging.info("✅ Отправлен эхо ответ", extra=SAMPLE_WEBHOOK)
+        elif update.message.photo:
+            # Ответ на фото
+            api.send_message(update.message.chat.id, "Фото получил! 📸")
+            logging.info("✅ Отправлен ответ на фото", extra=SAMPLE_WEBHOOK)
+    metrics.STAGE_HANDLER.observe(time.perf_counter() - started)
+    return True
+
+def deliver_polled_update(data):
+    """Апдейт из getUpdates: те же IngestStage и дедупликация, что у вебхука; False, если мест нет"""
+    update_id = data.get("update_id")
+    if update_id is not None and recent_updates.seen(update_id):
+        return True
+    if not ingest.try_acquire():
+        recent_updates.forget(update_id)
+        return False
+    poll_executor.submit(process_polled_update, data)
+    return True
+
+def process_polled_update(data):
+    try:
+        while True:
+            try:
+                handle_update(data)
+                break
+            except RateLimited as e:
+                # Поток poll_executor, а не gunicorn: можно подождать слот
+                time.sleep(e.retry_after)
+    except Exception as e:
+        logging.error("❌ Ошибка обработки апдейта из getUpdates: %s", e, exc_info=True)
+    finally:
+        ingest.release()
 
 @app.route("/set_webhook")
 def set_webhook_route():
-    """Маршрут для установки вебхука"""
+    """Маршрут для установки вебхука (?force=1 - установить, даже если он не изменился)"""
     try:
-        import requests
-        url = f"https://api.telegram.org/bot{TOKEN}/setWebhook"
-        data = {"url": WEBHOOK_URL}
-        response = requests.post(url, data=data)
-        
-        if response.status_code == 200:
-            result = response.json()
-            logging.info(f"✅ Вебхук установлен: {WEBHOOK_URL}")
-            return f"✅ Вебхук установлен: {WEBHOOK_URL}<br>Ответ: {result}", 200
-        else:
-            logging.error(f"❌ Ошибка установки вебхука: {response.text}")
-            return f"❌ Ошибка: {response.text}", 500
+        allowed_updates = allowed_updates_for(bootstrap())
+        if not ensure_webhook(api, WEBHOOK_URL, allowed_updates, secret_token=WEBHOOK_SECRET,
+                              force=request.args.get("force") == "1"):
+            return f"✅ Вебхук уже установлен: {WEBHOOK_URL}", 200
+        return f"✅ Вебхук установлен: {WEBHOOK_URL}", 200
+    except BotApiError as e:
+        logging.error("❌ Ошибка установки вебхука: %s", e)
+        return f"❌ Ошибка: {e}", 500
     except Exception as e:
-        logging.error(f"❌ Исключение при установке вебхука: {e}")
+        logging.error("❌ Исключение при установке вебхука: %s", e)
         return f"❌ Исключение: {e}", 500
 
 @app.route("/webhook_info")
 def webhook_info():
     """Получить информацию о текущем webhook"""
     try:
-        import requests
-        url = f"https://api.telegram.org/bot{TOKEN}/getWebhookInfo"
-        response = requests.get(url)
-        
-        if response.status_code == 200:
-            result = response.json()
-            return f"<pre>{json.dumps(result, indent=2, ensure_ascii=False)}</pre>", 200
-        else:
-            return f"❌ Ошибка: {response.text}", 500
+        result = api.get_webhook_info()
+        return f"<pre>{json.dumps(result, indent=2, ensure_ascii=False)}</pre>", 200
+    except BotApiError as e:
+        return f"❌ Ошибка: {e}", 500
     except Exception as e:
         return f"❌ Исключение: {e}", 500
 
 logging.info("=== Flask приложение загружено и готово к работе ===")
 
 if __name__ == "__main__":
+    bootstrap()
     app.run(host="0.0.0.0", port=PORT, debug=False)
\ No newline at end of file
@@ -2,15 +2,30 @@
 import os
 import sys
 import logging
-import asyncio
 from flask import Flask, request
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
+from rate_limit import PTBRateLimiter
+import codec
+import metrics
+import inline_reply
+from bot_api import BotApiClient, BotApiError, PTBRequest, PTB_BASE_URL, PTB_BASE_FILE_URL
+from bot_loop import BotLoop
+from ingest import RETRY_AFTER
+from dedup import recent_updates
+import ops_routes
+from bootstrap import run_once
+from leader import leader_lock
+from polling import UpdatePoller
+import warmup
+from readiness import monitor
+import profiling
+from webhook_auth import WEBHOOK_SECRET, reject as reject_webhook
+from webhook_registration import ensure_webhook, allowed_updates_for
+from log_setup import setup_logging, SAMPLE_WEBHOOK
 
-logging.basicConfig(
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Логи пишутся в отдельном потоке (см. log_setup.py)
+setup_logging('%(asctime)s - %(levelname)s - %(message)s')
 
 app = Flask(__name__)
 
@@ -22,20 +37,61 @@ if not TOKEN:
 
 WEBHOOK_URL = f"https://{os.environ.get('RAILWAY_STATIC_URL', 'xxxkg-production.up.railway.app')}/webhook"
 
-application = Application.builder().token(TOKEN).build()
+# Application и его event loop создаются в bootstrap(), а не при импорте
+application = None
+bot_loop = None
+# UpdatePoller лидера (в остальных воркерах None)
+poller = None
 
+# Общий клиент для прямых вызовов Bot API (keep-alive пул соединений)
+api = BotApiClient(TOKEN)
+
+@metrics.track_handler
+@profiling.trace_handler
 async def start(update: Update, context):
     await update.message.reply_text("Привет! Бот работает 🚀")
 
+@metrics.track_handler
+@profiling.trace_handler
 async def echo_text(update: Update, context):
     await update.message.reply_text(f"Ты написал: {update.message.text}")
 
+@metrics.track_handler
+@profiling.trace_handler
 async def handle_photo(update: Update, context):
     await update.message.reply_text("Фото получил! 📸")
 
-application.add_handler(CommandHandler("start", start))
-application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, echo_text))
-application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+@run_once
+def bootstrap():
+    """Собирает Application и запускает его event loop - один раз на процесс.
+
+    Вызывается хуком post_worker_init из gunicorn.conf.py или первым вебхуком.
+    """
+    global application, bot_loop, poller
+    application = Application.builder().token(TOKEN).base_url(PTB_BASE_URL).base_file_url(PTB_BASE_FILE_URL).request(PTBRequest()).rate_limiter(PTBRateLimiter()).build()
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, echo_text))
+    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    # Application работает на общем фоновом event loop, очередь ограничена IngestStage
+    bot_loop = BotLoop(application).start()
+    monitor.start(ingest=bot_loop.ingest, loop=bot_loop.loop, warm=warmup.is_ready)
+    # Вебхук регистрирует только лидер; он же переходит на getUpdates, пока вебхук отстаёт
+    if leader_lock.acquire():
+        poller = UpdatePoller(TOKEN, deliver_polled_update, WEBHOOK_URL, allowed_updates_for(application),
+                              secret_token=WEBHOOK_SECRET).start()
+    return application
+
+def deliver_polled_update(data):
+    """Апдейт из getUpdates - тот же путь, что и у вебхука; False, если очередь полна"""
+    update_id = data.get("update_id")
+    if update_id is not None and recent_updates.seen(update_id):
+        return True
+    with metrics.STAGE_DE_JSON.time():
+        update = Update.de_json(data, application.bot)
+    if not bot_loop.submit(update):
+        recent_updates.forget(update_id)
+        return False
+    return True
 
 @app.route("/")
 def home():
@@ -55,35 +111,63 @@ def home():
 def health():
     return "OK", 200
 
+def ops_components():
+    """Части сервера для /diagnostics (см. ops_routes.py)"""
+    return {"dispatcher": bot_loop and bot_loop.dispatcher, "ingest": bot_loop and bot_loop.ingest, "poller": poller}
+
+# /ready, /metrics, /diagnostics и /debug/*
+app.register_blueprint(ops_routes.blueprint(ops_components))
+
 @app.route("/webhook", methods=["POST"])
+@metrics.track_request
+@profiling.trace_webhook
 def webhook():
     """Получение апдейтов от Telegram"""
+    # Посторонние запросы отклоняются по заголовкам, до чтения тела
+    rejected = reject_webhook(request.headers)
+    if rejected:
+        return rejected
+    update_id = None
     try:
-        update = Update.de_json(request.get_json(force=True), application.bot)
-        application.update_queue.put_nowait(update)
-        logging.info("✅ Получен апдейт от Telegram")
+        bootstrap()
+        body = request.get_data()
+        with metrics.STAGE_DECODE.time():
+            data = codec.loads(body)
+        # Повторная доставка уже принятого апдейта - подтверждаем без обработки
+        update_id = data.get("update_id")
+        if update_id is not None and recent_updates.seen(update_id):
+            return "OK", 200
+        with metrics.STAGE_DE_JSON.time():
+            update = Update.de_json(data, application.bot)
+        slot = inline_reply.new_slot()
+        if not bot_loop.submit(update, slot):
+            recent_updates.forget(update_id)
+            return "Overloaded", 503, {"Retry-After": str(RETRY_AFTER)}
+        logging.info("✅ Получен апдейт от Telegram: %s", update_id, extra=SAMPLE_WEBHOOK)
+        # INLINE_REPLIES=1: первый ответ обработчика уходит в теле ответа на вебхук
+        if slot is not None and slot.wait():
+            return slot.body, 200, inline_reply.JSON_HEADERS
         return "OK", 200
     except Exception as e:
-        logging.error(f"❌ Ошибка обработки вебхука: {e}")
+        logging.error("❌ Ошибка обработки вебхука: %s", e)
+        if update_id is not None:
+            recent_updates.forget(update_id)
         return "ERROR", 500
 
 @app.route("/set_webhook")
 def set_webhook_route():
-    """Маршрут для установки вебхука"""
+    """Маршрут для установки вебхука (?force=1 - установить, даже если он не изменился)"""
     try:
-        import requests
-        url = f"https://api.telegram.org/bot{TOKEN}/setWebhook"
-        data = {"url": WEBHOOK_URL}
-        response = requests.post(url, data=data)
-        
-        if response.status_code == 200:
-            logging.info(f"✅ Вебхук установлен: {WEBHOOK_URL}")
-            return f"✅ Вебхук установлен: {WEBHOOK_URL}", 200
-        else:
-            logging.error(f"❌ Ошибка установки вебхука: {response.text}")
-            return f"❌ Ошибка: {response.text}", 500
+        allowed_updates = allowed_updates_for(bootstrap())
+        if not ensure_webhook(api, WEBHOOK_URL, allowed_updates, secret_token=WEBHOOK_SECRET,
+                              force=request.args.get("force") == "1"):
+            return f"✅ Вебхук уже установлен: {WEBHOOK_URL}", 200
+        return f"✅ Вебхук установлен: {WEBHOOK_URL}", 200
+    except BotApiError as e:
+        logging.error("❌ Ошибка установки вебхука: %s", e)
+        return f"❌ Ошибка: {e}", 500
     except Exception as e:
-        logging.error(f"❌ Исключение при установке вебхука: {e}")
+        logging.error("❌ Исключение при установке вебхука: %s", e)
         return f"❌ Исключение: {e}", 500
 
 logging.info("=== Flask приложение загружено и готово к работе ===")
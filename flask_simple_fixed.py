@@ -5,13 +5,27 @@ import logging
 from flask import Flask, request
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
-import asyncio
+from rate_limit import PTBRateLimiter
+import codec
+import metrics
+import inline_reply
+from bot_api import BotApiClient, BotApiError, PTBRequest, PTB_BASE_URL, PTB_BASE_FILE_URL
+from bot_loop import BotLoop
+from dispatcher import Overloaded
+from ingest import RETRY_AFTER
+from dedup import recent_updates
+import ops_routes
+from bootstrap import run_once
+from webhook_auth import WEBHOOK_SECRET, webhook_path, reject as reject_webhook
+from webhook_registration import ensure_webhook, allowed_updates_for
+import warmup
+from readiness import monitor
+import profiling
+from log_setup import setup_logging, SAMPLE_WEBHOOK
 import json
 
-logging.basicConfig(
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Логи пишутся в отдельном потоке (см. log_setup.py)
+setup_logging('%(asctime)s - %(levelname)s - %(message)s')
 
 app = Flask(__name__)
 
@@ -21,47 +35,50 @@ if not TOKEN:
     logging.error("❌ BOT_TOKEN не найден в переменных окружения!")
     sys.exit(1)
 
-WEBHOOK_URL = f"https://{os.environ.get('RAILWAY_STATIC_URL', 'xxxkg-production.up.railway.app')}/{TOKEN}"
+WEBHOOK_URL = f"https://{os.environ.get('RAILWAY_STATIC_URL', 'xxxkg-production.up.railway.app')}{webhook_path(TOKEN)}"
+# Сколько секунд вебхук ждёт конца обработки апдейта
+UPDATE_TIMEOUT = float(os.environ.get("UPDATE_TIMEOUT", "30"))
 
-# Создаем Application
-application = Application.builder().token(TOKEN).build()
+# Application и его event loop создаются в bootstrap(), а не при импорте
+application = None
+bot_loop = None
+
+# Общий клиент для прямых вызовов Bot API (keep-alive пул соединений)
+api = BotApiClient(TOKEN)
 
 # Обработчики бота
+@metrics.track_handler
+@profiling.trace_handler
 async def start(update: Update, context):
     await update.message.reply_text("Привет! Бот работает 🚀")
 
+@metrics.track_handler
+@profiling.trace_handler
 async def echo_text(update: Update, context):
     await update.message.reply_text(f"Ты написал: {update.message.text}")
 
+@metrics.track_handler
+@profiling.trace_handler
 async def handle_photo(update: Update, context):
     await update.message.reply_text("Фото получил! 📸")
 
-# Добавляем обработчики
-application.add_handler(CommandHandler("start", start))
-application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, echo_text))
-application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-
-# Инициализация приложения
-async def init_app():
-    await application.initialize()
-    await application.start()
-
-# Обработка update
-async def process_telegram_update(update_data):
-    try:
-        update = Update.de_json(update_data, application.bot)
-        await application.process_update(update)
-        return True
-    except Exception as e:
-        logging.error(f"❌ Ошибка обработки update: {e}")
-        return False
-
-# Инициализируем приложение при запуске
-try:
-    asyncio.run(init_app())
-    logging.info("✅ Application инициализировано")
-except Exception as e:
-    logging.error(f"❌ Ошибка инициализации: {e}")
+@run_once
+def bootstrap():
+    """Создаёт Application и запускает его event loop - один раз на процесс.
+
+    Вызывается хуком post_worker_init из gunicorn.conf.py или первым вебхуком.
+    """
+    global application, bot_loop
+    application = Application.builder().token(TOKEN).base_url(PTB_BASE_URL).base_file_url(PTB_BASE_FILE_URL).request(PTBRequest()).rate_limiter(PTBRateLimiter()).build()
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, echo_text))
+    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    # Один event loop на процесс: соединения httpx привязаны к loop, в котором открыты,
+    # и с asyncio.run() на каждый запрос прогретый пул доставался закрытому loop.
+    # Инициализация и прогрев - в BotLoop, с повторами
+    bot_loop = BotLoop(application).start()
+    monitor.start(ingest=bot_loop.ingest, loop=bot_loop.loop, warm=warmup.is_ready)
+    return application
 
 @app.route("/")
 def home():
@@ -81,72 +98,98 @@ def home():
 def health():
     return "OK", 200
 
-@app.route(f"/{TOKEN}", methods=["POST"])
+def ops_components():
+    """Части сервера для /diagnostics (см. ops_routes.py)"""
+    return {"dispatcher": bot_loop and bot_loop.dispatcher, "ingest": bot_loop and bot_loop.ingest}
+
+# /ready, /metrics, /diagnostics и /debug/*
+app.register_blueprint(ops_routes.blueprint(ops_components))
+
+@app.route(webhook_path(TOKEN), methods=["POST"])
+@metrics.track_request
+@profiling.trace_webhook
 def webhook():
     """Получение апдейтов от Telegram"""
+    # Посторонние запросы отклоняются по заголовкам, до чтения тела
+    rejected = reject_webhook(request.headers)
+    if rejected:
+        return rejected
+    update_id = None
     try:
+        bootstrap()
         # Получаем JSON данные
-        json_data = request.get_json(force=True)
+        raw_body = request.get_data()
+        with metrics.STAGE_DECODE.time():
+            json_data = codec.loads(raw_body)
         if not json_data:
             logging.error("❌ Пустые данные в webhook")
             return "ERROR", 400
         
-        logging.info(f"📨 Получен webhook: {json.dumps(json_data, ensure_ascii=False)[:200]}...")
+        # Начало тела запроса; форматируется, только если запись реально пишется в лог
+        logging.info("📨 Получен webhook: %s", codec.Preview(raw_body), extra=SAMPLE_WEBHOOK)
+        
+        # Повторная доставка уже обработанного апдейта - подтверждаем без обработки
+        update_id = json_data.get("update_id")
+        if update_id is not None and recent_updates.seen(update_id):
+            logging.info("🔁 Повторный апдейт %s, пропускаем", update_id)
+            return "OK", 200
         
-        # Обрабатываем в новом event loop
-        success = asyncio.run(process_telegram_update(json_data))
+        with metrics.STAGE_DE_JSON.time():
+            update = Update.de_json(json_data, application.bot)
         
-        if success:
-            logging.info("✅ Update успешно обработан")
+        # Обрабатываем на общем event loop и отвечаем после обработки; при
+        # INLINE_REPLIES=1 первый ответ обработчика уходит в теле ответа на вебхук
+        slot = inline_reply.new_slot()
+        try:
+            bot_loop.run_coroutine(bot_loop.dispatcher.dispatch(update, slot)).result(UPDATE_TIMEOUT)
+        except Overloaded:
+            recent_updates.forget(update_id)
+            return "Overloaded", 503, {"Retry-After": str(RETRY_AFTER)}
+        except TimeoutError:
+            # Апдейт ещё обрабатывается и будет обработан - повторная доставка не нужна
+            logging.warning("⚠️ Апдейт %s обрабатывается дольше %s с", update_id, UPDATE_TIMEOUT)
             return "OK", 200
-        else:
-            logging.error("❌ Ошибка обработки update")
-            return "ERROR", 500
+        
+        logging.info("✅ Update успешно обработан", extra=SAMPLE_WEBHOOK)
+        if slot is not None and slot.body:
+            return slot.body, 200, inline_reply.JSON_HEADERS
+        return "OK", 200
             
     except Exception as e:
-        logging.error(f"❌ Критическая ошибка в webhook: {e}")
-        import traceback
-        logging.error(f"❌ Traceback: {traceback.format_exc()}")
+        logging.error("❌ Ошибка обработки update: %s", e, exc_info=True)
+        if update_id is not None:
+            recent_updates.forget(update_id)
         return "ERROR", 500
 
 @app.route("/set_webhook")
 def set_webhook_route():
-    """Маршрут для установки вебхука"""
+    """Маршрут для установки вебхука (?force=1 - установить, даже если он не изменился)"""
     try:
-        import requests
-        url = f"https://api.telegram.org/bot{TOKEN}/setWebhook"
-        data = {"url": WEBHOOK_URL}
-        response = requests.post(url, data=data)
-        
-        if response.status_code == 200:
-            result = response.json()
-            logging.info(f"✅ Вебхук установлен: {WEBHOOK_URL}")
-            logging.info(f"📋 Ответ Telegram: {result}")
-            return f"✅ Вебхук установлен: {WEBHOOK_URL}<br>Ответ: {result}", 200
-        else:
-            logging.error(f"❌ Ошибка установки вебхука: {response.text}")
-            return f"❌ Ошибка: {response.text}", 500
+        allowed_updates = allowed_updates_for(bootstrap())
+        if not ensure_webhook(api, WEBHOOK_URL, allowed_updates, secret_token=WEBHOOK_SECRET,
+                              force=request.args.get("force") == "1"):
+            return f"✅ Вебхук уже установлен: {WEBHOOK_URL}", 200
+        return f"✅ Вебхук установлен: {WEBHOOK_URL}", 200
+    except BotApiError as e:
+        logging.error("❌ Ошибка установки вебхука: %s", e)
+        return f"❌ Ошибка: {e}", 500
     except Exception as e:
-        logging.error(f"❌ Исключение при установке вебхука: {e}")
+        logging.error("❌ Исключение при установке вебхука: %s", e)
         return f"❌ Исключение: {e}", 500
 
 @app.route("/webhook_info")
 def webhook_info():
     """Получить информацию о текущем webhook"""
     try:
-        import requests
-        url = f"https://api.telegram.org/bot{TOKEN}/getWebhookInfo"
-        response = requests.get(url)
-        
-        if response.status_code == 200:
-            result = response.json()
-            return f"<pre>{json.dumps(result, indent=2, ensure_ascii=False)}</pre>", 200
-        else:
-            return f"❌ Ошибка: {response.text}", 500
+        result = api.get_webhook_info()
+        return f"<pre>{json.dumps(result, indent=2, ensure_ascii=False)}</pre>", 200
+    except BotApiError as e:
+        return f"❌ Ошибка: {e}", 500
     except Exception as e:
         return f"❌ Исключение: {e}", 500
 
 logging.info("=== Flask приложение загружено и готово к работе ===")
 
 if __name__ == "__main__":
+    bootstrap()
     app.run(host="0.0.0.0", port=PORT, debug=False)
\ No newline at end of file
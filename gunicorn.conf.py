@@ -0,0 +1,83 @@
+"""Настройки gunicorn для всех вариантов сервера (подхватывается автоматически из корня проекта).
+
+Модули сервера при импорте ничего не делают по сети. Дорогая подготовка -
+Application, пулы соединений, регистрация вебхука - выполняется в функции
+bootstrap() модуля, которую хук post_worker_init вызывает в каждом воркере
+уже после fork, до первого запроса. Поэтому приложение можно загружать в
+мастере (preload_app) и запускать несколько воркеров: вебхук регистрирует
+только один из них, выбранный через leader.LeaderLock.
+
+Переменные окружения:
+    WEB_CONCURRENCY  - число воркеров (по умолчанию - квота CPU контейнера, без квоты 1)
+    GUNICORN_THREADS - потоков на воркер (по умолчанию 8)
+    GUNICORN_PRELOAD - загружать приложение в мастере до fork (по умолчанию 1)
+Параметры командной строки gunicorn имеют приоритет над этим файлом.
+"""
+import os
+import sys
+import glob
+import math
+import logging
+import tempfile
+
+
+def cpu_quota():
+    """Ядер по квоте cgroup (cpu.max, cgroup v2) или None, если квоты нет.
+
+    os.cpu_count() в контейнере возвращает ядра хоста: на большой машине это
+    десятки воркеров по ~55 МБ и OOM.
+    """
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+    except (OSError, ValueError):
+        return None
+    if quota == "max":
+        return None
+    return max(1, math.ceil(int(quota) / int(period)))
+
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY") or cpu_quota() or 1)
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+timeout = 60
+accesslog = "-"
+errorlog = "-"
+
+# /metrics любого воркера отдаёт сумму по всем воркерам
+os.environ.setdefault("METRICS_DIR", os.path.join(tempfile.gettempdir(), "telegram-bot-metrics"))
+
+
+def on_starting(server):
+    # Снимки метрик прошлого запуска не должны попасть в сумму
+    for path in glob.glob(os.path.join(os.environ.get("METRICS_DIR", ""), "metrics-*.json")):
+        os.remove(path)
+
+
+def when_ready(server):
+    # Мастер запросов не обслуживает: его снимок метрик не нужен (воркеры после fork пишут свои)
+    import metrics
+    metrics.REGISTRY.unpublish()
+
+
+def child_exit(server, worker):
+    # Счётчики вышедшего воркера переносятся в metrics-dead.json, его файл удаляется
+    import metrics
+    metrics.REGISTRY.retire(worker.pid)
+
+
+def post_worker_init(worker):
+    # Лимит Telegram ~30 сообщений/с - на бота, а не на процесс: делим его между воркерами
+    rate_limit = sys.modules.get("rate_limit")
+    if rate_limit is not None and worker.cfg.workers > 1:
+        rate_limit.outbound_limiter.share(worker.cfg.workers)
+    module = sys.modules.get(worker.app.app_uri.split(":", 1)[0])
+    bootstrap = getattr(module, "bootstrap", None)
+    if bootstrap is None:
+        return
+    try:
+        bootstrap()
+    except Exception as e:
+        # Воркер всё равно поднимется: bootstrap() повторится на вебхуке через BOOTSTRAP_RETRY_DELAY (bootstrap.py)
+        logging.getLogger(__name__).error("Ошибка инициализации воркера: %s", e, exc_info=True)
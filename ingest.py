@@ -0,0 +1,68 @@
+import os
+import logging
+import threading
+
+# Maximum number of admitted but not yet processed updates
+INGEST_MAX_DEPTH = int(os.getenv("INGEST_MAX_DEPTH", "1000"))
+# Depth at which the stage is reported as saturated (defaults to 80% of the maximum)
+INGEST_HIGH_WATER = int(os.getenv("INGEST_HIGH_WATER", str(INGEST_MAX_DEPTH * 4 // 5)))
+# Value of the Retry-After header sent with 503 responses (seconds)
+RETRY_AFTER = int(os.getenv("INGEST_RETRY_AFTER", "5"))
+
+logger = logging.getLogger(__name__)
+
+
+class IngestStage:
+    """Bounded admission stage in front of update dispatch.
+
+    Every update must :meth:`try_acquire` a slot before it is queued and
+    :meth:`release` it once processing is finished. When all slots are taken
+    the update is rejected, so the webhook can answer 503 and let Telegram
+    redeliver later instead of buffering without limit.
+    """
+
+    def __init__(self, max_depth=INGEST_MAX_DEPTH, high_water=INGEST_HIGH_WATER):
+        self.max_depth = max(1, max_depth)
+        self.high_water = min(max(1, high_water), self.max_depth)
+        self.depth = 0
+        self.peak = 0
+        self.accepted = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    @property
+    def full(self):
+        return self.depth >= self.max_depth
+
+    @property
+    def saturated(self):
+        return self.depth >= self.high_water
+
+    def try_acquire(self):
+        """Take a slot for one update; returns False if the stage is full."""
+        with self._lock:
+            if self.depth >= self.max_depth:
+                self.dropped += 1
+                return False
+            self.depth += 1
+            self.accepted += 1
+            if self.depth > self.peak:
+                self.peak = self.depth
+            crossed = self.depth == self.high_water
+        if crossed:
+            logger.warning("Очередь апдейтов достигла отметки %d из %d", self.high_water, self.max_depth)
+        return True
+
+    def release(self):
+        with self._lock:
+            self.depth -= 1
+
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "peak": self.peak,
+            "max_depth": self.max_depth,
+            "high_water": self.high_water,
+            "accepted": self.accepted,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,131 @@
+import os
+import time
+import threading
+import contextlib
+import contextvars
+from telegram.request import RequestData
+from telegram.request._requestparameter import RequestParameter
+import codec
+import metrics
+
+# Answer the first suitable Bot API call of a handler in the webhook response
+INLINE_REPLIES = os.getenv("INLINE_REPLIES", "0") == "1"
+# How long a webhook waits for a queued handler to make its first call (seconds)
+INLINE_REPLY_WAIT = float(os.getenv("INLINE_REPLY_WAIT", "0.2"))
+
+# Methods that may be answered inline; the handler only gets a synthetic result
+# back, so only methods whose result is not needed are here
+INLINE_METHODS = frozenset({"sendMessage", "sendChatAction", "answerCallbackQuery"})
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+INLINED = metrics.INLINE_REPLIES.labels("inlined")
+# A second call of the same update, or a method that cannot be inlined
+FALLBACK = metrics.INLINE_REPLIES.labels("fallback")
+# The webhook had already answered when the handler made its call
+LATE = metrics.INLINE_REPLIES.labels("late")
+
+_current = contextvars.ContextVar("inline_reply_slot", default=None)
+
+
+class InlineSlot:
+    """Room for one Bot API call to be returned as the webhook response body.
+
+    Telegram executes a method given in the body of a webhook response, which
+    saves the outbound request. The webhook creates a slot for the update;
+    while the handler runs with the slot :func:`active`, the first call of an
+    :data:`INLINE_METHODS` method is :meth:`capture` d instead of sent and the
+    caller gets a synthetic result. Everything after it - and everything once
+    the webhook has answered - goes out the normal way. Telegram does not
+    report the outcome of an inlined call, and a synthetic ``Message`` has
+    ``message_id`` 0.
+    """
+
+    __slots__ = ("body", "_open", "_done", "_lock")
+
+    def __init__(self):
+        self.body = None
+        self._open = True
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+
+    def capture(self, method, params):
+        """Take the call if the slot is still free; returns its synthetic result or None."""
+        if method not in INLINE_METHODS:
+            FALLBACK.inc()
+            return None
+        result = _synthetic_result(method, params)
+        if result is None:
+            FALLBACK.inc()
+            return None
+        with self._lock:
+            if not self._open:
+                (FALLBACK if self.body is not None else LATE).inc()
+                return None
+            self._open = False
+            self.body = codec.dumps({"method": method, **params})
+        INLINED.inc()
+        self._done.set()
+        return result
+
+    def close(self):
+        """The handler is done (or the webhook answered): later calls go out normally."""
+        with self._lock:
+            self._open = False
+        self._done.set()
+
+    def wait(self, timeout=INLINE_REPLY_WAIT):
+        """Wait for the first call or the end of the handler; returns the body or None."""
+        self._done.wait(timeout)
+        self.close()
+        return self.body
+
+
+@contextlib.contextmanager
+def active(slot):
+    """Run the block (a handler) with ``slot`` receiving its calls; closes the slot after."""
+    token = _current.set(slot)
+    try:
+        yield slot
+    finally:
+        _current.reset(token)
+        if slot is not None:
+            slot.close()
+
+
+def new_slot():
+    """A slot for the current update, or None when inline replies are off."""
+    return InlineSlot() if INLINE_REPLIES else None
+
+
+def capture(method, params):
+    """Called by the outbound clients before sending: the synthetic result if inlined."""
+    slot = _current.get()
+    if slot is None:
+        return None
+    return slot.capture(method, params)
+
+
+def capture_ptb(endpoint, data):
+    """:func:`capture` for python-telegram-bot's raw request parameters."""
+    slot = _current.get()
+    if slot is None:
+        return None
+    request_data = RequestData([RequestParameter.from_input(k, v) for k, v in data.items()])
+    if request_data.contains_files:
+        FALLBACK.inc()
+        return None
+    return slot.capture(endpoint, request_data.parameters)
+
+
+def _synthetic_result(method, params):
+    if method != "sendMessage":
+        return True
+    chat_id = params.get("chat_id")
+    if not isinstance(chat_id, int):
+        return None
+    return {
+        "message_id": 0,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+        "text": params.get("text", ""),
+    }
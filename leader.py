@@ -0,0 +1,71 @@
+import os
+import logging
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Lock file shared by all worker processes on the host
+LEADER_LOCK_FILE = os.getenv("LEADER_LOCK_FILE", os.path.join(tempfile.gettempdir(), "telegram-bot-leader.lock"))
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderLock:
+    """Elects one process on the host to run one-off tasks such as webhook registration.
+
+    The first process that :meth:`acquire` s an exclusive ``flock`` on the
+    lock file becomes the leader and keeps it until it exits; the kernel then
+    releases the lock and a restarted worker can take over. Call it after the
+    fork (from ``bootstrap()``), never in the gunicorn master: a lock taken
+    before fork would be shared with every worker. Without ``fcntl`` (Windows)
+    the process is always the leader.
+    """
+
+    def __init__(self, path=LEADER_LOCK_FILE):
+        self.path = path
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def held(self):
+        return self._fd is not None and self._pid == os.getpid()
+
+    def acquire(self):
+        """Try to become the leader without blocking; True if this process is it."""
+        with self._lock:
+            if self.held:
+                return True
+            if fcntl is None:
+                self._pid = os.getpid()
+                self._fd = -1
+                return True
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+            os.ftruncate(fd, 0)
+            os.write(fd, str(os.getpid()).encode())
+            self._fd = fd
+            self._pid = os.getpid()
+        logger.info("Процесс %d выбран лидером (%s)", self._pid, self.path)
+        return True
+
+    def release(self):
+        with self._lock:
+            if not self.held:
+                return
+            if self._fd >= 0:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+                os.close(self._fd)
+            self._fd = None
+            self._pid = None
+
+
+leader_lock = LeaderLock()
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+"""Нагрузочный тест всех вариантов сервера против локального fake_bot_api.py.
+
+    python loadtest.py [вариант ...] [--rate 100] [--duration 20] [--workers 1] [--threads 1]
+                       [--latency 0.05] [--rate-429 0.01] [--rate-5xx 0.01] [--chats 50]
+
+Для каждого варианта (по умолчанию - всех) скрипт поднимает fake_bot_api.py,
+запускает сервер под gunicorn с TELEGRAM_API_URL, указывающим на заглушку,
+шлёт вебхуки (текст, команды, фото, web_app_data) с заданной частотой и
+печатает пропускную способность, p50/p99 задержки, долю ошибок, число
+ответов бота (вызовов sendMessage) и пиковый RSS процессов сервера.
+"""
+import os
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from collections import Counter
+import aiohttp
+import codec
+from sample_updates import MIX
+
+FAKE_TOKEN = "123456:LOADTEST"
+
+# вариант: (модуль:приложение для gunicorn, класс воркера, путь вебхука)
+ENTRY_POINTS = {
+    "bot": ("bot:app", None, f"/{FAKE_TOKEN}"),
+    "simple_bot": ("simple_bot:app", None, f"/{FAKE_TOKEN}"),
+    "flask_railway": ("flask_railway:app", None, f"/{FAKE_TOKEN}"),
+    "flask_simple": ("flask_simple:app", None, "/webhook"),
+    "flask_simple_fixed": ("flask_simple_fixed:app", None, f"/{FAKE_TOKEN}"),
+    "bot_aiohttp": ("bot_aiohttp:app", "aiohttp.GunicornWebWorker", f"/{FAKE_TOKEN}"),
+    # Без gunicorn: python simple_server.py (workers/threads не применяются)
+    "simple_server": ("simple_server", None, f"/{FAKE_TOKEN}"),
+}
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def tree_rss(pid):
+    """RSS процесса и всех его потомков в байтах (Linux, /proc)."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    total, stack = 0, [pid]
+    while stack:
+        current = stack.pop()
+        stack.extend(children.get(current, ()))
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            pass
+    return total
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(len(sorted_values) - 1, round(p / 100 * (len(sorted_values) - 1)))]
+
+
+def make_payloads(count, chats, first_id=1):
+    """Вебхуки из MIX с уникальными update_id, раскиданные по ``chats`` чатам."""
+    return [
+        codec.dumps(MIX[i % len(MIX)](first_id + i, chat_id=1000 + i % chats))
+        for i in range(count)
+    ]
+
+
+async def wait_http(url, timeout):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as response:
+                    if response.status < 500:
+                        return True
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    return False
+
+
+def start_fake_api(port, latency=0.0, jitter=0.0, rate_429=0.0, rate_5xx=0.0, handshake=0.0):
+    """Запускает fake_bot_api.py в отдельном процессе."""
+    return subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "fake_bot_api.py"), "--port", str(port),
+         "--latency", str(latency), "--jitter", str(jitter), "--rate-429", str(rate_429),
+         "--rate-5xx", str(rate_5xx), "--handshake", str(handshake)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+# Лимиты Telegram на исходящие сообщения, снятые для замера самого сервера
+UNLIMITED = {
+    "RATE_LIMIT_GLOBAL": "1000000", "RATE_LIMIT_GLOBAL_BURST": "1000000",
+    "RATE_LIMIT_PER_CHAT": "1000000", "RATE_LIMIT_CHAT_BURST": "1000000",
+    "RATE_LIMIT_PER_GROUP_MINUTE": "60000000", "RATE_LIMIT_GROUP_BURST": "1000000",
+}
+
+
+def server_env(port, api_base, log_level="WARNING", telegram_limits=False):
+    """Окружение варианта сервера: поддельный токен и Bot API на заглушке."""
+    env = dict(os.environ,
+               BOT_TOKEN=FAKE_TOKEN,
+               TELEGRAM_API_URL=api_base,
+               WEBHOOK_URL=f"http://127.0.0.1:{port}",
+               RAILWAY_STATIC_URL=f"127.0.0.1:{port}",
+               PORT=str(port),
+               LOG_LEVEL=log_level,
+               # Свой offset getUpdates на каждый запуск (см. polling.py)
+               POLL_OFFSET_DIR=tempfile.mkdtemp(prefix="loadtest-poll-"),
+               POLL_MIN_SECONDS="1",
+               PYTHONUNBUFFERED="1")
+    if not telegram_limits:
+        env.update(UNLIMITED)
+    return env
+
+
+def server_command(name, port, workers=1, threads=1):
+    """Команда запуска варианта сервера под gunicorn (с gunicorn.conf.py проекта)."""
+    target, worker_class, _ = ENTRY_POINTS[name]
+    if ":" not in target:
+        return [sys.executable, os.path.join(HERE, f"{target}.py")]
+    command = [sys.executable, "-m", "gunicorn", target, "--bind", f"127.0.0.1:{port}",
+               "--workers", str(workers), "--threads", str(threads), "--timeout", "60"]
+    if worker_class:
+        command += ["--worker-class", worker_class]
+    return command
+
+
+async def fake_api(session, base, path, method="GET"):
+    async with session.request(method, f"{base}{path}") as response:
+        return (await response.json())["result"]
+
+
+async def generate_load(url, payloads, rate, max_in_flight, secret=None):
+    """Открытая модель нагрузки: запросы уходят по расписанию, не дожидаясь ответов."""
+    latencies = []
+    statuses = Counter()
+    inline = 0
+    in_flight = asyncio.Semaphore(max_in_flight)
+    headers = {"Content-Type": "application/json"}
+    if secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = secret
+    timeout = aiohttp.ClientTimeout(total=30)
+
+    async def post(session, body):
+        nonlocal inline
+        start = time.perf_counter()
+        try:
+            async with session.post(url, data=body, headers=headers) as response:
+                answer = await response.read()
+                statuses[response.status] += 1
+                if response.status == 200:
+                    latencies.append(time.perf_counter() - start)
+                    # Ответ бота прямо в теле ответа на вебхук (INLINE_REPLIES=1)
+                    if answer.startswith(b"{"):
+                        inline += 1
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            statuses[type(e).__name__] += 1
+        finally:
+            in_flight.release()
+
+    connector = aiohttp.TCPConnector(limit=max_in_flight)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        loop = asyncio.get_running_loop()
+        tasks = set()
+        started = loop.time()
+        for i, body in enumerate(payloads):
+            delay = started + i / rate - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if in_flight.locked():
+                # Сервер не успевает: запрос не отправляем, это тоже ошибка
+                statuses["client_overflow"] += 1
+                continue
+            await in_flight.acquire()
+            task = asyncio.create_task(post(session, body))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+        elapsed = loop.time() - started
+    return latencies, statuses, elapsed, inline
+
+
+async def wait_backlog(session, api_base, timeout, started):
+    """Секунды от ``started`` до выборки всей очереди getUpdates и возврата вебхука."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = await fake_api(session, api_base, "/fake/stats")
+        if not stats["pending_updates"] and stats["webhook"].get("url"):
+            return time.perf_counter() - started
+        await asyncio.sleep(0.1)
+    return None
+
+
+async def run_entry(name, args, api_base, log_dir):
+    path = ENTRY_POINTS[name][2]
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    env = server_env(port, api_base, args.log_level, args.telegram_limits)
+    if args.inline:
+        env["INLINE_REPLIES"] = "1"
+    if args.secret:
+        # С секретом вебхук у всех вариантов на /webhook (см. webhook_auth.py)
+        env["WEBHOOK_SECRET"] = args.secret
+        path = "/webhook"
+    command = server_command(name, port, args.workers, args.threads)
+    log_path = os.path.join(log_dir, f"{name}.log")
+    result = {"name": name, "log": log_path}
+    payloads = make_payloads(int(args.rate * args.duration), args.chats)
+
+    async with aiohttp.ClientSession() as session:
+        await fake_api(session, api_base, "/fake/reset", "POST")
+        if args.backlog:
+            # Апдейты, накопившиеся, пока сервер был недоступен
+            backlog = [codec.loads(p) for p in make_payloads(args.backlog, args.chats, first_id=10**6)]
+            async with session.post(f"{api_base}/fake/updates", data=codec.dumps(backlog)) as response:
+                await response.read()
+        started = time.perf_counter()
+        with open(log_path, "wb") as log:
+            server = subprocess.Popen(command, cwd=HERE, env=env, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            if not await wait_http(f"{base}/health", args.startup_timeout):
+                result["error"] = "сервер не поднялся"
+                return result
+            if args.backlog:
+                result["backlog_seconds"] = await wait_backlog(session, api_base, args.startup_timeout, started)
+            await asyncio.sleep(args.settle)
+            # Flask-варианты регистрируют вебхук только по /set_webhook
+            if not (await fake_api(session, api_base, "/fake/stats"))["webhook"]:
+                async with session.get(f"{base}/set_webhook") as response:
+                    await response.read()
+            peak_rss = tree_rss(server.pid)
+
+            async def sample_rss():
+                nonlocal peak_rss
+                while True:
+                    await asyncio.sleep(0.5)
+                    peak_rss = max(peak_rss, tree_rss(server.pid))
+
+            sampler = asyncio.create_task(sample_rss())
+            latencies, statuses, elapsed, inline = await generate_load(
+                base + path, payloads, args.rate, args.max_in_flight, args.secret)
+            # Даём асинхронным обработчикам доотправить ответы
+            replies, waited = -1, 0.0
+            while waited < args.drain:
+                calls = (await fake_api(session, api_base, "/fake/stats"))["calls"]
+                if calls.get("sendMessage", 0) == replies:
+                    break
+                replies = calls.get("sendMessage", 0)
+                await asyncio.sleep(0.5)
+                waited += 0.5
+            sampler.cancel()
+            stats = await fake_api(session, api_base, "/fake/stats")
+            async with session.get(f"{base}/diagnostics") as response:
+                result["breaker"] = (await response.json())["breaker"]
+        finally:
+            server.terminate()
+            try:
+                server.wait(10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+
+    latencies.sort()
+    sent = len(payloads)
+    ok = statuses.get(200, 0)
+    result.update(
+        sent=sent,
+        ok=ok,
+        error_rate=(sent - ok) / sent if sent else 0.0,
+        rps=ok / elapsed if elapsed else 0.0,
+        p50=percentile(latencies, 50),
+        p99=percentile(latencies, 99),
+        replies=stats["calls"].get("sendMessage", 0) + inline,
+        inline=inline,
+        injected_429=stats["injected_429"],
+        injected_5xx=stats["injected_5xx"],
+        rss=peak_rss,
+        statuses=dict(statuses),
+        webhook=stats["webhook"],
+        backlog=args.backlog,
+    )
+    return result
+
+
+def print_report(results):
+    print(f"\n{'вариант':<20}{'отправлено':>11}{'ok':>7}{'ошибки':>8}{'rps':>8}"
+          f"{'p50 мс':>9}{'p99 мс':>9}{'ответов':>9}{'RSS МБ':>8}")
+    for r in results:
+        if "error" in r:
+            print(f"{r['name']:<20}  {r['error']} (лог: {r['log']})")
+            continue
+        print(f"{r['name']:<20}{r['sent']:>11}{r['ok']:>7}{r['error_rate']:>7.1%} {r['rps']:>7.1f}"
+              f"{r['p50'] * 1000:>9.1f}{r['p99'] * 1000:>9.1f}{r['replies']:>9}{r['rss'] / 2**20:>8.1f}")
+    for r in results:
+        if "error" in r:
+            continue
+        other = {k: v for k, v in r["statuses"].items() if k != 200}
+        if other:
+            print(f"  {r['name']}: ответы кроме 200: {other}")
+        if r["injected_5xx"]:
+            breaker = r["breaker"]
+            print(f"  {r['name']}: {r['injected_5xx']} ответов 502, автомат Bot API размыкался "
+                  f"{breaker['opened']} раз, сразу отклонено {breaker['rejected']} вызовов")
+        if r["inline"]:
+            print(f"  {r['name']}: из них {r['inline']} ответов в теле ответа на вебхук")
+        if "backlog_seconds" in r:
+            seconds = r["backlog_seconds"]
+            print(f"  {r['name']}: очередь из {r['backlog']} апдейтов выбрана за "
+                  + (f"{seconds:.1f} с" if seconds is not None else "- не успели"))
+        if r["webhook"]:
+            print(f"  {r['name']}: setWebhook allowed_updates={r['webhook'].get('allowed_updates')} "
+                  f"max_connections={r['webhook'].get('max_connections')} "
+                  f"secret_token={r['webhook'].get('has_secret_token')}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест вариантов сервера")
+    parser.add_argument("entries", nargs="*", metavar="вариант",
+                        help=f"варианты сервера: {', '.join(ENTRY_POINTS)} (по умолчанию все)")
+    parser.add_argument("--rate", type=float, default=100, help="вебхуков в секунду")
+    parser.add_argument("--duration", type=float, default=20, help="длительность, с")
+    parser.add_argument("--chats", type=int, default=50, help="число разных чатов")
+    parser.add_argument("--max-in-flight", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=1, help="воркеров gunicorn")
+    parser.add_argument("--threads", type=int, default=1, help="потоков на воркер gunicorn")
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка Bot API, с")
+    parser.add_argument("--jitter", type=float, default=0.01, help="разброс задержки Bot API, ± с")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="доля ответов 429 от Bot API")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="доля ответов 502 от Bot API")
+    parser.add_argument("--startup-timeout", type=float, default=30)
+    parser.add_argument("--settle", type=float, default=1.0, help="пауза после старта сервера, с")
+    parser.add_argument("--drain", type=float, default=10.0, help="сколько ждать доотправки ответов, с")
+    parser.add_argument("--backlog", type=int, default=0,
+                        help="апдейтов в очереди getUpdates до старта сервера (выборка при UPDATE_MODE=auto)")
+    parser.add_argument("--inline", action="store_true",
+                        help="INLINE_REPLIES=1: первый ответ обработчика - в теле ответа на вебхук")
+    parser.add_argument("--secret", help="WEBHOOK_SECRET серверов (заголовок X-Telegram-Bot-Api-Secret-Token)")
+    parser.add_argument("--log-level", default="WARNING", help="LOG_LEVEL серверов")
+    parser.add_argument("--telegram-limits", action="store_true",
+                        help="оставить лимиты Telegram на исходящие (rate_limit.py), по умолчанию сняты")
+    args = parser.parse_args()
+    unknown = set(args.entries) - set(ENTRY_POINTS)
+    if unknown:
+        parser.error(f"неизвестные варианты: {', '.join(sorted(unknown))}")
+
+    api_port = free_port()
+    api_base = f"http://127.0.0.1:{api_port}"
+    log_dir = tempfile.mkdtemp(prefix="loadtest-")
+    fake = start_fake_api(api_port, args.latency, args.jitter, args.rate_429, args.rate_5xx)
+    try:
+        if not await wait_http(f"{api_base}/fake/stats", 10):
+            sys.exit("fake_bot_api.py не запустился")
+        print(f"Bot API: {api_base} (задержка {args.latency * 1000:.0f}±{args.jitter * 1000:.0f} мс, "
+              f"429: {args.rate_429:.1%}, 502: {args.rate_5xx:.1%}), нагрузка {args.rate:g} вебхуков/с × {args.duration:g} с, "
+              f"gunicorn {args.workers}×{args.threads}, логи: {log_dir}")
+        results = []
+        for name in args.entries or ENTRY_POINTS:
+            print(f"... {name}", flush=True)
+            results.append(await run_entry(name, args, api_base, log_dir))
+        print_report(results)
+    finally:
+        fake.terminate()
+        fake.wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,146 @@
+import os
+import sys
+import time
+import queue
+import atexit
+import logging
+import itertools
+import threading
+from logging.handlers import QueueHandler, QueueListener
+import codec
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# "text" or "json" (one JSON object per line)
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+# Sampling: a record logged with extra=sampled("<key>") is written once per N;
+# N comes from LOG_SAMPLE_<KEY>, 0 drops them all. Warnings and errors are never sampled.
+DEFAULT_SAMPLE_RATES = {"health": 100, "webhook": 10}
+
+DEFAULT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+_listener = None
+_listener_queue = None
+_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a single-line JSON object."""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        sample = getattr(record, "sample", None)
+        if sample is not None:
+            entry["sample"] = sample
+        return codec.dumps(entry).decode()
+
+
+class SamplingFilter(logging.Filter):
+    """Lets through one of every N records tagged with the same ``sample`` key."""
+
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = dict(DEFAULT_SAMPLE_RATES)
+        self.rates.update(rates or {})
+        self._counters = {}
+
+    def filter(self, record):
+        key = getattr(record, "sample", None)
+        if key is None or record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(key, 1)
+        if rate <= 1:
+            return rate == 1
+        counter = self._counters.get(key)
+        if counter is None:
+            counter = self._counters.setdefault(key, itertools.count())
+        return next(counter) % rate == 0
+
+
+class _InProcessQueueHandler(QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread.
+
+    The stock ``prepare`` renders the message in the caller's thread so the
+    record can be pickled; the queue never leaves the process here, so the
+    record is passed as is and ``%`` arguments are merged off the hot path.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def sampled(key):
+    """``extra`` argument that puts a record under sampling key ``key``."""
+    return {"sample": key}
+
+
+# Sampling keys of the servers' hot-path lines (LOG_SAMPLE_WEBHOOK etc.)
+SAMPLE_WEBHOOK = sampled("webhook")
+SAMPLE_HEALTH = sampled("health")
+SAMPLE_WEBAPP = sampled("webapp")
+
+
+def _sample_rates_from_env():
+    rates = {}
+    for name, value in os.environ.items():
+        if name.startswith("LOG_SAMPLE_"):
+            try:
+                rates[name[len("LOG_SAMPLE_"):].lower()] = int(value)
+            except ValueError:
+                pass
+    return rates
+
+
+def _start_listener(handler):
+    global _listener
+    _listener = QueueListener(_listener_queue, handler, respect_handler_level=True)
+    _listener.start()
+
+
+def setup_logging(fmt=DEFAULT_FORMAT, level=LOG_LEVEL):
+    """Route all logging through a queue drained by a background thread.
+
+    Safe to call more than once: only the first call configures logging.
+    """
+    global _listener_queue
+    with _lock:
+        if _listener is not None:
+            return
+        handler = logging.StreamHandler(sys.stderr)
+        if LOG_FORMAT == "json":
+            handler.setFormatter(JsonFormatter())
+        else:
+            formatter = logging.Formatter(fmt)
+            formatter.converter = time.localtime
+            handler.setFormatter(formatter)
+
+        _listener_queue = queue.SimpleQueue()
+        queue_handler = _InProcessQueueHandler(_listener_queue)
+        queue_handler.addFilter(SamplingFilter(_sample_rates_from_env()))
+
+        root = logging.getLogger()
+        for old in root.handlers[:]:
+            root.removeHandler(old)
+        root.addHandler(queue_handler)
+        root.setLevel(level)
+
+        _start_listener(handler)
+        atexit.register(_stop_listener)
+        # The listener thread does not survive fork (e.g. gunicorn preload_app)
+        os.register_at_fork(after_in_child=lambda: _start_listener(handler))
+
+
+def _stop_listener():
+    if _listener is not None:
+        _listener.stop()
+
+
+def set_level(level):
+    """Change the root log level at runtime (see /debug/log_level in profiling.py)."""
+    logging.getLogger().setLevel(level.upper() if isinstance(level, str) else level)
@@ -0,0 +1,584 @@
+import os
+import time
+import glob
+import atexit
+import bisect
+import asyncio
+import inspect
+import logging
+import functools
+import contextlib
+import threading
+import codec
+
+# Directory for per-worker snapshots; set it when several worker processes serve /metrics
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+# How often a worker writes its snapshot to METRICS_DIR (seconds)
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels_text(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+        (registry or REGISTRY).register(self)
+
+    def labels(self, *values):
+        """Return the child for the given label values (cache it on hot paths)."""
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name}: expected labels {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _only_child(self):
+        return self._children[()]
+
+    def samples(self):
+        """``[(label values, value)]`` where value is what the child dumps."""
+        return [(values, child.dump()) for values, child in list(self._children.items())]
+
+
+class _CounterChild:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dump(self):
+        return self.value
+
+
+class Counter(_Metric):
+    """Monotonically increasing value; the name should end with ``_total``."""
+
+    type = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._only_child().inc(amount)
+
+
+class _GaugeChild:
+    __slots__ = ("value", "function", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set_function(self, function):
+        """Read the value from ``function()`` at collection time instead."""
+        self.function = function
+
+    def dump(self):
+        if self.function is not None:
+            try:
+                return float(self.function())
+            except Exception:
+                return float("nan")
+        return self.value
+
+
+class Gauge(_Metric):
+    """Value that goes up and down; across workers the values are summed."""
+
+    type = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._only_child().set(value)
+
+    def inc(self, amount=1):
+        self._only_child().inc(amount)
+
+    def dec(self, amount=1):
+        self._only_child().dec(amount)
+
+    def set_function(self, function):
+        self._only_child().set_function(function)
+
+    def get(self):
+        """Value in this process (what /metrics shows is the sum over workers)."""
+        return self._only_child().dump()
+
+
+class _Timer:
+    __slots__ = ("child", "start")
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "_lock")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager observing the duration of its block in seconds."""
+        return _Timer(self)
+
+    def dump(self):
+        with self._lock:
+            return [list(self.counts), self.sum]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in fixed buckets (seconds by default)."""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value):
+        self._only_child().observe(value)
+
+    def time(self):
+        return self._only_child().time()
+
+
+class Registry:
+    """Collection of metrics rendered in the Prometheus text format.
+
+    With ``directory`` set, every process periodically writes its own values
+    to ``<directory>/metrics-<pid>.json`` and :meth:`render` merges the files
+    of all workers, so any worker can answer a scrape. Gauges count only for
+    live processes. :meth:`retire` folds the counters and histograms of an
+    exited worker into ``metrics-dead.json`` and removes its file.
+    """
+
+    def __init__(self, directory=""):
+        self.directory = directory
+        self._metrics = {}
+        self._flusher = None
+        self._publish = False
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def snapshot(self):
+        return {
+            metric.name: {
+                "type": metric.type,
+                "help": metric.documentation,
+                "labels": metric.labelnames,
+                "bounds": getattr(metric, "bounds", None),
+                "samples": metric.samples(),
+            }
+            for metric in self._metrics.values()
+        }
+
+    # --- several worker processes ---
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f"metrics-{pid}.json")
+
+    def flush(self):
+        """Write this process' snapshot (atomically) for the other workers."""
+        if not self.directory or not self._publish:
+            return
+        path = self._path(os.getpid())
+        tmp = f"{path}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(codec.dumps(self.snapshot()))
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning("Не удалось записать метрики в %s: %s", path, e)
+
+    def start_flusher(self, interval=METRICS_FLUSH_INTERVAL):
+        """Flush in a background thread every ``interval`` seconds and at exit."""
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._publish = True
+
+        def run():
+            while True:
+                time.sleep(interval)
+                self.flush()
+
+        self._flusher = threading.Thread(target=run, name="metrics-flush", daemon=True)
+        self._flusher.start()
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, "rb") as f:
+                return codec.loads(f.read())
+        except (OSError, codec.DecodeError):
+            return None
+
+    @staticmethod
+    def _add(merged, snapshot, gauges=True):
+        """Add a snapshot's samples to ``merged`` (name -> family with a samples dict)."""
+        for name, family in snapshot.items():
+            if family["type"] == "gauge" and not gauges:
+                continue
+            target = merged.setdefault(name, dict(family, samples={}))
+            for values, value in family["samples"]:
+                if value is None:
+                    continue
+                key = tuple(values)
+                if family["type"] == "histogram":
+                    counts, total = target["samples"].get(key, ([0] * len(value[0]), 0.0))
+                    target["samples"][key] = ([a + b for a, b in zip(counts, value[0])], total + value[1])
+                else:
+                    target["samples"][key] = target["samples"].get(key, 0.0) + value
+
+    @staticmethod
+    def _listed(merged):
+        for family in merged.values():
+            family["samples"] = list(family["samples"].items())
+        return merged
+
+    def unpublish(self):
+        """Stop writing this process' snapshot, e.g. in the gunicorn master, which serves nothing."""
+        self._publish = False
+        with contextlib.suppress(OSError):
+            os.remove(self._path(os.getpid()))
+
+    def retire(self, pid):
+        """Fold an exited worker's counters and histograms into ``metrics-dead.json``.
+
+        Called by the gunicorn master (``child_exit``), the only writer of that
+        file. The worker's own file is removed, so it is not parsed on every
+        scrape and a new process with the same pid starts from zero.
+        """
+        if not self.directory:
+            return
+        path = self._path(pid)
+        snapshot = self._read(path)
+        if snapshot is not None:
+            dead_path = self._path("dead")
+            merged = {}
+            self._add(merged, self._read(dead_path) or {})
+            self._add(merged, snapshot, gauges=False)
+            tmp = f"{dead_path}.tmp"
+            try:
+                with open(tmp, "wb") as f:
+                    f.write(codec.dumps(self._listed(merged)))
+                os.replace(tmp, dead_path)
+            except OSError as e:
+                logger.warning("Не удалось записать метрики в %s: %s", dead_path, e)
+                return
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+    def _merged(self):
+        self.flush()
+        merged = {}
+        for path in glob.glob(os.path.join(self.directory, "metrics-*.json")):
+            name = os.path.basename(path)[len("metrics-"):-len(".json")]
+            if name == "dead":
+                alive = False
+            else:
+                try:
+                    alive = _pid_alive(int(name))
+                except ValueError:
+                    continue
+            snapshot = self._read(path)
+            if snapshot is not None:
+                self._add(merged, snapshot, gauges=alive)
+        return self._listed(merged)
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        families = self._merged() if self.directory else self.snapshot()
+        lines = []
+        for name, family in families.items():
+            lines.append(f"# HELP {name} {family['help']}")
+            lines.append(f"# TYPE {name} {family['type']}")
+            labels = family["labels"]
+            for values, value in family["samples"]:
+                if family["type"] != "histogram":
+                    lines.append(f"{name}{_labels_text(labels, values)} {_number(value)}")
+                    continue
+                counts, total = value
+                cumulative = 0
+                for bound, count in zip(list(family["bounds"]) + [float("inf")], counts):
+                    cumulative += count
+                    le = f'le="{_number(float(bound))}"'
+                    lines.append(f"{name}_bucket{_labels_text(labels, values, le)} {cumulative}")
+                lines.append(f"{name}_sum{_labels_text(labels, values)} {_number(total)}")
+                lines.append(f"{name}_count{_labels_text(labels, values)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def _pid_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+REGISTRY = Registry(METRICS_DIR)
+
+
+def render():
+    return REGISTRY.render()
+
+
+# --- Metrics shared by all entry points ---
+
+WEBHOOK_SECONDS = Histogram(
+    "bot_webhook_request_seconds", "Time spent answering a webhook request")
+STAGE_SECONDS = Histogram(
+    "bot_update_stage_seconds", "Time spent per update processing stage", ["stage"])
+
+# Called as observer(stage, seconds) / observer(method, status, seconds), see add_*_observer()
+_stage_observers = []
+_outbound_observers = []
+
+
+def add_stage_observer(observer):
+    """Call ``observer(stage, seconds)`` after every observation of a :class:`Stage`."""
+    _stage_observers.append(observer)
+
+
+def add_outbound_observer(observer):
+    """Call ``observer(method, status, seconds)`` after every :func:`observe_outbound`."""
+    _outbound_observers.append(observer)
+
+
+class Stage:
+    """One update processing stage: a ``STAGE_SECONDS`` child plus the stage observers."""
+
+    __slots__ = ("name", "child")
+
+    def __init__(self, name):
+        self.name = name
+        self.child = STAGE_SECONDS.labels(name)
+
+    def observe(self, seconds):
+        self.child.observe(seconds)
+        for observer in _stage_observers:
+            observer(self.name, seconds)
+
+    def time(self):
+        """Context manager observing the duration of its block in seconds."""
+        return _Timer(self)
+
+
+# Created once, not per update
+STAGE_DECODE = Stage("decode")
+STAGE_DE_JSON = Stage("de_json")
+STAGE_QUEUE_WAIT = Stage("queue_wait")
+STAGE_HANDLER = Stage("handler")
+
+HANDLER_SECONDS = Histogram(
+    "bot_handler_seconds", "Duration of bot handler calls", ["handler"])
+HANDLER_CALLS = Counter(
+    "bot_handler_calls_total", "Bot handler calls by outcome", ["handler", "outcome"])
+
+OUTBOUND_SECONDS = Histogram(
+    "bot_api_request_seconds", "Latency of outbound Bot API calls", ["method"])
+OUTBOUND_REQUESTS = Counter(
+    "bot_api_requests_total", "Outbound Bot API calls by status", ["method", "status"])
+
+FAST_PATH_FALLBACKS = Counter(
+    "bot_fast_path_fallbacks_total", "Updates the FAST_PATH router did not match, handled via Update.de_json")
+
+POLLED_UPDATES = Counter(
+    "bot_polled_updates_total", "Updates received with getUpdates instead of the webhook")
+POLLING_ACTIVE = Gauge(
+    "bot_polling_active", "1 while the leader receives updates with getUpdates")
+
+WEBHOOK_REJECTED = Counter(
+    "bot_webhook_rejected_total", "Webhook requests rejected before reading the body", ["reason"])
+INLINE_REPLIES = Counter(
+    "bot_inline_replies_total", "Bot API calls answered in the webhook response, by outcome",
+    ["outcome"])
+BOT_API_RETRIES = Counter(
+    "bot_api_retries_total", "Idempotent Bot API calls retried after a timeout, network error or 5xx",
+    ["method"])
+BOT_API_CIRCUIT_OPEN = Gauge(
+    "bot_api_circuit_open", "1 while the Bot API circuit breaker fails calls fast")
+
+IN_FLIGHT_REQUESTS = Gauge(
+    "bot_webhook_in_flight", "Webhook requests currently being handled")
+THREADS = Gauge("bot_threads", "Live threads in the process")
+THREADS.set_function(threading.active_count)
+TASKS = Gauge("bot_asyncio_tasks", "Pending asyncio tasks on watched event loops")
+READY = Gauge("bot_ready", "Workers that answer /ready with 200")
+
+_watched_loops = []
+
+
+def _count_tasks():
+    return sum(len(asyncio.all_tasks(loop)) for loop in _watched_loops if not loop.is_closed())
+
+
+TASKS.set_function(_count_tasks)
+
+
+def watch_loop(loop):
+    """Count the tasks of ``loop`` in ``bot_asyncio_tasks``."""
+    _watched_loops.append(loop)
+
+
+def watched_loops():
+    """Loops passed to :func:`watch_loop` that are still open."""
+    return [loop for loop in _watched_loops if not loop.is_closed()]
+
+
+def track_request(view):
+    """Decorate a webhook view (sync or async) to record latency and in-flight count."""
+    if inspect.iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def wrapper(*args, **kwargs):
+            IN_FLIGHT_REQUESTS.inc()
+            start = time.perf_counter()
+            try:
+                return await view(*args, **kwargs)
+            finally:
+                WEBHOOK_SECONDS.observe(time.perf_counter() - start)
+                IN_FLIGHT_REQUESTS.dec()
+    else:
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            IN_FLIGHT_REQUESTS.inc()
+            start = time.perf_counter()
+            try:
+                return view(*args, **kwargs)
+            finally:
+                WEBHOOK_SECONDS.observe(time.perf_counter() - start)
+                IN_FLIGHT_REQUESTS.dec()
+    return wrapper
+
+
+def track_handler(handler):
+    """Decorate a bot handler (sync or async) to count calls and time them."""
+    name = handler.__name__
+    seconds = HANDLER_SECONDS.labels(name)
+    ok = HANDLER_CALLS.labels(name, "ok")
+    error = HANDLER_CALLS.labels(name, "error")
+    if inspect.iscoroutinefunction(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = await handler(*args, **kwargs)
+            except BaseException:
+                error.inc()
+                raise
+            finally:
+                seconds.observe(time.perf_counter() - start)
+            ok.inc()
+            return result
+    else:
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = handler(*args, **kwargs)
+            except BaseException:
+                error.inc()
+                raise
+            finally:
+                seconds.observe(time.perf_counter() - start)
+            ok.inc()
+            return result
+    return wrapper
+
+
+def observe_outbound(method, status, seconds):
+    """Record one outbound Bot API call."""
+    OUTBOUND_SECONDS.labels(method).observe(seconds)
+    OUTBOUND_REQUESTS.labels(method, status).inc()
+    for observer in _outbound_observers:
+        observer(method, status, seconds)
+
+
+if METRICS_DIR:
+    REGISTRY.start_flusher()
+    atexit.register(REGISTRY.flush)
+    # The flusher thread does not survive fork (gunicorn preload_app)
+    os.register_at_fork(after_in_child=REGISTRY.start_flusher)
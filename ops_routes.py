@@ -0,0 +1,62 @@
+from flask import Blueprint, request
+import metrics
+import profiling
+import warmup
+from dedup import recent_updates
+from readiness import monitor
+from resilience import diagnostics
+
+
+def blueprint(components):
+    """Flask blueprint with the operational endpoints of the Flask servers.
+
+    ``/ready``, ``/metrics``, ``/diagnostics`` and ``/debug/profile``,
+    ``/debug/traces`` and ``/debug/log_level``. ``components()`` returns the
+    server's own parts for ``/diagnostics`` as keyword arguments of
+    :func:`resilience.diagnostics` (``dispatcher``, ``ingest``, ``poller``);
+    it is called per request, since they are created in ``bootstrap()``.
+    """
+    ops = Blueprint("ops", __name__)
+
+    @ops.route("/ready")
+    def ready():
+        """Readiness probe: 503 while warming up or overloaded."""
+        reason = monitor.not_ready()
+        if reason:
+            return reason, 503
+        return "OK", 200
+
+    @ops.route("/metrics")
+    def metrics_endpoint():
+        """Prometheus metrics."""
+        return metrics.render(), 200, {"Content-Type": metrics.CONTENT_TYPE}
+
+    @ops.route("/diagnostics")
+    def diagnostics_endpoint():
+        """Outbound Bot API path and update queues, as JSON."""
+        return diagnostics(**components(), dedup=recent_updates,
+                           warmup=warmup.state, load=monitor)
+
+    @ops.route("/debug/profile")
+    def debug_profile():
+        """Samples this worker for ?seconds=N; needs X-Profile-Token."""
+        return _response(*profiling.profile_response(request.headers,
+                                                     request.args))
+
+    @ops.route("/debug/traces")
+    def debug_traces():
+        """Stage timings of the last updates (TRACE_UPDATES=1)."""
+        return _response(*profiling.traces_response(request.headers,
+                                                    request.args))
+
+    @ops.route("/debug/log_level", methods=["GET", "POST"])
+    def debug_log_level():
+        """Log level of this worker; POST ?level=DEBUG changes it."""
+        return _response(*profiling.log_level_response(
+            request.headers, request.args, request.method))
+
+    return ops
+
+
+def _response(body, status, content_type):
+    return body, status, {"Content-Type": content_type}
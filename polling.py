@@ -0,0 +1,261 @@
+import os
+import re
+import time
+import logging
+import tempfile
+import threading
+import metrics
+from bot_api import BotApiClient, BotApiError, CONNECT_TIMEOUT
+from webhook_registration import ensure_webhook
+
+# How updates reach the bot: "webhook" only, "polling" only, or "auto" -
+# webhook normally, getUpdates while the webhook lags or Telegram cannot reach it
+UPDATE_MODE = os.getenv("UPDATE_MODE", "auto")
+# Updates per getUpdates call (Telegram allows 1-100)
+POLL_LIMIT = int(os.getenv("POLL_LIMIT", "100"))
+# Long polling timeout of getUpdates (seconds)
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "50"))
+# pending_update_count at which "auto" drains the backlog with getUpdates
+POLL_BACKLOG_THRESHOLD = int(os.getenv("POLL_BACKLOG_THRESHOLD", "500"))
+# How often "auto" checks getWebhookInfo while on the webhook (seconds)
+WEBHOOK_CHECK_INTERVAL = float(os.getenv("WEBHOOK_CHECK_INTERVAL", "60"))
+# Minimum time on polling before the webhook is tried again; doubles (up to
+# POLL_MAX_SECONDS) each time the webhook fails again right away
+POLL_MIN_SECONDS = float(os.getenv("POLL_MIN_SECONDS", "60"))
+POLL_MAX_SECONDS = float(os.getenv("POLL_MAX_SECONDS", "900"))
+# Pause before offering updates again when the dispatch path is full (seconds)
+POLL_OVERLOAD_DELAY = float(os.getenv("POLL_OVERLOAD_DELAY", "0.5"))
+# Pause after a failed Bot API call (seconds)
+POLL_ERROR_DELAY = float(os.getenv("POLL_ERROR_DELAY", "5"))
+# Directory of the offset files (one per bot)
+POLL_OFFSET_DIR = os.getenv("POLL_OFFSET_DIR", tempfile.gettempdir())
+# Telegram picks a random next update_id after a week without updates,
+# so an older offset could hide new updates
+OFFSET_MAX_AGE = 7 * 24 * 3600
+
+WEBHOOK = "webhook"
+POLLING = "polling"
+
+# Telegram's last_error_message for a 503 (e.g. "Wrong response from the
+# webhook: 503 Service Unavailable") - the workers shedding load on purpose
+_SHED_LOAD = re.compile(r"\b503\b|Overloaded")
+
+logger = logging.getLogger(__name__)
+
+
+class OffsetStore:
+    """The next getUpdates offset, kept in a file so a restart does not replay a batch.
+
+    Telegram confirms updates only on the next getUpdates call with a higher
+    offset, so without this a process restarted mid-batch would get the
+    already dispatched updates again. The file is replaced atomically.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            if time.time() - os.path.getmtime(self.path) > OFFSET_MAX_AGE:
+                return None
+            with open(self.path) as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def save(self, offset):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(str(offset))
+        os.replace(tmp, self.path)
+
+
+class UpdatePoller:
+    """Receives updates with batched long polling and switches between webhook and polling.
+
+    ``deliver(data)`` gets every update as a decoded dict and must hand it to
+    the same dispatch path the webhook uses (dedup, admission, queue); it
+    returns False when that path is full, and the update is offered again
+    later - the offset never moves past an update that was not accepted.
+
+    Modes (:data:`UPDATE_MODE`):
+
+    * ``webhook`` - only registers the webhook, like before;
+    * ``polling`` - deletes the webhook and polls;
+    * ``auto`` - drains a large backlog with ``getUpdates`` (up to
+      :data:`POLL_LIMIT` updates per call) before the webhook is registered,
+      and falls back to polling when the webhook backlog grows or Telegram
+      reports delivery errors while it keeps growing. A 503 is not such an
+      error: the workers answer it when they are full (see ingest.py), and
+      polling would feed the same full workers.
+
+    Runs in a daemon thread of the leader process only (see leader.py).
+    """
+
+    def __init__(self, token, deliver, webhook_url=None, allowed_updates=None, mode=UPDATE_MODE,
+                 offset_store=None, secret_token=None, client=None):
+        self.deliver = deliver
+        self.webhook_url = webhook_url
+        self.allowed_updates = allowed_updates
+        self.secret_token = secret_token
+        self.mode = mode if webhook_url else POLLING
+        self.state = None
+        self.offset_store = offset_store or OffsetStore(
+            os.path.join(POLL_OFFSET_DIR, f"telegram-bot-offset-{token.split(':', 1)[0]}"))
+        self.offset = self.offset_store.load()
+        self.polled = 0
+        self.batches = 0
+        self.switches = 0
+        # getUpdates holds its connection for up to POLL_TIMEOUT seconds
+        self._client = client or BotApiClient(token, pool_size=1)
+        self._hold = POLL_MIN_SECONDS
+        self._state_since = time.monotonic()
+        self._last_pending = 0
+        self._last_check = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="update-poller", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.state is None:
+                    self._begin()
+                    if self.mode == WEBHOOK:
+                        return
+                elif self.state == WEBHOOK:
+                    self._watch_webhook()
+                else:
+                    self._poll()
+            except Exception as e:
+                logger.error("Ошибка получения апдейтов (%s): %s", self.state or "старт", e)
+                self._stop.wait(POLL_ERROR_DELAY)
+
+    def _begin(self):
+        if self.mode == WEBHOOK:
+            ensure_webhook(self._client, self.webhook_url, self.allowed_updates,
+                           secret_token=self.secret_token)
+            self.state = WEBHOOK
+            return
+        if self.mode == POLLING:
+            self._switch_to_polling("режим polling")
+            return
+        info = self._client.get_webhook_info()
+        pending = info.get("pending_update_count", 0)
+        if pending >= POLL_BACKLOG_THRESHOLD:
+            self._switch_to_polling(f"в очереди {pending} апдейтов")
+        else:
+            # getUpdates (and so the confirmation) only works without a webhook
+            self._switch_to_webhook(confirm=not info.get("url"))
+
+    def _switch_to_polling(self, reason):
+        # Without drop_pending_updates the backlog stays and is fetched by getUpdates
+        self._client.delete_webhook()
+        # The webhook failed soon after it came back: wait longer before the next try
+        if self.state == WEBHOOK and time.monotonic() - self._state_since < self._hold * 2:
+            self._hold = min(self._hold * 2, POLL_MAX_SECONDS)
+        self._set_state(POLLING)
+        logger.warning("Переходим на getUpdates: %s", reason)
+
+    def _switch_to_webhook(self, confirm=True):
+        if confirm and self.offset is not None:
+            # Confirm the last polled batch, or Telegram would send it again
+            # through the webhook; updates that arrive later go to the webhook
+            if self._fetch(timeout=0, limit=1):
+                return
+        ensure_webhook(self._client, self.webhook_url, self.allowed_updates,
+                       secret_token=self.secret_token)
+        self._last_pending = 0
+        self._last_check = time.time()
+        self._set_state(WEBHOOK)
+        logger.info("Апдейты приходят через вебхук")
+
+    def _set_state(self, state):
+        if self.state is not None and self.state != state:
+            self.switches += 1
+        self.state = state
+        self._state_since = time.monotonic()
+        metrics.POLLING_ACTIVE.set(1 if state == POLLING else 0)
+
+    def _watch_webhook(self):
+        if self._stop.wait(WEBHOOK_CHECK_INTERVAL):
+            return
+        info = self._client.get_webhook_info()
+        pending = info.get("pending_update_count", 0)
+        error = info.get("last_error_message") or ""
+        failing = (info.get("last_error_date", 0) > self._last_check and pending > self._last_pending
+                   and not _SHED_LOAD.search(error))
+        self._last_pending = pending
+        self._last_check = time.time()
+        if pending >= POLL_BACKLOG_THRESHOLD:
+            self._switch_to_polling(f"в очереди вебхука {pending} апдейтов")
+        elif failing:
+            self._switch_to_polling(f"ошибка доставки: {error}")
+        elif time.monotonic() - self._state_since >= self._hold * 2:
+            self._hold = POLL_MIN_SECONDS
+
+    def _poll(self):
+        timeout = POLL_TIMEOUT
+        if self.mode == "auto":
+            remaining = self._hold - (time.monotonic() - self._state_since)
+            timeout = max(0, min(POLL_TIMEOUT, int(remaining) + 1))
+        try:
+            fetched = self._fetch(timeout, POLL_LIMIT)
+        except BotApiError as e:
+            if e.error_code != 409:
+                raise
+            # Somebody set a webhook (setup_webhook.py, another instance)
+            if self.mode == "auto":
+                logger.warning("Вебхук установлен извне, getUpdates остановлен")
+                self._set_state(WEBHOOK)
+            else:
+                logger.warning("Вебхук установлен извне, удаляем его (UPDATE_MODE=polling)")
+                self._client.delete_webhook()
+            return
+        # A short batch means the backlog is drained
+        if (self.mode == "auto" and fetched < POLL_LIMIT
+                and time.monotonic() - self._state_since >= self._hold):
+            self._switch_to_webhook()
+
+    def _fetch(self, timeout, limit):
+        """One getUpdates call; delivers the updates and returns how many came."""
+        params = {"limit": limit, "timeout": timeout}
+        if self.offset is not None:
+            params["offset"] = self.offset
+        if self.allowed_updates is not None:
+            params["allowed_updates"] = self.allowed_updates
+        updates = self._client.call("getUpdates", params, timeout=(CONNECT_TIMEOUT, timeout + 10))
+        if not updates:
+            return 0
+        self.batches += 1
+        delivered = 0
+        for data in updates:
+            if not self.deliver(data):
+                break
+            delivered += 1
+            self.offset = data["update_id"] + 1
+        if delivered:
+            self.polled += delivered
+            metrics.POLLED_UPDATES.inc(delivered)
+            self.offset_store.save(self.offset)
+        if delivered < len(updates):
+            logger.warning("Очередь апдейтов заполнена, принято %d из %d", delivered, len(updates))
+            self._stop.wait(POLL_OVERLOAD_DELAY)
+        return len(updates)
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "state": self.state,
+            "offset": self.offset,
+            "polled": self.polled,
+            "batches": self.batches,
+            "switches": self.switches,
+        }
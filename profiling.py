@@ -0,0 +1,424 @@
+import os
+import re
+import sys
+import time
+import hmac
+import asyncio
+import inspect
+import logging
+import functools
+import threading
+import contextvars
+from collections import Counter, OrderedDict
+import codec
+import metrics
+import log_setup
+
+# Secret for the /debug/* endpoints, sent in X-Profile-Token; while unset they answer 404
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+# Sampling period of /debug/profile (seconds)
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.01"))
+# Longest profile one request may ask for (seconds); keep it under gunicorn's timeout
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "30"))
+# Record the stages of every webhook update (decode, de_json, handler, outbound
+# sends). Read once at import: when off, no hook is installed at all
+TRACE_UPDATES = os.getenv("TRACE_UPDATES", "0") == "1"
+# Traced updates kept for /debug/traces
+TRACE_KEEP = int(os.getenv("TRACE_KEEP", "200"))
+
+TOKEN_HEADER = "X-Profile-Token"
+TEXT = "text/plain; charset=utf-8"
+JSON = "application/json"
+# Deepest stack recorded per sample
+MAX_DEPTH = 128
+# Innermost frames of a thread or task that is only waiting for work
+# (file, function); such samples are dropped unless idle=1
+IDLE_FRAMES = frozenset({
+    ("selectors.py", "select"),
+    ("socket.py", "accept"),
+    ("thread.py", "_worker"),
+    ("queue.py", "get"),
+    ("queues.py", "get"),
+    ("handlers.py", "dequeue"),
+})
+
+logger = logging.getLogger(__name__)
+
+_TOKEN = PROFILE_TOKEN.encode()
+_current = contextvars.ContextVar("update_trace", default=None)
+_running = threading.Lock()
+
+
+def authorize(headers):
+    """None if the request may use the /debug endpoints, otherwise ``(text, status)``.
+
+    404 while :data:`PROFILE_TOKEN` is unset, so the endpoints do not exist;
+    403 for a missing or wrong token (compared in constant time).
+    """
+    if not _TOKEN:
+        return "Not Found", 404
+    if not hmac.compare_digest(headers.get(TOKEN_HEADER, "").encode(), _TOKEN):
+        return "Forbidden", 403
+    return None
+
+
+def _label(name):
+    # Thread and task names differ only by a counter; one name per kind of worker
+    return re.sub(r"\d+", "N", name).replace(";", ":")
+
+
+def _key(code):
+    return code.co_qualname, code.co_filename, code.co_firstlineno
+
+
+def _thread_stack(frame):
+    stack = []
+    while frame is not None and len(stack) < MAX_DEPTH:
+        stack.append(_key(frame.f_code))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def _waits_for_work(key):
+    name, filename, _ = key
+    return (os.path.basename(filename), name.rpartition(".")[2]) in IDLE_FRAMES
+
+
+def _is_idle(stack):
+    if not stack:
+        return True
+    if _waits_for_work(stack[-1]):
+        return True
+    # queue.Queue.get() blocks in threading.Condition.wait()
+    return stack[-1][0] == "Condition.wait" and len(stack) > 1 and _waits_for_work(stack[-2])
+
+
+def _task_stack(task):
+    # Task.get_stack() stops at the outermost coroutine of a suspended task;
+    # follow what each coroutine awaits down to the innermost one
+    stack = []
+    coro = task.get_coro()
+    while coro is not None and len(stack) < MAX_DEPTH:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        stack.append(_key(frame.f_code))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return stack
+
+
+def _tasks(loop):
+    try:
+        return asyncio.all_tasks(loop)
+    except RuntimeError:
+        # The set of tasks changed under us; the next sample will see it
+        return ()
+
+
+class Profile:
+    """Stacks sampled from every thread of the process and every task of its event loops.
+
+    Each sample takes the current frame of all threads
+    (:func:`sys._current_frames`) - the web server's request threads, the bot
+    loop thread, pollers - and the coroutine stack of every pending task on
+    the loops registered with :func:`metrics.watch_loop`, so handlers waiting
+    on the Bot API or the rate limiter show up as well. This is wall-clock
+    time: a thread blocked in a call counts like one running it. Threads and
+    tasks that are only waiting for work are left out unless ``idle`` is set.
+    Task stacks are read from another thread, so now and then one is a frame
+    out of date; that is noise in a sampling profile.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL, idle=False):
+        self.interval = interval
+        self.idle = idle
+        self.samples = 0
+        self.duration = 0.0
+        self.stacks = Counter()
+
+    def run(self, seconds):
+        """Sample for ``seconds``, blocking the calling thread."""
+        me = threading.get_ident()
+        started = time.perf_counter()
+        deadline = started + seconds
+        while True:
+            self.sample(skip=me)
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            time.sleep(min(self.interval, remaining))
+        self.duration = time.perf_counter() - started
+        return self
+
+    def sample(self, skip=None):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident != skip:
+                self._add(_label(names.get(ident, "thread")), _thread_stack(frame))
+        for loop in metrics.watched_loops():
+            for task in _tasks(loop):
+                self._add("task " + _label(task.get_name()), _task_stack(task))
+        self.samples += 1
+
+    def _add(self, root, stack):
+        if self.idle or not _is_idle(stack):
+            self.stacks[(root, *stack)] += 1
+
+    def collapsed(self):
+        """Brendan Gregg's collapsed stacks, one ``root;outer;...;inner count`` per line.
+
+        Read by flamegraph.pl, speedscope and most flame graph viewers.
+        """
+        lines = []
+        for (root, *stack), count in self.stacks.most_common():
+            frames = [f"{name} ({os.path.basename(filename)}:{line})" for name, filename, line in stack]
+            lines.append(";".join([root, *frames]) + f" {count}")
+        return "\n".join(lines) + "\n"
+
+    def speedscope(self):
+        """The profile in speedscope's file format, one sampled profile per thread or task kind."""
+        frames = {}
+        profiles = {}
+        for (root, *stack), count in self.stacks.most_common():
+            profile = profiles.setdefault(root, {
+                "type": "sampled", "name": root, "unit": "seconds",
+                "startValue": 0, "endValue": 0, "samples": [], "weights": [],
+            })
+            profile["samples"].append([frames.setdefault(key, len(frames)) for key in stack])
+            profile["weights"].append(count * self.interval)
+            profile["endValue"] += count * self.interval
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": f"pid {os.getpid()}, {self.duration:.1f} s, {self.samples} samples",
+            "exporter": "profiling.py",
+            "activeProfileIndex": 0,
+            "shared": {"frames": [{"name": name, "file": filename, "line": line}
+                                  for name, filename, line in frames]},
+            "profiles": list(profiles.values()),
+        }
+
+
+def profile(seconds, interval=PROFILE_INTERVAL, idle=False):
+    """Sample this process for ``seconds``; None if another profile is running."""
+    if not _running.acquire(blocking=False):
+        return None
+    try:
+        return Profile(interval, idle).run(seconds)
+    finally:
+        _running.release()
+
+
+def profile_response(headers, args):
+    """Serve ``/debug/profile``: ``(body, status, content type)``.
+
+    Query: ``seconds`` (5 by default, at most :data:`PROFILE_MAX_SECONDS`),
+    ``format`` - ``collapsed`` (text) or ``speedscope`` (JSON) - ``interval``
+    and ``idle=1``. Blocks the calling thread while sampling; with several
+    workers it profiles the one that got the request.
+    """
+    denied = authorize(headers)
+    if denied:
+        return denied[0].encode(), denied[1], TEXT
+    fmt = args.get("format", "collapsed")
+    try:
+        seconds = min(max(float(args.get("seconds", 5)), 0.0), PROFILE_MAX_SECONDS)
+        interval = max(float(args.get("interval", PROFILE_INTERVAL)), 0.001)
+    except ValueError:
+        return b"Bad Request", 400, TEXT
+    if fmt not in ("collapsed", "speedscope"):
+        return b"Bad Request", 400, TEXT
+    logger.info("Профилирование процесса на %.1f с", seconds)
+    result = profile(seconds, interval, args.get("idle") == "1")
+    if result is None:
+        return b"Profile already running", 409, TEXT
+    if fmt == "speedscope":
+        return codec.dumps(result.speedscope()), 200, JSON
+    return result.collapsed().encode(), 200, TEXT
+
+
+def log_level_response(headers, args, method="GET"):
+    """Serve ``/debug/log_level``: the root log level; ``POST ?level=DEBUG`` changes it.
+
+    Like the rest of /debug it acts on the process that got the request;
+    with several workers each one has its own level.
+    """
+    denied = authorize(headers)
+    if denied:
+        return denied[0].encode(), denied[1], TEXT
+    if method == "POST":
+        level = args.get("level", "").upper()
+        if not isinstance(logging.getLevelName(level), int):
+            return b"Bad Request", 400, TEXT
+        log_setup.set_level(level)
+        logger.warning("Уровень логов изменён на %s", level)
+    return logging.getLevelName(logging.getLogger().level).encode(), 200, TEXT
+
+
+class UpdateTrace:
+    """Stage timings of one update, in milliseconds from the moment its webhook arrived."""
+
+    __slots__ = ("update_id", "started", "total", "spans", "_start")
+
+    def __init__(self):
+        self.update_id = None
+        self.started = time.time()
+        self.total = None
+        self.spans = []
+        self._start = time.perf_counter()
+
+    def add(self, name, seconds):
+        """Record a stage of ``seconds`` that has just ended."""
+        start = time.perf_counter() - seconds - self._start
+        self.spans.append((name, start, seconds, threading.current_thread().name))
+
+    def finish(self):
+        self.total = time.perf_counter() - self._start
+
+    def as_dict(self):
+        return {
+            "update_id": self.update_id,
+            "started": self.started,
+            "total_ms": None if self.total is None else round(self.total * 1000, 3),
+            "spans": [{"name": name, "start_ms": round(start * 1000, 3), "ms": round(seconds * 1000, 3),
+                       "thread": thread}
+                      for name, start, seconds, thread in sorted(self.spans, key=lambda span: span[1])],
+        }
+
+
+class Tracer:
+    """The last ``keep`` traced updates, by update_id.
+
+    The webhook thread starts a trace; once the body is decoded the trace is
+    kept here, so a handler running later on the bot loop finds it by its
+    update's id and adds its own spans and those of its Bot API calls.
+    """
+
+    def __init__(self, keep=TRACE_KEEP):
+        self.keep = keep
+        self.traces = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, trace, update_id):
+        trace.update_id = update_id
+        with self._lock:
+            self.traces[update_id] = trace
+            self.traces.move_to_end(update_id)
+            while len(self.traces) > self.keep:
+                self.traces.popitem(last=False)
+
+    def find(self, update_id):
+        return self.traces.get(update_id)
+
+    def recent(self, limit=None):
+        """Traces as dicts, newest first."""
+        with self._lock:
+            traces = list(reversed(self.traces.values()))
+        return [trace.as_dict() for trace in traces[:limit]]
+
+
+tracer = Tracer()
+
+
+def traces_response(headers, args):
+    """Serve ``/debug/traces``: the last traced updates as JSON (``limit``, 50 by default)."""
+    denied = authorize(headers)
+    if denied:
+        return denied[0].encode(), denied[1], TEXT
+    try:
+        limit = int(args.get("limit", 50))
+    except ValueError:
+        return b"Bad Request", 400, TEXT
+    return codec.dumps({"enabled": TRACE_UPDATES, "traces": tracer.recent(limit)}), 200, JSON
+
+
+def trace_webhook(view):
+    """Decorate a webhook view (sync or async) to trace the update it receives.
+
+    Returns ``view`` itself unless TRACE_UPDATES=1, so tracing costs nothing
+    when it is off.
+    """
+    if not TRACE_UPDATES:
+        return view
+    if inspect.iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def wrapper(*args, **kwargs):
+            trace = UpdateTrace()
+            token = _current.set(trace)
+            try:
+                return await view(*args, **kwargs)
+            finally:
+                trace.finish()
+                _current.reset(token)
+    else:
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            trace = UpdateTrace()
+            token = _current.set(trace)
+            try:
+                return view(*args, **kwargs)
+            finally:
+                trace.finish()
+                _current.reset(token)
+    return wrapper
+
+
+def trace_handler(handler):
+    """Decorate a python-telegram-bot handler to add a ``handler:<name>`` span to its update's trace.
+
+    The trace is the current one when the handler runs in the webhook's
+    context, otherwise the one kept for ``update.update_id``; the handler's
+    Bot API calls are recorded into it too. Returns ``handler`` itself
+    unless TRACE_UPDATES=1.
+    """
+    if not TRACE_UPDATES:
+        return handler
+    name = "handler:" + handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(update, *args, **kwargs):
+        trace = _current.get() or tracer.find(getattr(update, "update_id", None))
+        if trace is None:
+            return await handler(update, *args, **kwargs)
+        token = _current.set(trace)
+        start = time.perf_counter()
+        try:
+            return await handler(update, *args, **kwargs)
+        finally:
+            trace.add(name, time.perf_counter() - start)
+            _current.reset(token)
+    return wrapper
+
+
+def _on_decode(result, seconds):
+    trace = _current.get()
+    # Only the webhook body: later loads() in the same context are Bot API responses
+    if trace is None or trace.update_id is not None:
+        return
+    trace.add("decode", seconds)
+    if isinstance(result, dict) and "update_id" in result:
+        tracer.register(trace, result["update_id"])
+
+
+def _on_stage(stage, seconds):
+    trace = _current.get()
+    # The decode span comes from _on_decode, together with the update_id
+    if trace is not None and stage != "decode":
+        trace.add(stage, seconds)
+
+
+def _on_outbound(method, status, seconds):
+    trace = _current.get()
+    if trace is not None:
+        trace.add(f"send:{method} ({status})", seconds)
+
+
+def _install():
+    codec.add_decode_observer(_on_decode)
+    metrics.add_stage_observer(_on_stage)
+    metrics.add_outbound_observer(_on_outbound)
+    logger.info("Трассировка апдейтов включена (TRACE_UPDATES=1)")
+
+
+if TRACE_UPDATES:
+    _install()
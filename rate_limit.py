@@ -0,0 +1,329 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from telegram._utils.defaultvalue import DefaultValue
+from telegram.error import (RetryAfter, BadRequest, Forbidden, InvalidToken, TimedOut, NetworkError,
+                            TelegramError)
+from telegram.ext import BaseRateLimiter
+import metrics
+import inline_reply
+from resilience import bot_api_breaker, timeout_for, retry_delay, CircuitOpenError
+
+# Telegram limits: ~30 messages/s overall, ~1 message/s per private chat,
+# 20 messages/min per group
+GLOBAL_RATE = float(os.getenv("RATE_LIMIT_GLOBAL", "30"))
+GLOBAL_BURST = int(os.getenv("RATE_LIMIT_GLOBAL_BURST", "30"))
+CHAT_RATE = float(os.getenv("RATE_LIMIT_PER_CHAT", "1"))
+CHAT_BURST = int(os.getenv("RATE_LIMIT_CHAT_BURST", "3"))
+GROUP_RATE = float(os.getenv("RATE_LIMIT_PER_GROUP_MINUTE", "20")) / 60
+GROUP_BURST = int(os.getenv("RATE_LIMIT_GROUP_BURST", "3"))
+# How many times a request is retried after a 429 answer
+MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "3"))
+# Number of per-chat buckets kept; the least recently used are dropped
+MAX_TRACKED_CHATS = int(os.getenv("RATE_LIMIT_MAX_CHATS", "10000"))
+# Longest a thread sleeps for a send slot (seconds); a longer wait raises RateLimited
+MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "1"))
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimited(Exception):
+    """Raised when a send would have to wait longer than the limiter allows."""
+
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super().__init__(f"Rate limited: next send slot in {retry_after:.2f} s")
+
+
+class TokenBucket:
+    """Token bucket in virtual-scheduling form (GCRA).
+
+    Instead of counting tokens it tracks the theoretical arrival time of the
+    next request, so :meth:`reserve` can return how long a caller has to wait
+    and book its slot in one step. Not thread-safe on its own.
+    """
+
+    __slots__ = ("interval", "tolerance", "tat")
+
+    def __init__(self, rate, burst=1):
+        self.interval = 1.0 / rate
+        self.tolerance = self.interval * (max(1, burst) - 1)
+        self.tat = 0.0
+
+    def delay(self, now):
+        """How long a request arriving at ``now`` would wait, without booking it."""
+        return max(0.0, max(self.tat, now) - self.tolerance - now)
+
+    def reserve(self, now):
+        """Book the next slot at or after ``now``; returns the delay in seconds."""
+        tat = max(self.tat, now)
+        send_at = max(now, tat - self.tolerance)
+        self.tat = tat + self.interval
+        return send_at - now
+
+    def pause_until(self, until):
+        """Make sure nothing is scheduled before ``until``."""
+        self.tat = max(self.tat, until + self.tolerance)
+
+
+class OutboundLimiter:
+    """Schedules outgoing sends against a global and a per-chat bucket.
+
+    Thread-safe; used both by the synchronous :class:`bot_api.BotApiClient`
+    and, through :class:`PTBRateLimiter`, by python-telegram-bot.
+
+    The buckets live in the process. :meth:`share` splits the global rate
+    between gunicorn workers, but the per-chat buckets are per process: a
+    chat whose updates land on several workers may get up to that many
+    times its per-chat rate, and Telegram's 429 answers (see :meth:`pause`)
+    are what holds it back then.
+    """
+
+    def __init__(self, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST,
+                 chat_rate=CHAT_RATE, chat_burst=CHAT_BURST,
+                 group_rate=GROUP_RATE, group_burst=GROUP_BURST,
+                 max_chats=MAX_TRACKED_CHATS, max_wait=MAX_WAIT):
+        self._global_params = (global_rate, global_burst)
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chat_params = (chat_rate, chat_burst)
+        self._group_params = (group_rate, group_burst)
+        self._chats = OrderedDict()
+        self._max_chats = max_chats
+        self._lock = threading.Lock()
+        self.max_wait = max_wait
+        self.sends = 0
+        self.delayed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.retries = 0
+        self.rate_limited = 0
+        # Sends currently sleeping for a slot: the outbound backlog
+        self.waiting = 0
+
+    def share(self, parts):
+        """Keep 1/``parts`` of the global rate, for ``parts`` processes sending as one bot."""
+        rate, burst = self._global_params
+        with self._lock:
+            self._global = TokenBucket(rate / parts, max(1, burst // parts))
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            is_group = not isinstance(chat_id, int) or chat_id < 0
+            bucket = TokenBucket(*(self._group_params if is_group else self._chat_params))
+            self._chats[chat_id] = bucket
+            if len(self._chats) > self._max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    def _reserve(self, chat_id=None, max_wait=None):
+        """Book a slot in the chat's bucket, or the global one if chat_id is None.
+
+        With ``max_wait``, a slot further away than that is not booked and
+        :class:`RateLimited` is raised instead.
+        """
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._global if chat_id is None else self._chat_bucket(chat_id)
+            if max_wait is not None:
+                delay = bucket.delay(now)
+                if delay > max_wait:
+                    self.rate_limited += 1
+                    raise RateLimited(delay)
+            return bucket.reserve(now)
+
+    def _record(self, waited):
+        with self._lock:
+            self.sends += 1
+            if waited > 0:
+                self.delayed += 1
+                self.total_wait += waited
+                self.max_wait = max(self.max_wait, waited)
+
+    def pause(self, seconds, chat_id=None):
+        """Hold back sends after a 429 with ``retry_after``."""
+        until = time.monotonic() + seconds
+        with self._lock:
+            self.retries += 1
+            if chat_id is not None:
+                self._chat_bucket(chat_id).pause_until(until)
+            else:
+                self._global.pause_until(until)
+        logger.warning("Превышен лимит Telegram, повтор через %s с", seconds)
+
+    def acquire(self, chat_id=None):
+        """Block the calling thread until a send slot is available.
+
+        The chat slot is waited for before the global one is booked, so one busy
+        chat never books global slots ahead and holds back everyone else. A
+        wait longer than :attr:`max_wait` raises :class:`RateLimited` instead:
+        in a web server the caller is a request thread, and a busy chat must
+        not put all of them to sleep.
+        """
+        waited = 0.0
+        if chat_id is not None:
+            delay = self._reserve(chat_id, self.max_wait)
+            if delay > 0:
+                self._wait(delay)
+                waited += delay
+        delay = self._reserve(max_wait=self.max_wait)
+        if delay > 0:
+            self._wait(delay)
+            waited += delay
+        self._record(waited)
+        return waited
+
+    def _wait(self, delay):
+        with self._lock:
+            self.waiting += 1
+        try:
+            time.sleep(delay)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    async def acquire_async(self, chat_id=None):
+        """Like :meth:`acquire`, but waits on the event loop and without a limit."""
+        waited = 0.0
+        if chat_id is not None:
+            delay = self._reserve(chat_id)
+            if delay > 0:
+                await self._wait_async(delay)
+                waited += delay
+        delay = self._reserve()
+        if delay > 0:
+            await self._wait_async(delay)
+            waited += delay
+        self._record(waited)
+        return waited
+
+    async def _wait_async(self, delay):
+        with self._lock:
+            self.waiting += 1
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def stats(self):
+        return {
+            "sends": self.sends,
+            "delayed": self.delayed,
+            "avg_wait": self.total_wait / self.sends if self.sends else 0.0,
+            "max_wait": self.max_wait,
+            "retries_429": self.retries,
+            "rate_limited": self.rate_limited,
+            "waiting": self.waiting,
+            "tracked_chats": len(self._chats),
+        }
+
+
+# Shared by every client in the process: Telegram's limits are per bot, not per client
+outbound_limiter = OutboundLimiter()
+
+
+class PTBRateLimiter(BaseRateLimiter):
+    """python-telegram-bot adapter for :class:`OutboundLimiter`.
+
+    Requests carrying a ``chat_id`` wait for their slot; a ``RetryAfter``
+    answer pauses the chat's bucket and the request is retried up to
+    ``max_retries`` times. It is also where python-telegram-bot's calls get
+    the resilience layer of :class:`bot_api.BotApiClient`: per-method read
+    timeouts, retries of idempotent methods and the shared circuit breaker.
+    """
+
+    def __init__(self, limiter=outbound_limiter, max_retries=MAX_RETRIES, breaker=bot_api_breaker):
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.breaker = breaker
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if isinstance(kwargs.get("read_timeout"), DefaultValue):
+            kwargs = {**kwargs, "read_timeout": timeout_for(endpoint)}
+        for attempt in range(self.max_retries + 1):
+            if chat_id is not None:
+                await self.limiter.acquire_async(chat_id)
+            if attempt == 0:
+                # Goes out in the webhook response instead (INLINE_REPLIES=1)
+                inlined = inline_reply.capture_ptb(endpoint, data)
+                if inlined is not None:
+                    return inlined
+            try:
+                return await self._guarded(endpoint, callback, args, kwargs)
+            except RetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                self.limiter.pause(e.retry_after, chat_id)
+                if chat_id is None:
+                    await asyncio.sleep(e.retry_after)
+
+    async def _guarded(self, endpoint, callback, args, kwargs):
+        """The call behind the circuit breaker, with retries of idempotent methods."""
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                metrics.observe_outbound(endpoint, "circuit_open", 0)
+                raise NetworkError(str(CircuitOpenError(self.breaker)))
+            try:
+                result = await self._timed(endpoint, callback, args, kwargs)
+            except BadRequest:
+                self.breaker.success()
+                raise
+            except NetworkError as e:
+                # TimedOut, connection errors and 5xx answers
+                self.breaker.failure()
+                delay = retry_delay(endpoint, attempt)
+                if delay is None:
+                    raise
+                logger.warning("%s не удался (%s), повтор через %.2f с", endpoint, e, delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+            except TelegramError:
+                # The API answered (429, 403, ...): it is up
+                self.breaker.success()
+                raise
+            else:
+                self.breaker.success()
+                return result
+
+    @staticmethod
+    async def _timed(endpoint, callback, args, kwargs):
+        start = time.perf_counter()
+        status = 200
+        try:
+            return await callback(*args, **kwargs)
+        except Exception as e:
+            status = _status_of(e)
+            raise
+        finally:
+            metrics.observe_outbound(endpoint, status, time.perf_counter() - start)
+
+
+def _status_of(error):
+    """HTTP status (or error kind) behind a python-telegram-bot exception."""
+    if isinstance(error, RetryAfter):
+        return 429
+    if isinstance(error, BadRequest):
+        return 400
+    if isinstance(error, InvalidToken):
+        return 401
+    if isinstance(error, Forbidden):
+        return 403
+    if isinstance(error, TimedOut):
+        return "timeout"
+    if isinstance(error, NetworkError):
+        return "network"
+    return "error"
@@ -0,0 +1,149 @@
+import os
+import sys
+import time
+import logging
+import threading
+import metrics
+
+# How often the monitor samples the load (seconds)
+READY_CHECK_INTERVAL = float(os.getenv("READY_CHECK_INTERVAL", "0.5"))
+# Thresholds past which /ready answers 503; 0 turns a check off.
+# Event loop (or, without one, monitor thread) scheduling lag, seconds
+READY_MAX_LOOP_LAG = float(os.getenv("READY_MAX_LOOP_LAG", "0.5"))
+# Webhook requests being handled at once
+READY_MAX_IN_FLIGHT = int(os.getenv("READY_MAX_IN_FLIGHT", "64"))
+# Updates admitted but not processed; by default the IngestStage high-water mark
+READY_MAX_INGEST_DEPTH = int(os.getenv("READY_MAX_INGEST_DEPTH", "0") or 0)
+# Outbound sends waiting for a rate limiter slot
+READY_MAX_OUTBOUND_BACKLOG = int(os.getenv("READY_MAX_OUTBOUND_BACKLOG", "200"))
+# Live threads in the process
+READY_MAX_THREADS = int(os.getenv("READY_MAX_THREADS", "500"))
+
+logger = logging.getLogger(__name__)
+
+
+class LoadMonitor:
+    """Samples the load of the process and decides whether it should get traffic.
+
+    A daemon thread measures, every ``interval`` seconds: the scheduling lag
+    of the bot's event loop (a callback posted to the loop; while it has not
+    run the lag keeps growing, so a blocked loop is seen too), or of the
+    monitor thread itself in servers without a loop; in-flight webhook
+    requests; the depth of the :class:`ingest.IngestStage`; sends waiting in
+    :data:`rate_limit.outbound_limiter`; and the thread count.
+
+    :attr:`overloaded` is the list of values past their threshold, so
+    ``/ready`` (:meth:`not_ready`) only reads attributes. The load balancer
+    stops sending traffic while it is not empty - before latency blows up -
+    and ``/health`` stays a plain liveness probe.
+    """
+
+    def __init__(self, interval=READY_CHECK_INTERVAL, max_loop_lag=READY_MAX_LOOP_LAG,
+                 max_in_flight=READY_MAX_IN_FLIGHT, max_ingest_depth=READY_MAX_INGEST_DEPTH,
+                 max_outbound_backlog=READY_MAX_OUTBOUND_BACKLOG, max_threads=READY_MAX_THREADS):
+        self.interval = interval
+        self.max_loop_lag = max_loop_lag
+        self.max_in_flight = max_in_flight
+        self.max_ingest_depth = max_ingest_depth
+        self.max_outbound_backlog = max_outbound_backlog
+        self.max_threads = max_threads
+        self.ingest = None
+        self.loop = None
+        self.warm = None
+        self.overloaded = []
+        self.sample = {}
+        self.unready_since = None
+        self._probe_sent = None
+        self._probe_lag = 0.0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self, ingest=None, loop=None, warm=None):
+        """Start sampling (once per process).
+
+        ``loop`` is the event loop updates run on, ``warm()`` tells whether
+        the warm-up is done (see warmup.py); until :meth:`start` the process
+        is not ready.
+        """
+        with self._lock:
+            self.ingest = ingest or self.ingest
+            self.loop = loop or self.loop
+            self.warm = warm or self.warm
+            if self.ingest is not None and not self.max_ingest_depth:
+                self.max_ingest_depth = self.ingest.high_water
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="load-monitor", daemon=True)
+                self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            started = time.monotonic()
+            time.sleep(self.interval)
+            try:
+                self._check(time.monotonic() - started - self.interval)
+            except Exception as e:
+                logger.error("Ошибка монитора нагрузки: %s", e)
+
+    def _loop_lag(self, thread_lag):
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            return thread_lag
+        now = time.monotonic()
+        if self._probe_sent is not None:
+            # The last probe has not run yet: the loop is at least this late
+            return now - self._probe_sent
+        self._probe_sent = now
+        loop.call_soon_threadsafe(self._probe_done)
+        return self._probe_lag
+
+    def _probe_done(self):
+        self._probe_lag = time.monotonic() - self._probe_sent
+        self._probe_sent = None
+
+    def _check(self, thread_lag):
+        rate_limit = sys.modules.get("rate_limit")
+        sample = {
+            "loop_lag": round(self._loop_lag(thread_lag), 4),
+            "in_flight": int(metrics.IN_FLIGHT_REQUESTS.get()),
+            "ingest_depth": self.ingest.depth if self.ingest is not None else 0,
+            "outbound_backlog": rate_limit.outbound_limiter.waiting if rate_limit is not None else 0,
+            "threads": threading.active_count(),
+        }
+        limits = {
+            "loop_lag": self.max_loop_lag,
+            "in_flight": self.max_in_flight,
+            "ingest_depth": self.max_ingest_depth,
+            "outbound_backlog": self.max_outbound_backlog,
+            "threads": self.max_threads,
+        }
+        overloaded = [f"{name}={value}" for name, value in sample.items()
+                      if limits[name] and value >= limits[name]]
+        if overloaded and not self.overloaded:
+            self.unready_since = time.time()
+            logger.warning("Воркер перегружен, /ready отвечает 503: %s", ", ".join(overloaded))
+        elif self.overloaded and not overloaded:
+            logger.info("Нагрузка снизилась, /ready снова отвечает 200")
+            self.unready_since = None
+        self.sample = sample
+        self.overloaded = overloaded
+        metrics.READY.set(0 if self.not_ready() else 1)
+
+    def not_ready(self):
+        """Why ``/ready`` should answer 503, or None."""
+        if self._thread is None or (self.warm is not None and not self.warm()):
+            return "Warming up"
+        if self.overloaded:
+            return "Overloaded: " + ", ".join(self.overloaded)
+        return None
+
+    def stats(self):
+        return {
+            "overloaded": self.overloaded,
+            "unready_since": self.unready_since,
+            "sample": self.sample,
+        }
+
+
+# One per process, started by the server's bootstrap
+monitor = LoadMonitor()
@@ -0,0 +1,192 @@
+import os
+import time
+import random
+import logging
+import threading
+import metrics
+
+# Read timeout of a Bot API call when the method has no entry below (seconds)
+DEFAULT_TIMEOUT = float(os.getenv("BOT_API_READ_TIMEOUT", "10"))
+# Read timeouts per method; quick replies give up sooner than uploads.
+# Overridden with BOT_API_METHOD_TIMEOUTS="sendMessage=5,sendPhoto=60"
+METHOD_TIMEOUTS = {
+    "answerCallbackQuery": 5.0,
+    "sendChatAction": 5.0,
+    "getMe": 5.0,
+    "getWebhookInfo": 5.0,
+    "sendMessage": 10.0,
+    "editMessageText": 10.0,
+    "setWebhook": 15.0,
+    "deleteWebhook": 15.0,
+    "sendPhoto": 30.0,
+    "sendDocument": 60.0,
+    "sendVideo": 60.0,
+    "sendAudio": 60.0,
+    "sendMediaGroup": 60.0,
+}
+for _item in filter(None, os.getenv("BOT_API_METHOD_TIMEOUTS", "").split(",")):
+    _method, _, _seconds = _item.partition("=")
+    METHOD_TIMEOUTS[_method.strip()] = float(_seconds)
+
+# Methods that can be repeated without a visible effect, besides every get*.
+# Anything else (sendMessage above all) is never retried after a timeout or a
+# 5xx: Telegram may have executed it, and a retry would send it twice
+IDEMPOTENT_METHODS = frozenset({
+    "setWebhook", "deleteWebhook", "setMyCommands", "deleteMyCommands",
+    "setMyName", "setMyDescription", "setMyShortDescription", "setChatMenuButton",
+    "sendChatAction", "editMessageText", "editMessageCaption", "editMessageReplyMarkup",
+})
+# Retries of an idempotent call after a timeout, a network error or a 5xx
+RETRY_ATTEMPTS = int(os.getenv("BOT_API_RETRIES", "2"))
+# Backoff before retry n is random in [0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**n)]
+RETRY_BASE_DELAY = float(os.getenv("BOT_API_RETRY_BASE_DELAY", "0.25"))
+RETRY_MAX_DELAY = float(os.getenv("BOT_API_RETRY_MAX_DELAY", "4"))
+# Consecutive failed calls that open the circuit breaker
+BREAKER_FAILURES = int(os.getenv("BOT_API_BREAKER_FAILURES", "5"))
+# How long an open breaker fails calls fast before one probe call is let through (seconds)
+BREAKER_RESET = float(os.getenv("BOT_API_BREAKER_RESET", "30"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+logger = logging.getLogger(__name__)
+
+
+def timeout_for(method, default=DEFAULT_TIMEOUT):
+    """Read timeout of ``method`` in seconds."""
+    return METHOD_TIMEOUTS.get(method, default)
+
+
+def is_idempotent(method):
+    return method.startswith("get") or method in IDEMPOTENT_METHODS
+
+
+def backoff(attempt):
+    """Delay before retry ``attempt`` (0-based): exponential with full jitter.
+
+    The jitter spreads the retries of many workers that failed at the same
+    moment, so they do not hit a recovering API all at once.
+    """
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def retry_delay(method, attempt):
+    """Seconds to wait before retrying a failed ``method`` call, or None to give up.
+
+    Only for failures that say nothing about whether the call was executed
+    (timeouts, network errors, 5xx) - the caller decides which those are.
+    """
+    if attempt >= RETRY_ATTEMPTS or not is_idempotent(method):
+        return None
+    metrics.BOT_API_RETRIES.labels(method).inc()
+    return backoff(attempt)
+
+
+class CircuitOpenError(Exception):
+    """The breaker is open: the call was not attempted."""
+
+    def __init__(self, breaker):
+        self.retry_in = breaker.retry_in()
+        super().__init__(f"Circuit open: Bot API is failing, next try in {self.retry_in:.0f} s")
+
+
+class CircuitBreaker:
+    """Fails calls fast while the remote API keeps failing.
+
+    ``closed``: calls go through; ``failures`` consecutive failures (timeouts,
+    network errors, 5xx - not 4xx or 429, which are the API working) open the
+    breaker. ``open``: :meth:`allow` refuses every call for ``reset`` seconds,
+    so handlers do not pile up on timeouts. ``half_open``: one probe call is
+    let through; its success closes the breaker, its failure opens it again.
+
+    Thread-safe and never blocks, so the asyncio clients use it as well.
+    A call let through by :meth:`allow` should end in :meth:`success` or
+    :meth:`failure`; a probe that never reports (a cancelled task) is
+    replaced by a new one after ``reset`` seconds.
+    """
+
+    def __init__(self, name, failures=BREAKER_FAILURES, reset=BREAKER_RESET):
+        self.name = name
+        self.failures = failures
+        self.reset = reset
+        self.state = CLOSED
+        self.consecutive = 0
+        self.opened = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._probe_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """True if a call may go out now."""
+        if self.state == CLOSED:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            if self.state == OPEN and now - self._opened_at >= self.reset:
+                self.state = HALF_OPEN
+                self._probe_at = None
+            if self.state == HALF_OPEN and (self._probe_at is None or now - self._probe_at >= self.reset):
+                self._probe_at = now
+                return True
+            if self.state == CLOSED:
+                return True
+            self.rejected += 1
+            return False
+
+    def success(self):
+        if self.state == CLOSED and not self.consecutive:
+            return
+        with self._lock:
+            if self.state != CLOSED:
+                logger.info("Bot API снова отвечает, автомат %s замкнут", self.name)
+                metrics.BOT_API_CIRCUIT_OPEN.set(0)
+            self.state = CLOSED
+            self.consecutive = 0
+            self._probe_at = None
+
+    def failure(self):
+        with self._lock:
+            self.consecutive += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.consecutive >= self.failures):
+                if self.state == CLOSED:
+                    logger.error("Bot API не отвечает (%d ошибок подряд), автомат %s разомкнут на %s с",
+                                 self.consecutive, self.name, self.reset)
+                    metrics.BOT_API_CIRCUIT_OPEN.set(1)
+                self.state = OPEN
+                self.opened += 1
+                self._opened_at = time.monotonic()
+                self._probe_at = None
+
+    def retry_in(self):
+        """Seconds until the next probe call (0 unless open)."""
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.reset - (time.monotonic() - self._opened_at))
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive,
+            "opened": self.opened,
+            "rejected": self.rejected,
+            "retry_in": round(self.retry_in(), 1),
+        }
+
+
+# Shared by every Bot API client in the process, like rate_limit.outbound_limiter
+bot_api_breaker = CircuitBreaker("bot_api")
+
+
+def diagnostics(**sections):
+    """State of the outbound path for a /diagnostics endpoint, plus ``sections``.
+
+    Values with a ``stats()`` method are replaced by its result; None values are left out.
+    """
+    from rate_limit import outbound_limiter
+    report = {"breaker": bot_api_breaker.stats(), "limiter": outbound_limiter.stats()}
+    for name, value in sections.items():
+        if value is not None:
+            report[name] = value.stats() if hasattr(value, "stats") else value
+    return report
@@ -0,0 +1,47 @@
+"""Realistic webhook payloads used by the benchmarks and the load generator."""
+import time
+
+
+def _message(update_id, chat_id, **fields):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Тест",
+                     "username": f"user{chat_id}", "language_code": "ru"},
+            "chat": {"id": chat_id, "first_name": "Тест", "username": f"user{chat_id}",
+                     "type": "private"},
+            "date": int(time.time()),
+            **fields,
+        },
+    }
+
+
+def text_update(update_id, chat_id=1000, text="Привет, бот! Как дела?"):
+    return _message(update_id, chat_id, text=text)
+
+
+def command_update(update_id, chat_id=1000, command="start"):
+    text = f"/{command}"
+    return _message(update_id, chat_id, text=text,
+                    entities=[{"offset": 0, "length": len(text), "type": "bot_command"}])
+
+
+def photo_update(update_id, chat_id=1000):
+    sizes = [(90, 67, 1361), (320, 240, 16489), (800, 600, 71532), (1280, 960, 143204)]
+    return _message(update_id, chat_id, photo=[
+        {"file_id": f"AgACAgIAAxkBAAI{update_id:08d}{w}x{h}" + "A" * 40,
+         "file_unique_id": f"AQAD{update_id:08d}{w}", "file_size": size, "width": w, "height": h}
+        for w, h, size in sizes
+    ], caption="Фото из отпуска")
+
+
+def web_app_data_update(update_id, chat_id=1000, data="Привет, бот! Я из Web App!"):
+    return _message(update_id, chat_id, web_app_data={"data": data, "button_text": "Открыть Web App"})
+
+
+def long_text_update(update_id, chat_id=1000, length=4000):
+    return text_update(update_id, chat_id, text=("Длинное сообщение " * (length // 18 + 1))[:length])
+
+
+MIX = (text_update, text_update, text_update, command_update, photo_update, web_app_data_update)
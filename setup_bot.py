@@ -1,9 +1,10 @@
 import os
 import sys
 import logging
-import asyncio
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters
 from dotenv import load_dotenv
+from bot_api import BotApiClient
+from webhook_registration import ensure_webhook
+from webhook_auth import WEBHOOK_SECRET, webhook_path
 
 # Load environment variables from .env file
 load_dotenv()
@@ -17,10 +18,10 @@ logging.basicConfig(
 # Load environment variables
 TOKEN = os.getenv("BOT_TOKEN")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
-WEBHOOK_PATH = f'/{TOKEN}'
+WEBHOOK_PATH = webhook_path(TOKEN)
 
-async def setup_webhook():
-    """Setup webhook for the bot."""
+def setup_webhook(force=False):
+    """Setup webhook for the bot (skipped if it is already registered)."""
     logging.info(f"BOT_TOKEN установлен: {'Да' if TOKEN else 'Нет'}")
     logging.info(f"WEBHOOK_URL установлен: {'Да' if WEBHOOK_URL else 'Нет'}")
     
@@ -30,15 +31,14 @@ async def setup_webhook():
 
     logging.info(f"Используемый WEBHOOK_URL: {WEBHOOK_URL}")
 
-    # Build the Application
-    logging.info("Создание Telegram Application...")
-    application = ApplicationBuilder().token(TOKEN).build()
-    logging.info("Telegram Application создан успешно")
-
     # Set webhook
     webhook_full_url = WEBHOOK_URL + WEBHOOK_PATH
-    await application.bot.set_webhook(url=webhook_full_url)
-    logging.info(f"Вебхук успешно установлен на URL: {webhook_full_url}")
+    api = BotApiClient(TOKEN)
+    try:
+        if ensure_webhook(api, webhook_full_url, secret_token=WEBHOOK_SECRET, force=force):
+            logging.info(f"Вебхук успешно установлен на URL: {webhook_full_url}")
+    finally:
+        api.close()
 
 if __name__ == '__main__':
-    asyncio.run(setup_webhook())
\ No newline at end of file
+    setup_webhook(force="--force" in sys.argv[1:])
\ No newline at end of file
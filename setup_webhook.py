@@ -2,51 +2,49 @@
 """
 Скрипт для установки и проверки webhook на Railway
 """
+import sys
 import requests
 import json
 import os
 from dotenv import load_dotenv
+from bot_api import BotApiClient, BotApiError
+from webhook_registration import ensure_webhook
+from webhook_auth import WEBHOOK_SECRET, webhook_path
 
 load_dotenv()
 
 TOKEN = os.getenv("BOT_TOKEN")
 RAILWAY_URL = "https://xxxkg-production.up.railway.app"  # Замените на ваш URL
 
+api = BotApiClient(TOKEN)
+
 def get_webhook_info():
     """Получить информацию о текущем webhook"""
     try:
-        url = f"https://api.telegram.org/bot{TOKEN}/getWebhookInfo"
-        response = requests.get(url)
-        
-        if response.status_code == 200:
-            result = response.json()
-            print("📋 Информация о webhook:")
-            print(json.dumps(result, indent=2, ensure_ascii=False))
-            return result
-        else:
-            print(f"❌ Ошибка получения информации: {response.text}")
-            return None
+        result = api.get_webhook_info()
+        print("📋 Информация о webhook:")
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+        return result
+    except BotApiError as e:
+        print(f"❌ Ошибка получения информации: {e}")
+        return None
     except Exception as e:
         print(f"❌ Исключение: {e}")
         return None
 
-def set_webhook():
-    """Установить webhook"""
-    webhook_url = f"{RAILWAY_URL}/{TOKEN}"
+def set_webhook(force=False):
+    """Установить webhook (если он уже установлен с тем же URL - ничего не делать)"""
+    webhook_url = f"{RAILWAY_URL}{webhook_path(TOKEN)}"
     
     try:
-        url = f"https://api.telegram.org/bot{TOKEN}/setWebhook"
-        data = {"url": webhook_url}
-        response = requests.post(url, data=data)
-        
-        if response.status_code == 200:
-            result = response.json()
+        if ensure_webhook(api, webhook_url, secret_token=WEBHOOK_SECRET, force=force):
             print(f"✅ Webhook установлен: {webhook_url}")
-            print(f"📋 Ответ Telegram: {json.dumps(result, indent=2, ensure_ascii=False)}")
-            return True
         else:
-            print(f"❌ Ошибка установки webhook: {response.text}")
-            return False
+            print(f"✅ Webhook уже установлен: {webhook_url}")
+        return True
+    except BotApiError as e:
+        print(f"❌ Ошибка установки webhook: {e}")
+        return False
     except Exception as e:
         print(f"❌ Исключение при установке webhook: {e}")
         return False
@@ -54,17 +52,13 @@ def set_webhook():
 def delete_webhook():
     """Удалить webhook"""
     try:
-        url = f"https://api.telegram.org/bot{TOKEN}/deleteWebhook"
-        response = requests.post(url)
-        
-        if response.status_code == 200:
-            result = response.json()
-            print(f"✅ Webhook удален")
-            print(f"📋 Ответ Telegram: {json.dumps(result, indent=2, ensure_ascii=False)}")
-            return True
-        else:
-            print(f"❌ Ошибка удаления webhook: {response.text}")
-            return False
+        result = api.delete_webhook()
+        print(f"✅ Webhook удален")
+        print(f"📋 Ответ Telegram: {json.dumps(result, indent=2, ensure_ascii=False)}")
+        return True
+    except BotApiError as e:
+        print(f"❌ Ошибка удаления webhook: {e}")
+        return False
     except Exception as e:
         print(f"❌ Исключение при удалении webhook: {e}")
         return False
@@ -84,6 +78,8 @@ def test_server():
         return False
 
 if __name__ == "__main__":
+    # --force - вызвать setWebhook, даже если вебхук не изменился
+    force = "--force" in sys.argv[1:]
     print("🔧 Настройка webhook для Telegram бота...")
     print(f"🤖 Token: {TOKEN[:10]}...")
     print(f"🌐 Railway URL: {RAILWAY_URL}")
@@ -97,7 +93,7 @@ if __name__ == "__main__":
     current_info = get_webhook_info()
     
     print("\n3. Устанавливаем новый webhook...")
-    if set_webhook():
+    if set_webhook(force):
         print("\n4. Проверяем установленный webhook...")
         get_webhook_info()
         print("\n✅ Webhook успешно настроен!")
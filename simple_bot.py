@@ -5,67 +5,102 @@ from flask import Flask, request
 from telegram import Update
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
 from dotenv import load_dotenv
-import threading
+import codec
+import metrics
+import inline_reply
+from bot_api import PTBRequest, PTB_BASE_URL, PTB_BASE_FILE_URL
+from rate_limit import PTBRateLimiter
+from bot_loop import BotLoop
+from ingest import RETRY_AFTER
+from dedup import recent_updates
+import ops_routes
+from bootstrap import run_once
+from leader import leader_lock
+from webhook_registration import allowed_updates_for
+from polling import UpdatePoller
+import warmup
+from readiness import monitor
+import profiling
+from webhook_auth import WEBHOOK_SECRET, webhook_path, reject as reject_webhook
+from log_setup import setup_logging, SAMPLE_WEBHOOK
 
 # Load environment variables
 load_dotenv()
 
-# Set up logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Set up logging (written off-thread, see log_setup.py)
+setup_logging('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
 # Load environment variables
 TOKEN = os.getenv("BOT_TOKEN")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
-WEBHOOK_PATH = f'/{TOKEN}'
+WEBHOOK_PATH = webhook_path(TOKEN)
 
 # Create Flask app
 app = Flask(__name__)
 
-# Global variable to store the bot application
+# Global variables to store the bot application and its event loop
 bot_application = None
+bot_loop = None
+# The leader's UpdatePoller (None in the other workers)
+poller = None
 
-def init_bot():
-    """Initialize bot application."""
-    global bot_application
+@run_once
+def bootstrap():
+    """Build the bot application, start its loop and register the webhook.
+
+    Runs once per worker process: from gunicorn's post_worker_init hook or on
+    the first webhook, never at import.
+    """
+    global bot_application, bot_loop, poller
     
     if not all([TOKEN, WEBHOOK_URL]):
         logging.error("Не установлены обязательные переменные окружения")
         return None
     
     # Build the Application
-    bot_application = ApplicationBuilder().token(TOKEN).build()
+    bot_application = ApplicationBuilder().token(TOKEN).base_url(PTB_BASE_URL).base_file_url(PTB_BASE_FILE_URL).request(PTBRequest()).rate_limiter(PTBRateLimiter()).build()
     
     # Add command handlers
     bot_application.add_handler(CommandHandler("start", start_command))
     
-    # Set webhook in background
-    def setup_webhook_background():
-        async def setup_webhook():
-            webhook_full_url = WEBHOOK_URL + WEBHOOK_PATH
-            await bot_application.bot.set_webhook(url=webhook_full_url)
-            logging.info(f"Вебхук успешно установлен на URL: {webhook_full_url}")
-        
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(setup_webhook())
-        loop.close()
+    # Run the Application on one shared background event loop
+    bot_loop = BotLoop(bot_application).start()
+    monitor.start(ingest=bot_loop.ingest, loop=bot_loop.loop, warm=warmup.is_ready)
     
-    setup_thread = threading.Thread(target=setup_webhook_background)
-    setup_thread.daemon = True
-    setup_thread.start()
+    # With several workers only the elected leader registers the webhook; it
+    # also falls back to getUpdates while the webhook lags (see polling.py).
+    # Runs in a background thread (non-blocking).
+    if leader_lock.acquire():
+        poller = UpdatePoller(TOKEN, deliver_polled_update, WEBHOOK_URL + WEBHOOK_PATH,
+                              allowed_updates_for(bot_application), secret_token=WEBHOOK_SECRET).start()
     
     logging.info("Bot application инициализирован")
     return bot_application
 
+def deliver_polled_update(data):
+    """Sends an update fetched with getUpdates down the webhook's path; False if full."""
+    update_id = data.get('update_id')
+    if update_id is not None and recent_updates.seen(update_id):
+        return True
+    with metrics.STAGE_DE_JSON.time():
+        update = Update.de_json(data, bot_application.bot)
+    if not bot_loop.submit(update):
+        recent_updates.forget(update_id)
+        return False
+    return True
+
 @app.route('/health')
 def health_check():
-    """Health check endpoint."""
-    logging.info("=== ПОЛУЧЕН ЗАПРОС НА /health ===")
+    """Liveness probe: constant time and no logging (readiness is /ready)."""
     return 'OK', 200
 
+def ops_components():
+    """Parts of this server shown by /diagnostics (see ops_routes.py)."""
+    return {"dispatcher": bot_loop and bot_loop.dispatcher, "ingest": bot_loop and bot_loop.ingest, "poller": poller}
+
+# /ready, /metrics, /diagnostics and /debug/*
+app.register_blueprint(ops_routes.blueprint(ops_components))
+
 @app.route('/')
 def home():
     """Home page."""
@@ -73,55 +108,75 @@ def home():
     return 'Telegram Bot is running!'
 
 @app.route(WEBHOOK_PATH, methods=['POST'])
+@metrics.track_request
+@profiling.trace_webhook
 def telegram_webhook_handler():
     """Handles incoming webhooks from Telegram."""
+    # Junk traffic is turned away on its headers, before the body is read
+    rejected = reject_webhook(request.headers)
+    if rejected:
+        return rejected
+    update_id = None
     try:
-        data = request.get_json()
-        logging.info(f"Получен вебхук от Telegram: {data.get('update_id', 'unknown')}")
+        body = request.get_data()
+        with metrics.STAGE_DECODE.time():
+            data = codec.loads(body)
+        logging.info("Получен вебхук от Telegram: %s", data.get('update_id', 'unknown'), extra=SAMPLE_WEBHOOK)
         
+        bootstrap()
         if not bot_application:
             logging.error("Bot application не инициализирован")
             return 'Bot not initialized', 500
         
-        update = Update.de_json(data, bot_application.bot)
+        # Telegram redelivers updates it considers undelivered; process each one once
+        update_id = data.get('update_id')
+        if update_id is not None and recent_updates.seen(update_id):
+            logging.info("Повторная доставка апдейта %s, пропускаем", update_id)
+            return 'OK'
+        
+        with metrics.STAGE_DE_JSON.time():
+            update = Update.de_json(data, bot_application.bot)
         
         if not update:
             logging.warning("Не удалось создать объект Update из данных вебхука")
             return 'Invalid update data', 400
         
-        # Process the update
-        def process_update():
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            loop.run_until_complete(bot_application.process_update(update))
-            loop.close()
-        
-        thread = threading.Thread(target=process_update)
-        thread.start()
+        # Hand the update over to the shared bot event loop
+        slot = inline_reply.new_slot()
+        if not bot_loop.submit(update, slot):
+            logging.warning("Очередь апдейтов переполнена, просим Telegram повторить позже")
+            recent_updates.forget(update_id)
+            return 'Overloaded', 503, {'Retry-After': str(RETRY_AFTER)}
         
-        logging.info("Вебхук обработан успешно")
+        logging.info("Вебхук обработан успешно", extra=SAMPLE_WEBHOOK)
+        # With INLINE_REPLIES=1 the handler's first reply is the response body
+        if slot is not None and slot.wait():
+            return slot.body, 200, inline_reply.JSON_HEADERS
         return 'OK'
         
     except Exception as e:
         logging.error("Ошибка при обработке вебхука: %s", e, exc_info=True)
+        if update_id is not None:
+            recent_updates.forget(update_id)
         return f'Error: {e}', 500
 
+@metrics.track_handler
+@profiling.trace_handler
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles the /start command."""
     try:
-        logging.info(f"Получена команда /start от пользователя {update.effective_user.id}")
+        logging.info("Получена команда /start от пользователя %s", update.effective_user.id, extra=SAMPLE_WEBHOOK)
         await update.message.reply_text("Привет! Я работаю на Railway! 🚀")
-        logging.info("Ответ на команду /start отправлен успешно")
+        logging.info("Ответ на команду /start отправлен успешно", extra=SAMPLE_WEBHOOK)
     except Exception as e:
-        logging.error(f"Ошибка при обработке команды /start: {e}")
+        logging.error("Ошибка при обработке команды /start: %s", e)
         await update.message.reply_text("Произошла ошибка при обработке команды.")
 
-# Initialize bot when module is imported
-init_bot()
 logging.info("Простой бот готов к работе!")
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8000))
     logging.info(f"Запуск Flask сервера на порту: {port}")
     logging.info(f"Переменная PORT из окружения: {os.environ.get('PORT', 'НЕ УСТАНОВЛЕНА')}")
+    bootstrap()
     app.run(host='0.0.0.0', port=port, debug=False, threaded=True)
\ No newline at end of file
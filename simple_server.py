@@ -1,73 +1,293 @@
 #!/usr/bin/env python3
+"""Приёмник вебхуков без Flask и gunicorn - для маленьких контейнеров.
+
+ThreadingHTTPServer из стандартной библиотеки: поток на соединение, HTTP/1.1
+с keep-alive (Telegram держит соединения открытыми), тело читается ровно по
+Content-Length и не больше WEBHOOK_MAX_BODY, все служебные ответы собраны
+заранее. Декодированный апдейт передаётся функции dispatch(data), которая
+возвращает True (принят), False (перегрузка, 503) или bytes - JSON метода
+Bot API для ответа в теле вебхука.
+
+    python simple_server.py
+
+С BOT_TOKEN апдейты обрабатывает bot_dispatcher() (/start, текст, фото -
+как быстрый путь flask_railway.py), без токена сервер только принимает запросы.
+/ready отвечает 503, пока не прогреты DNS и соединения к Bot API (warmup.py)
+и пока процесс перегружен (readiness.py); /health - только проверка жизни.
+/debug/profile и /debug/traces - профилирование, см. profiling.py.
+"""
 import os
 import sys
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import time
 import logging
+from urllib.parse import urlsplit, parse_qsl
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import codec
+import metrics
+import inline_reply
+from ingest import IngestStage, RETRY_AFTER
+from dedup import recent_updates
+from webhook_auth import webhook_path, reject as reject_webhook
+from resilience import diagnostics
+from readiness import monitor
+import profiling
+from log_setup import setup_logging, SAMPLE_WEBHOOK
 
-# Set up logging
-logging.basicConfig(
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Set up logging (written off-thread, see log_setup.py)
+setup_logging('%(asctime)s - %(levelname)s - %(message)s')
 
-class SimpleHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        logging.info(f"=== ПОЛУЧЕН GET ЗАПРОС: {self.path} ===")
-        
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html')
-        self.end_headers()
-        
-        response = f"""
+# Сколько секунд держать простаивающее keep-alive соединение
+KEEPALIVE_TIMEOUT = float(os.environ.get("KEEPALIVE_TIMEOUT", "75"))
+# Очередь ещё не принятых соединений
+LISTEN_BACKLOG = int(os.environ.get("LISTEN_BACKLOG", "128"))
+
+
+def _response(status, body=b"", content_type="text/plain; charset=utf-8", close=False, headers=()):
+    """Готовый HTTP/1.1 ответ целиком, одним куском байтов."""
+    lines = [f"HTTP/1.1 {status}", f"Content-Type: {content_type}", f"Content-Length: {len(body)}"]
+    lines += [f"{name}: {value}" for name, value in headers]
+    if close:
+        lines.append("Connection: close")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode() + body
+
+
+def _page():
+    # Показываем важные переменные окружения
+    important_vars = ['PORT', 'RAILWAY_ENVIRONMENT', 'RAILWAY_PROJECT_ID']
+    items = "".join(f"<li><strong>{var}:</strong> {os.environ.get(var, 'НЕ УСТАНОВЛЕНА')}</li>"
+                    for var in important_vars)
+    return f"""
         <html>
         <head><title>Simple Test Server</title></head>
         <body>
             <h1>🎉 СЕРВЕР РАБОТАЕТ!</h1>
-            <p><strong>Path:</strong> {self.path}</p>
             <p><strong>Port:</strong> {os.environ.get('PORT', 'НЕ УСТАНОВЛЕНА')}</p>
             <p><strong>Python:</strong> {sys.version}</p>
             <h2>Environment Variables:</h2>
-            <ul>
-        """
-        
-        # Показываем важные переменные окружения
-        important_vars = ['PORT', 'RAILWAY_ENVIRONMENT', 'RAILWAY_PROJECT_ID']
-        for var in important_vars:
-            value = os.environ.get(var, 'НЕ УСТАНОВЛЕНА')
-            response += f"<li><strong>{var}:</strong> {value}</li>"
-        
-        response += """
-            </ul>
+            <ul>{items}</ul>
         </body>
         </html>
-        """
-        
-        self.wfile.write(response.encode())
-        logging.info(f"=== ОТВЕТ ОТПРАВЛЕН ДЛЯ: {self.path} ===")
+        """.encode()
+
+
+# Ответы не зависят от запроса и собираются один раз
+OK = _response("200 OK", b"OK")
+HEALTH = OK
+PAGE = _response("200 OK", _page(), "text/html; charset=utf-8")
+BAD_REQUEST = _response("400 Bad Request", b"ERROR")
+NOT_FOUND = _response("404 Not Found", b"Not Found")
+NOT_FOUND_CLOSE = _response("404 Not Found", b"Not Found", close=True)
+SERVER_ERROR = _response("500 Internal Server Error", b"ERROR")
+OVERLOADED = _response("503 Service Unavailable", b"Overloaded",
+                       headers=[("Retry-After", RETRY_AFTER)])
+# Тело отклонённого запроса не читается, поэтому соединение закрывается
+REJECTED = {status: _response(f"{status} {text}", text.encode(), close=True)
+            for text, status in (("Forbidden", 403), ("Length Required", 411),
+                                 ("Payload Too Large", 413), ("Unsupported Media Type", 415))}
+
+
+def log_only(data):
+    """dispatch по умолчанию без токена: апдейт только пишется в лог."""
+    logging.info("📨 Апдейт %s", data.get("update_id"), extra=SAMPLE_WEBHOOK)
+    return True
+
+
+def bot_dispatcher(token):
+    """dispatch, отвечающий через Bot API прямо из потока соединения.
+
+    Импорты здесь, а не в начале модуля: без токена python-telegram-bot не нужен.
+    Соединения клиента открываются в фоне, см. warmup.start_client_warmup().
+    """
+    from bot_api import BotApiClient
+    from fast_router import FastRouter
+    from rate_limit import RateLimited
+    import warmup
+
+    api = BotApiClient(token)
+    warmup.start_client_warmup(api)
+    router = FastRouter()
+
+    @router.command("start")
+    @metrics.track_handler
+    def start(raw):
+        api.send_message(raw.chat_id, "Привет! Бот работает 🚀")
+
+    @router.text
+    @metrics.track_handler
+    def echo_text(raw):
+        api.send_message(raw.chat_id, f"Ты написал: {raw.text}")
+
+    @router.photo
+    @metrics.track_handler
+    def handle_photo(raw):
+        api.send_message(raw.chat_id, "Фото получил! 📸")
+
+    def dispatch(data):
+        # INLINE_REPLIES=1: первый ответ уходит в теле ответа на вебхук
+        with inline_reply.active(inline_reply.new_slot()) as slot:
+            with metrics.STAGE_HANDLER.time():
+                try:
+                    router.route(data)
+                except RateLimited:
+                    # Слот отправки слишком далеко: 503, Telegram повторит доставку
+                    return False
+        return slot.body if slot is not None and slot.body else True
+
+    return dispatch
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Обработчик соединения; настраивается через атрибуты класса в make_server()."""
+
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
+    webhook_path = "/webhook"
+    dispatch = staticmethod(log_only)
+    ingest = None
+    dedup = None
+
+    def do_GET(self):
+        if self.path.startswith("/debug/"):
+            self._debug()
+        elif self.path == "/health":
+            self.wfile.write(HEALTH)
+        elif self.path == "/ready":
+            reason = monitor.not_ready()
+            self.wfile.write(_response("503 Service Unavailable", reason.encode()) if reason else OK)
+        elif self.path == "/metrics":
+            self.wfile.write(_response("200 OK", metrics.render().encode(), metrics.CONTENT_TYPE))
+        elif self.path == "/diagnostics":
+            report = diagnostics(ingest=self.ingest, dedup=self.dedup, load=monitor)
+            self.wfile.write(_response("200 OK", codec.dumps(report), "application/json"))
+        elif self.path == "/":
+            self.wfile.write(PAGE)
+        else:
+            self.wfile.write(NOT_FOUND if self._discard_body() else NOT_FOUND_CLOSE)
 
     def do_POST(self):
-        logging.info(f"=== ПОЛУЧЕН POST ЗАПРОС: {self.path} ===")
-        self.do_GET()
+        if self.path.startswith("/debug/"):
+            self._debug("POST")
+            return
+        if self.path.split("?", 1)[0] != self.webhook_path:
+            self.wfile.write(NOT_FOUND if self._discard_body() else NOT_FOUND_CLOSE)
+            return
+        rejected = reject_webhook(self.headers)
+        if rejected:
+            self.close_connection = True
+            self.wfile.write(REJECTED[rejected[1]])
+            return
+        self.wfile.write(self._webhook(self.rfile.read(int(self.headers["Content-Length"]))))
+
+    def _debug(self, method="GET"):
+        """/debug/profile, /debug/traces и /debug/log_level, нужен заголовок X-Profile-Token (см. profiling.py)."""
+        # Тело у этих запросов не нужно
+        if not self._discard_body():
+            self.wfile.write(NOT_FOUND_CLOSE)
+            return
+        url = urlsplit(self.path)
+        args = dict(parse_qsl(url.query))
+        if url.path == "/debug/profile":
+            body, status, content_type = profiling.profile_response(self.headers, args)
+        elif url.path == "/debug/traces":
+            body, status, content_type = profiling.traces_response(self.headers, args)
+        elif url.path == "/debug/log_level":
+            body, status, content_type = profiling.log_level_response(self.headers, args, method)
+        else:
+            self.wfile.write(NOT_FOUND)
+            return
+        self.wfile.write(_response(f"{status} {HTTPStatus(status).phrase}", body, content_type))
+
+    @metrics.track_request
+    @profiling.trace_webhook
+    def _webhook(self, body):
+        # При перегрузке отвечаем 503, Telegram повторит доставку позже
+        if not self.ingest.try_acquire():
+            return OVERLOADED
+        update_id = None
+        try:
+            with metrics.STAGE_DECODE.time():
+                data = codec.loads(body)
+            if not isinstance(data, dict):
+                return BAD_REQUEST
+            # Повторная доставка уже принятого апдейта - подтверждаем без обработки
+            update_id = data.get("update_id")
+            if update_id is not None and self.dedup.seen(update_id):
+                return OK
+            result = self.dispatch(data)
+            if result is False:
+                self.dedup.forget(update_id)
+                return OVERLOADED
+            if isinstance(result, bytes):
+                return _response("200 OK", result, "application/json")
+            return OK
+        except codec.DecodeError:
+            return BAD_REQUEST
+        except Exception as e:
+            logging.error("❌ Ошибка обработки webhook: %s", e, exc_info=True)
+            if update_id is not None:
+                self.dedup.forget(update_id)
+            return SERVER_ERROR
+        finally:
+            self.ingest.release()
+
+    def _discard_body(self):
+        """Пропустить небольшое тело; False, если соединение придётся закрыть."""
+        length = self.headers.get("Content-Length")
+        if length and length.isascii() and length.isdigit() and int(length) <= 65536:
+            self.rfile.read(int(length))
+        elif length or self.headers.get("Transfer-Encoding"):
+            self.close_connection = True
+            return False
+        return True
+
+    def log_message(self, format, *args):
+        # Строка на каждый запрос в stderr - это дорого; ошибки протокола - в debug
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    request_queue_size = LISTEN_BACKLOG
+    daemon_threads = True
+
+
+def make_server(host, port, dispatch=log_only, path="/webhook", ingest=None, dedup=None):
+    """Сервер, передающий апдейты с ``path`` в ``dispatch(data)``."""
+    handler = type("Handler", (WebhookHandler,), {
+        "webhook_path": path,
+        "dispatch": staticmethod(dispatch),
+        "ingest": ingest or IngestStage(),
+        "dedup": dedup or recent_updates,
+    })
+    return WebhookServer((host, port), handler)
+
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8000))
     host = '0.0.0.0'
-    
-    logging.info(f"=== ЗАПУСК ПРОСТОГО HTTP СЕРВЕРА ===")
-    logging.info(f"=== HOST: {host} ===")
-    logging.info(f"=== PORT: {port} ===")
-    logging.info(f"=== RAILWAY_ENVIRONMENT: {os.environ.get('RAILWAY_ENVIRONMENT', 'НЕ УСТАНОВЛЕНА')} ===")
-    
+    token = os.environ.get("BOT_TOKEN")
+    path = webhook_path(token) if token else "/webhook"
+
+    logging.info("=== ЗАПУСК ПРОСТОГО HTTP СЕРВЕРА ===")
+    # Токен в лог не пишем
+    logging.info("=== HOST: %s PORT: %s, вебхук: %s ===", host, port,
+                 "/<token>" if token and path == f"/{token}" else path)
+
     try:
-        server = HTTPServer((host, port), SimpleHandler)
-        logging.info(f"=== СЕРВЕР СОЗДАН УСПЕШНО ===")
-        logging.info(f"=== АДРЕС СЕРВЕРА: {server.server_address} ===")
-        logging.info(f"=== СЕРВЕР ГОТОВ К РАБОТЕ НА http://{host}:{port} ===")
-        
+        started = time.perf_counter()
+        server = make_server(host, port, bot_dispatcher(token) if token else log_only, path)
+        # Без токена прогревать нечего
+        warm = None
+        if token:
+            import warmup
+            warm = warmup.is_ready
+        monitor.start(ingest=server.RequestHandlerClass.ingest, warm=warm)
+        logging.info("=== СЕРВЕР ГОТОВ К РАБОТЕ НА http://%s:%s (%.3f с) ===", host, port,
+                     time.perf_counter() - started)
         server.serve_forever()
-    except Exception as e:
-        logging.error(f"=== ОШИБКА ЗАПУСКА СЕРВЕРА: {e} ===")
-        raise
     except KeyboardInterrupt:
         logging.info("=== СЕРВЕР ОСТАНОВЛЕН ===")
-        server.server_close()
\ No newline at end of file
+        server.server_close()
+    except Exception as e:
+        logging.error("=== ОШИБКА ЗАПУСКА СЕРВЕРА: %s ===", e)
+        raise
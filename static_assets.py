@@ -0,0 +1,129 @@
+import os
+import gzip
+import hashlib
+import mimetypes
+from email.utils import formatdate, parsedate_to_datetime
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Cache-Control max-age for static assets (seconds)
+CACHE_MAX_AGE = int(os.getenv("STATIC_CACHE_MAX_AGE", "86400"))
+
+# Suffixes that keep ETags of compressed representations distinct
+_ETAG_SUFFIX = {"identity": "", "gzip": "-gz", "br": "-br"}
+
+
+def _accepted_encodings(accept_encoding):
+    """Return the content codings accepted with a non-zero q-value."""
+    accepted = set()
+    for item in (accept_encoding or "").split(","):
+        coding, _, params = item.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if q > 0:
+            accepted.add(coding)
+    return accepted
+
+
+class StaticAsset:
+    """One static file, prepared once at startup.
+
+    The body is compressed with gzip (and brotli, when installed) up front and
+    gets a strong ETag derived from its content. :meth:`respond` then only
+    negotiates ``Accept-Encoding`` and conditional headers per request.
+    Without ``mtime`` there is no ``Last-Modified`` and the ETag alone drives
+    revalidation, so every worker answers the same for the same content.
+    """
+
+    def __init__(self, body, content_type, mtime=None, max_age=CACHE_MAX_AGE):
+        if isinstance(body, str):
+            body = body.encode()
+        self.content_type = content_type
+        self.variants = {"identity": body}
+        compressed = gzip.compress(body, 9, mtime=0)
+        if len(compressed) < len(body):
+            self.variants["gzip"] = compressed
+        if brotli is not None:
+            compressed = brotli.compress(body, quality=11)
+            if len(compressed) < len(body):
+                self.variants["br"] = compressed
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.etags = {coding: f'"{digest}{_ETAG_SUFFIX[coding]}"' for coding in self.variants}
+        self.mtime = int(mtime) if mtime is not None else None
+        self.last_modified = formatdate(self.mtime, usegmt=True) if self.mtime is not None else None
+        self.cache_control = f"public, max-age={max_age}"
+
+    def _select(self, accept_encoding):
+        accepted = _accepted_encodings(accept_encoding)
+        for coding in ("br", "gzip"):
+            if coding in self.variants and (coding in accepted or "*" in accepted):
+                return coding
+        return "identity"
+
+    def _not_modified(self, headers):
+        if_none_match = headers.get("If-None-Match")
+        if if_none_match is not None:
+            if if_none_match.strip() == "*":
+                return True
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            return not tags.isdisjoint(self.etags.values())
+        if_modified_since = headers.get("If-Modified-Since")
+        if if_modified_since and self.mtime is not None:
+            try:
+                return parsedate_to_datetime(if_modified_since).timestamp() >= self.mtime
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def respond(self, headers):
+        """Build ``(status, headers, body)`` for a GET with the given request headers."""
+        coding = self._select(headers.get("Accept-Encoding"))
+        response_headers = {
+            "ETag": self.etags[coding],
+            "Cache-Control": self.cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if self.last_modified:
+            response_headers["Last-Modified"] = self.last_modified
+        if self._not_modified(headers):
+            return 304, response_headers, b""
+        response_headers["Content-Type"] = self.content_type
+        if coding != "identity":
+            response_headers["Content-Encoding"] = coding
+        return 200, response_headers, self.variants[coding]
+
+
+class StaticBundle:
+    """A set of :class:`StaticAsset` objects addressed by relative path."""
+
+    def __init__(self, assets=None):
+        self.assets = dict(assets or {})
+
+    @classmethod
+    def from_directory(cls, directory, max_age=CACHE_MAX_AGE):
+        """Load every file below ``directory`` into memory."""
+        assets = {}
+        for root, _, files in os.walk(directory):
+            for name in files:
+                path = os.path.join(root, name)
+                rel = os.path.relpath(path, directory).replace(os.sep, "/")
+                content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+                if content_type.startswith("text/") or content_type in ("application/javascript", "application/json"):
+                    content_type += "; charset=utf-8"
+                with open(path, "rb") as f:
+                    assets[rel] = StaticAsset(f.read(), content_type, os.path.getmtime(path), max_age)
+        return cls(assets)
+
+    def get(self, path):
+        return self.assets.get(path or "index.html")
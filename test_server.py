@@ -1,12 +1,10 @@
 import os
 import logging
 from flask import Flask
+from log_setup import setup_logging, SAMPLE_HEALTH
 
-# Set up logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Set up logging (written off-thread, see log_setup.py)
+setup_logging('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
 app = Flask(__name__)
 
@@ -17,7 +15,7 @@ def hello():
 
 @app.route('/health')
 def health():
-    logging.info("=== ПОЛУЧЕН ЗАПРОС НА /health ===")
+    logging.info("=== ПОЛУЧЕН ЗАПРОС НА /health ===", extra=SAMPLE_HEALTH)
     return 'OK'
 
 @app.route('/test')
@@ -0,0 +1,37 @@
+import pytest
+from dedup import UpdateDeduplicator
+
+
+def test_repeat_inside_window_is_seen():
+    dedup = UpdateDeduplicator(3)
+    assert not dedup.seen(1)
+    assert dedup.seen(1)
+    for update_id in (2, 3, 4):
+        dedup.seen(update_id)
+    # 1 was evicted by 4
+    assert not dedup.seen(1)
+
+
+def test_forgotten_and_reseen_id_survives_its_stale_slot():
+    dedup = UpdateDeduplicator(4)
+    for update_id in (1, 2, 3):
+        dedup.seen(update_id)
+    dedup.forget(2)
+    # The redelivery is processed and takes a new slot
+    assert not dedup.seen(2)
+    dedup.seen(4)
+    dedup.seen(5)
+    # Overwrites the stale slot of 2; the new one is still inside the window
+    dedup.seen(6)
+    assert dedup.seen(2)
+    assert not dedup.seen(1)
+    assert dedup.stats()["size"] == 4
+
+
+def test_non_int_update_id_leaves_state_intact():
+    dedup = UpdateDeduplicator(2)
+    dedup.seen(1)
+    with pytest.raises(TypeError):
+        dedup.seen("2")
+    assert dedup.stats() == {"capacity": 2, "size": 1, "hits": 0, "misses": 1}
+    assert dedup.seen(1)
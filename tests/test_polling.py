@@ -0,0 +1,43 @@
+import pytest
+import polling
+from bot_api import BotApiClient
+from polling import OffsetStore, UpdatePoller, POLLING, WEBHOOK
+
+TOKEN = "123456:TEST"
+URL = "https://example.com/webhook"
+
+
+@pytest.fixture
+def poller(fake_api, tmp_path, monkeypatch):
+    fake, base_url = fake_api
+    monkeypatch.setattr(polling, "WEBHOOK_CHECK_INTERVAL", 0)
+    poller = UpdatePoller(TOKEN, lambda data: True, URL, ["message"], mode="auto",
+                          offset_store=OffsetStore(str(tmp_path / "offset")),
+                          client=BotApiClient(TOKEN, base_url=base_url, pool_size=1))
+    poller._begin()
+    assert poller.state == WEBHOOK
+    return poller
+
+
+def pend(fake, count):
+    fake.updates.extend({"update_id": len(fake.updates) + i} for i in range(count))
+
+
+def test_overloaded_webhook_stays_on_webhook(fake_api, poller):
+    fake, _ = fake_api
+    # The workers shed load with 503 and Telegram's backlog grows
+    pend(fake, 5)
+    fake.set_webhook_error("Wrong response from the webhook: 503 Service Unavailable")
+    poller._watch_webhook()
+    assert poller.state == WEBHOOK
+    assert fake.calls["deleteWebhook"] == 0
+
+
+def test_failing_webhook_switches_to_polling(fake_api, poller):
+    fake, _ = fake_api
+    pend(fake, 5)
+    fake.set_webhook_error("Connection refused")
+    poller._watch_webhook()
+    assert poller.state == POLLING
+    assert fake.calls["deleteWebhook"] == 1
+    assert fake.webhook == {}
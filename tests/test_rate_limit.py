@@ -0,0 +1,48 @@
+import pytest
+from rate_limit import OutboundLimiter, RateLimited, TokenBucket
+
+
+def test_burst_then_spacing():
+    bucket = TokenBucket(rate=10, burst=3)
+    # The burst goes out at once, then one slot per interval
+    assert [bucket.reserve(100.0) for _ in range(3)] == [0, 0, 0]
+    assert bucket.reserve(100.0) == pytest.approx(0.1)
+    assert bucket.reserve(100.0) == pytest.approx(0.2)
+
+
+def test_refill():
+    bucket = TokenBucket(rate=10, burst=3)
+    for _ in range(4):
+        bucket.reserve(100.0)
+    assert bucket.delay(100.0) == pytest.approx(0.2)
+    # 0.3 s later one interval has passed since the last booked slot
+    assert bucket.reserve(100.3) == 0
+    # After an idle second the whole burst is back
+    assert [bucket.reserve(101.5) for _ in range(3)] == [0, 0, 0]
+
+
+def test_pause_until():
+    bucket = TokenBucket(rate=10, burst=3)
+    bucket.pause_until(105.0)
+    assert bucket.reserve(100.0) == pytest.approx(5.0)
+
+
+def test_share_splits_global_rate():
+    limiter = OutboundLimiter(global_rate=30, global_burst=30)
+    limiter.share(4)
+    assert limiter._global.interval == pytest.approx(4 / 30)
+    assert limiter._global.tolerance == pytest.approx(4 / 30 * 6)
+    # Per-chat buckets are per process and keep their rate
+    assert limiter._chat_bucket(1).interval == pytest.approx(1.0)
+
+
+def test_acquire_raises_instead_of_sleeping_past_max_wait():
+    limiter = OutboundLimiter(chat_rate=1, chat_burst=1, max_wait=0.5)
+    assert limiter.acquire(1) == 0
+    booked = limiter._chats[1].tat
+    with pytest.raises(RateLimited) as info:
+        limiter.acquire(1)
+    assert info.value.retry_after == pytest.approx(1.0, abs=0.05)
+    # The refused send did not book a slot
+    assert limiter._chats[1].tat == booked
+    assert limiter.stats()["rate_limited"] == 1
@@ -0,0 +1,32 @@
+import pytest
+from telegram.ext import Application, CommandHandler, MessageHandler, filters
+from bot_api import BotApiClient
+from webhook_registration import allowed_updates_for, ensure_webhook
+
+TOKEN = "123456:TEST"
+URL = "https://example.com/webhook"
+
+
+@pytest.fixture
+def application():
+    application = Application.builder().token(TOKEN).build()
+    application.add_handler(CommandHandler("start", lambda update, context: None))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, lambda update, context: None))
+    return application
+
+
+def test_ensure_webhook_sets_allowed_updates_once(fake_api, application):
+    fake, base_url = fake_api
+    client = BotApiClient(TOKEN, base_url=base_url)
+    allowed_updates = allowed_updates_for(application)
+
+    assert ensure_webhook(client, URL, allowed_updates=allowed_updates, max_connections=40)
+    assert fake.webhook["url"] == URL
+    assert fake.webhook["allowed_updates"] == ["message"]
+    assert fake.webhook["max_connections"] == 40
+    assert fake.calls["setWebhook"] == 1
+
+    # Same settings: only getWebhookInfo, no second setWebhook
+    assert not ensure_webhook(client, URL, allowed_updates=allowed_updates, max_connections=40)
+    assert fake.calls["setWebhook"] == 1
+    assert fake.calls["getWebhookInfo"] == 2
@@ -0,0 +1,203 @@
+import os
+import time
+import socket
+import asyncio
+import logging
+import threading
+import contextlib
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from bot_api import API_URL
+
+# Connections to the Bot API opened before the worker reports ready
+WARMUP_CONNECTIONS = int(os.getenv("WARMUP_CONNECTIONS", "4"))
+# How long resolved addresses are reused (seconds); 0 turns the DNS cache off
+DNS_CACHE_TTL = float(os.getenv("DNS_CACHE_TTL", "300"))
+# How long past its TTL an address is still used while the resolver fails (seconds)
+DNS_MAX_STALE = float(os.getenv("DNS_MAX_STALE", "3600"))
+# Delay between warm-up attempts while the Bot API is unreachable (seconds)
+WARMUP_RETRY_DELAY = float(os.getenv("WARMUP_RETRY_DELAY", "5"))
+
+logger = logging.getLogger(__name__)
+
+
+class DnsCache:
+    """``getaddrinfo`` cache with a TTL for the Bot API host.
+
+    :meth:`install` replaces :func:`socket.getaddrinfo`, which is what both
+    urllib3 (requests) and asyncio (httpx, aiohttp) call to resolve a host,
+    so new connections to the Bot API skip the resolver. Only the hosts
+    passed to :meth:`install` are cached; every other lookup goes straight
+    to the resolver. When a lookup fails after the TTL has run out, the last
+    good answer is used for at most ``max_stale`` more seconds. Thread-safe.
+    """
+
+    def __init__(self, ttl=DNS_CACHE_TTL, max_stale=DNS_MAX_STALE):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self._hosts = frozenset()
+        self._entries = {}
+        self._resolve = None
+        self._lock = threading.Lock()
+
+    def install(self, host):
+        """Start caching ``host`` (idempotent); a TTL of 0 leaves the resolver alone."""
+        if self.ttl <= 0:
+            return self
+        with self._lock:
+            self._hosts |= {host}
+            if self._resolve is None:
+                self._resolve = socket.getaddrinfo
+                socket.getaddrinfo = self.getaddrinfo
+        return self
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        if host not in self._hosts:
+            return self._resolve(host, port, family, type, proto, flags)
+        key = (host, port, family, type, proto, flags)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return list(entry[1])
+            self.misses += 1
+        # The resolver is called outside the lock: it can block for seconds
+        try:
+            result = self._resolve(host, port, family, type, proto, flags)
+        except socket.gaierror:
+            if entry is None or entry[0] + self.max_stale <= now:
+                raise
+            with self._lock:
+                self.stale += 1
+            logger.warning("DNS не ответил для %s, используем прошлый адрес", host)
+            return list(entry[1])
+        with self._lock:
+            self._entries[key] = (now + self.ttl, tuple(result))
+        return result
+
+    def stats(self):
+        return {
+            "ttl": self.ttl,
+            "max_stale": self.max_stale,
+            "hosts": sorted(self._hosts),
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+        }
+
+
+dns_cache = DnsCache()
+
+
+class WarmupState:
+    """Whether this process has finished warming up, with the time of each step.
+
+    Servers answer ``/ready`` with 503 until :attr:`ready` is set, so the
+    platform does not route the first updates to a worker that would still
+    be resolving DNS and opening connections for them.
+    """
+
+    def __init__(self):
+        self.ready = threading.Event()
+        self.steps = {}
+        self.attempts = 0
+        self.error = None
+        self.duration = None
+        self._started = time.perf_counter()
+
+    @contextlib.contextmanager
+    def step(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.error = f"{name}: {e}"
+            raise
+        self.steps[name] = round(time.perf_counter() - start, 4)
+
+    def finish(self):
+        self.error = None
+        self.duration = time.perf_counter() - self._started
+        self.ready.set()
+        logger.info("Прогрев завершён за %.3f с: %s", self.duration, self.steps)
+
+    def stats(self):
+        return {
+            "ready": self.ready.is_set(),
+            "attempts": self.attempts,
+            "steps": self.steps,
+            "duration": self.duration,
+            "error": self.error,
+            "dns": dns_cache.stats(),
+        }
+
+
+# One per process, like the bot loop it describes
+state = WarmupState()
+
+
+def is_ready():
+    return state.ready.is_set()
+
+
+def prime_dns(url=None):
+    """Install the DNS cache and resolve the Bot API host into it."""
+    parts = urlsplit(url or API_URL)
+    dns_cache.install(parts.hostname)
+    socket.getaddrinfo(parts.hostname, parts.port or (443 if parts.scheme == "https" else 80),
+                       type=socket.SOCK_STREAM)
+
+
+def warm_up_client(client, connections=WARMUP_CONNECTIONS):
+    """Warm up a :class:`bot_api.BotApiClient`: DNS, then ``connections`` pooled connections.
+
+    The connections are opened by concurrent ``getMe`` calls, which also
+    check the token; urllib3 keeps them in the client's pool.
+    """
+    state.attempts += 1
+    with state.step("dns"):
+        prime_dns()
+    with state.step("connections"):
+        with ThreadPoolExecutor(max(1, connections), thread_name_prefix="warmup") as pool:
+            list(pool.map(lambda _: client.call("getMe"), range(max(1, connections))))
+    state.finish()
+
+
+def start_client_warmup(client, connections=WARMUP_CONNECTIONS):
+    """:func:`warm_up_client` in a daemon thread, retried until it succeeds."""
+    def run():
+        while True:
+            try:
+                warm_up_client(client, connections)
+                return
+            except Exception as e:
+                logger.error("Прогрев не удался: %s", e)
+                time.sleep(WARMUP_RETRY_DELAY)
+
+    thread = threading.Thread(target=run, name="warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+async def warm_up_application(application, connections=WARMUP_CONNECTIONS):
+    """Warm up a python-telegram-bot Application on its event loop.
+
+    In order: DNS, ``Application.initialize()`` (the HTTP client and
+    ``getMe``), then concurrent ``getMe`` calls until ``connections``
+    connections are open in the client's pool. Raises on failure; the
+    caller retries.
+    """
+    state.attempts += 1
+    with state.step("dns"):
+        await asyncio.get_running_loop().run_in_executor(None, prime_dns)
+    with state.step("initialize"):
+        await application.initialize()
+    with state.step("connections"):
+        # initialize() has already opened one
+        await asyncio.gather(*(application.bot.get_me() for _ in range(connections - 1)))
+    state.finish()
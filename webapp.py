@@ -0,0 +1,79 @@
+import os
+from static_assets import StaticAsset, StaticBundle
+
+# Directory with a Web App bundle (index.html, scripts, styles); the inline page is used if unset
+WEBAPP_DIR = os.getenv("WEBAPP_DIR")
+
+# Web App HTML content
+WEB_APP_HTML = """
+<!DOCTYPE html>
+<html>
+<head>
+    <title>Моё первое Web App</title>
+    <style>
+        body {
+            font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, Helvetica, Arial, sans-serif;
+            text-align: center;
+            background-color: #f0f2f5;
+            padding: 20px;
+        }
+        .container {
+            background-color: white;
+            border-radius: 12px;
+            box-shadow: 0 4px 12px rgba(0, 0, 0, 0.1);
+            padding: 30px;
+            max-width: 400px;
+            margin: 0 auto;
+        }
+        h1 {
+            color: #333;
+            margin-bottom: 20px;
+        }
+        p {
+            color: #666;
+            line-height: 1.6;
+        }
+        button {
+            background-color: #007bff;
+            color: white;
+            border: none;
+            padding: 12px 24px;
+            border-radius: 8px;
+            font-size: 16px;
+            cursor: pointer;
+            transition: background-color 0.3s;
+            margin-top: 20px;
+        }
+        button:hover {
+            background-color: #0056b3;
+        }
+    </style>
+    <script src="https://telegram.org/js/telegram-web-app.js"></script>
+    <script>
+        function sendMessage() {
+            // Отправляем данные боту
+            Telegram.WebApp.sendData("Привет, бот! Я из Web App!");
+        }
+    </script>
+</head>
+<body>
+    <div class="container">
+        <h1>Добро пожаловать в Web App!</h1>
+        <p>Это простое веб-приложение, запущенное прямо в Telegram.</p>
+        <button onclick="sendMessage()">Отправить сообщение боту</button>
+    </div>
+</body>
+</html>
+"""
+
+
+def load_webapp():
+    """Prepare the Web App for serving: the bundle from WEBAPP_DIR or the inline page.
+
+    The inline page is dated by this file's mtime, which is the same in every
+    worker and across restarts of one deploy.
+    """
+    if WEBAPP_DIR:
+        return StaticBundle.from_directory(WEBAPP_DIR)
+    return StaticBundle({"index.html": StaticAsset(WEB_APP_HTML, "text/html; charset=utf-8",
+                                                          os.path.getmtime(__file__))})
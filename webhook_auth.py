@@ -0,0 +1,54 @@
+import os
+import re
+import hmac
+import logging
+import metrics
+
+# Secret Telegram sends in X-Telegram-Bot-Api-Secret-Token (1-256 of A-Z, a-z, 0-9, _ and -).
+# When set, the webhook also moves from /<token> to WEBHOOK_SECRET_PATH.
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_SECRET_PATH = os.getenv("WEBHOOK_SECRET_PATH", "/webhook")
+# Largest accepted webhook body (bytes); real updates are a few kilobytes
+WEBHOOK_MAX_BODY = int(os.getenv("WEBHOOK_MAX_BODY", str(1024 * 1024)))
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+logger = logging.getLogger(__name__)
+
+if WEBHOOK_SECRET and not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", WEBHOOK_SECRET):
+    raise ValueError("WEBHOOK_SECRET: 1-256 символов A-Z, a-z, 0-9, _ и -")
+
+_SECRET = WEBHOOK_SECRET.encode()
+_REJECTED = {reason: metrics.WEBHOOK_REJECTED.labels(reason)
+             for reason in ("secret", "length", "too_large", "content_type")}
+
+
+def webhook_path(token):
+    """Path of the webhook route: the secret path if a secret is set, else ``/<token>``."""
+    return WEBHOOK_SECRET_PATH if WEBHOOK_SECRET else f"/{token}"
+
+
+def reject(headers):
+    """Check a webhook request by its headers alone, before the body is read.
+
+    Returns None for a request that may be from Telegram, otherwise
+    ``(text, status)``: 403 for a missing or wrong secret (compared in
+    constant time), 411 without a decimal Content-Length, 413 for a body over
+    :data:`WEBHOOK_MAX_BODY` and 415 for a non-JSON content type.
+    """
+    if _SECRET and not hmac.compare_digest(headers.get(SECRET_HEADER, "").encode(), _SECRET):
+        return _rejected("secret", "Forbidden", 403)
+    length = headers.get("Content-Length")
+    if length is None or not (length.isascii() and length.isdigit()):
+        return _rejected("length", "Length Required", 411)
+    if int(length) > WEBHOOK_MAX_BODY:
+        return _rejected("too_large", "Payload Too Large", 413)
+    if not headers.get("Content-Type", "").startswith("application/json"):
+        return _rejected("content_type", "Unsupported Media Type", 415)
+    return None
+
+
+def _rejected(reason, text, status):
+    _REJECTED[reason].inc()
+    logger.debug("Вебхук отклонён (%s)", reason)
+    return text, status
@@ -0,0 +1,154 @@
+import os
+import hashlib
+import logging
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from telegram.ext import (BusinessConnectionHandler, BusinessMessagesDeletedHandler,
+                          CallbackQueryHandler, ChatBoostHandler, ChatJoinRequestHandler,
+                          ChatMemberHandler, ChosenInlineResultHandler, CommandHandler,
+                          ConversationHandler, InlineQueryHandler, MessageHandler,
+                          MessageReactionHandler, PaidMediaPurchasedHandler, PollAnswerHandler, PrefixHandler,
+                          PollHandler, PreCheckoutQueryHandler, ShippingQueryHandler)
+
+# Query parameter that carries a fingerprint of the secret token in the webhook URL
+SECRET_FINGERPRINT_PARAM = "sf"
+# Simultaneous HTTPS connections Telegram may open to the webhook (1-100, Telegram's
+# default is 40). Keep it near the number of requests the server handles at once
+# (workers x threads); an empty value leaves the current setting untouched.
+MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40") or 0) or None
+
+# Update types each handler class consumes. Message handlers only get "message":
+# the bots here do not react to edited messages or channel posts, and those are
+# most of the traffic nobody handles.
+_MESSAGE_TYPES = ("message",)
+_HANDLER_UPDATE_TYPES = {
+    CommandHandler: _MESSAGE_TYPES,
+    MessageHandler: _MESSAGE_TYPES,
+    PrefixHandler: _MESSAGE_TYPES,
+    CallbackQueryHandler: ("callback_query",),
+    InlineQueryHandler: ("inline_query",),
+    ChosenInlineResultHandler: ("chosen_inline_result",),
+    ShippingQueryHandler: ("shipping_query",),
+    PreCheckoutQueryHandler: ("pre_checkout_query",),
+    PollHandler: ("poll",),
+    PollAnswerHandler: ("poll_answer",),
+    ChatJoinRequestHandler: ("chat_join_request",),
+    BusinessConnectionHandler: ("business_connection",),
+    BusinessMessagesDeletedHandler: ("deleted_business_messages",),
+    PaidMediaPurchasedHandler: ("purchased_paid_media",),
+    # Handlers with a "which of the two" switch: (first only, second only, both)
+    ChatMemberHandler: lambda h: (("my_chat_member",), ("chat_member",),
+                                  ("my_chat_member", "chat_member"))[h.chat_member_types + 1],
+    ChatBoostHandler: lambda h: (("chat_boost",), ("removed_chat_boost",),
+                                 ("chat_boost", "removed_chat_boost"))[h.chat_boost_types + 1],
+    MessageReactionHandler: lambda h: (("message_reaction",), ("message_reaction_count",),
+                                       ("message_reaction", "message_reaction_count"))[
+                                           h.message_reaction_types + 1],
+}
+
+logger = logging.getLogger(__name__)
+
+
+def secret_fingerprint(secret_token):
+    """Short, non-reversible fingerprint of a webhook secret token."""
+    return hashlib.sha256(secret_token.encode()).hexdigest()[:12]
+
+
+def webhook_url_for(url, secret_token=None):
+    """The URL to register: ``url`` plus the secret's fingerprint, if there is a secret.
+
+    getWebhookInfo never returns the secret token, so a changed secret could
+    not be detected otherwise; with the fingerprint in the URL it changes the
+    URL, and the webhook is registered again.
+    """
+    if not secret_token:
+        return url
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query) if k != SECRET_FINGERPRINT_PARAM]
+    query.append((SECRET_FINGERPRINT_PARAM, secret_fingerprint(secret_token)))
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def _handler_update_types(handler):
+    """Update types ``handler`` consumes, or None if it is unknown (may want anything)."""
+    if isinstance(handler, ConversationHandler):
+        types = set()
+        for child in (*handler.entry_points, *handler.fallbacks,
+                      *(h for state in handler.states.values() for h in state)):
+            child_types = _handler_update_types(child)
+            if child_types is None:
+                return None
+            types.update(child_types)
+        return types
+    for cls in type(handler).__mro__:
+        types = _HANDLER_UPDATE_TYPES.get(cls)
+        if types is not None:
+            return set(types(handler) if callable(types) else types)
+    return None
+
+
+def allowed_updates_for(application):
+    """``allowed_updates`` for setWebhook computed from the handlers of ``application``.
+
+    Telegram then stops sending update types no handler consumes, so they
+    cost neither a request nor a JSON decode. Returns None - "all types" - if
+    a handler of an unknown class (TypeHandler, a custom one) is registered.
+    """
+    types = set()
+    for group in application.handlers.values():
+        for handler in group:
+            handler_types = _handler_update_types(handler)
+            if handler_types is None:
+                return None
+            types.update(handler_types)
+    return sorted(types)
+
+
+def webhook_differences(info, url, allowed_updates=None, max_connections=None):
+    """Names of the settings in ``info`` (getWebhookInfo) that differ from the desired ones.
+
+    ``None`` means "not configured": setWebhook keeps the previous value for an
+    omitted parameter, so it is not compared.
+    """
+    differences = []
+    if info.get("url", "") != url:
+        differences.append("url")
+    if allowed_updates is not None and set(info.get("allowed_updates") or ()) != set(allowed_updates):
+        differences.append("allowed_updates")
+    if max_connections is not None and info.get("max_connections") != max_connections:
+        differences.append("max_connections")
+    return differences
+
+
+def ensure_webhook(client, url, allowed_updates=None, max_connections=MAX_CONNECTIONS,
+                   secret_token=None, force=False):
+    """Register the webhook only if the current registration differs.
+
+    ``client`` is a :class:`bot_api.BotApiClient`; pass ``allowed_updates``
+    from :func:`allowed_updates_for`. Calls getWebhookInfo, logs
+    the pending update count and last delivery error, and calls setWebhook
+    only when the URL, ``allowed_updates``, ``max_connections`` or the secret
+    token changed (or with ``force``). Returns True if setWebhook was called.
+    Raises :class:`bot_api.BotApiError` when the Bot API refuses a call.
+    """
+    target = webhook_url_for(url, secret_token)
+    info = client.get_webhook_info()
+    logger.info("Вебхук: ожидает доставки %s апдейтов", info.get("pending_update_count", 0))
+    if info.get("last_error_message"):
+        logger.warning("Вебхук: последняя ошибка доставки (%s): %s",
+                       info.get("last_error_date"), info["last_error_message"])
+
+    differences = webhook_differences(info, target, allowed_updates, max_connections)
+    if not differences and not force:
+        logger.info("Вебхук уже установлен с нужными параметрами, setWebhook не нужен")
+        return False
+
+    params = {}
+    if allowed_updates is not None:
+        params["allowed_updates"] = list(allowed_updates)
+    if max_connections is not None:
+        params["max_connections"] = max_connections
+    if secret_token:
+        params["secret_token"] = secret_token
+    client.set_webhook(target, **params)
+    logger.info("Вебхук установлен (изменилось: %s)", ", ".join(differences) or "принудительно")
+    return True